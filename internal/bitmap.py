@@ -0,0 +1,166 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from typing import Iterable, Iterator, Union
+
+ARRAY_MAX_SIZE = 4096  # denser containers are smaller as bitsets of 2^16 bits
+BITSET_BYTES = 1 << 13
+BITS_OF_BYTE = [
+    tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)
+]
+
+# Sorted array("H") of low 16 bits or bitset of them in int,
+# containers aren't changed in place, so bitmaps share them
+Container = Union[array, int]
+
+
+def to_bitset(container: Container) -> int:
+    if isinstance(container, int):
+        return container
+    bits = bytearray(BITSET_BYTES)
+    for low in container:
+        bits[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(bits, "little")
+
+
+def iter_bitset(bitset: int, start: int = 0) -> Iterator[int]:
+    data = bitset.to_bytes(BITSET_BYTES, "little")
+    for i in range(start >> 3, BITSET_BYTES):
+        if data[i]:
+            for bit in BITS_OF_BYTE[data[i]]:
+                low = i << 3 | bit
+                if low >= start:
+                    yield low
+
+
+def get_size(container: Container) -> int:
+    if isinstance(container, int):
+        return container.bit_count()
+    return len(container)
+
+
+def contains(container: Container, low: int) -> bool:
+    if isinstance(container, int):
+        return bool(container >> low & 1)
+    i = bisect_left(container, low)
+    return i < len(container) and container[i] == low
+
+
+def iter_container(container: Container, start: int = 0) -> Iterator[int]:
+    if isinstance(container, int):
+        return iter_bitset(container, start)
+    return iter(container[bisect_left(container, start) :])
+
+
+def optimize(container: Container) -> Container:
+    if isinstance(container, int) and container.bit_count() <= ARRAY_MAX_SIZE:
+        return array("H", iter_bitset(container))
+    if isinstance(container, array) and len(container) > ARRAY_MAX_SIZE:
+        return to_bitset(container)
+    return container
+
+
+def union(first: Container, second: Container) -> Container:
+    if (
+        isinstance(first, array)
+        and isinstance(second, array)
+        and len(first) + len(second) <= ARRAY_MAX_SIZE
+    ):
+        return array("H", sorted(set(first).union(second)))
+    return optimize(to_bitset(first) | to_bitset(second))
+
+
+def difference(first: Container, second: Container) -> Container:
+    if isinstance(first, array):
+        return array("H", (low for low in first if not contains(second, low)))
+    return optimize(first & ~to_bitset(second))
+
+
+class BitMap:
+    """
+    Compressed set of 32-bit integers like Roaring bitmap: integers are grouped
+    by their high 16 bits, low bits of a group are kept in a sorted array while
+    there are at most 4096 of them and in a 8 KB bitset when the group is denser,
+    so an integer takes at most 2 bytes. Sets are combined group by group.
+    """
+
+    __slots__ = ("containers",)
+
+    def __init__(self, values: Iterable[int] = ()):
+        self.containers: dict[int, Container] = {}
+        for high, group in groupby(sorted(set(values)), key=lambda value: value >> 16):
+            self.containers[high] = optimize(
+                array("H", (value & 0xFFFF for value in group))
+            )
+
+    def __len__(self) -> int:
+        return sum(get_size(container) for container in self.containers.values())
+
+    def __bool__(self) -> bool:
+        return bool(self.containers)
+
+    def __contains__(self, value: int) -> bool:
+        container = self.containers.get(value >> 16)
+        return container is not None and contains(container, value & 0xFFFF)
+
+    def __iter__(self) -> Iterator[int]:
+        return self.iter_after(-1)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BitMap) and list(self) == list(other)
+
+    def __repr__(self) -> str:
+        return f"BitMap({list(self)})"
+
+    def iter_after(self, value: int) -> Iterator[int]:
+        """
+        Sorted integers greater than `value`.
+        """
+        start = value + 1
+        highs = sorted(self.containers)
+        for high in highs[bisect_right(highs, (start >> 16) - 1) :]:
+            low_start = start & 0xFFFF if high == start >> 16 else 0
+            for low in iter_container(self.containers[high], low_start):
+                yield high << 16 | low
+
+    def copy(self) -> "BitMap":
+        bitmap = BitMap()
+        bitmap.containers = dict(self.containers)
+        return bitmap
+
+    def discard(self, value: int):
+        high = value >> 16
+        container = self.containers.get(high)
+        if container is not None and contains(container, value & 0xFFFF):
+            self.set_container(
+                high, difference(container, array("H", [value & 0xFFFF]))
+            )
+
+    def set_container(self, high: int, container: Container):
+        if get_size(container):
+            self.containers[high] = container
+        else:
+            self.containers.pop(high, None)
+
+    def __ior__(self, other: "BitMap") -> "BitMap":
+        for high, container in other.containers.items():
+            own = self.containers.get(high)
+            self.containers[high] = container if own is None else union(own, container)
+        return self
+
+    def __or__(self, other: "BitMap") -> "BitMap":
+        bitmap = self.copy()
+        bitmap |= other
+        return bitmap
+
+    def __isub__(self, other: "BitMap") -> "BitMap":
+        for high, container in other.containers.items():
+            own = self.containers.get(high)
+            if own is not None:
+                self.set_container(high, difference(own, container))
+        return self
+
+    def __sub__(self, other: "BitMap") -> "BitMap":
+        bitmap = self.copy()
+        bitmap -= other
+        return bitmap
@@ -0,0 +1,101 @@
+import logging
+from asyncio import Semaphore, Task, create_task, gather
+from time import time
+from typing import Optional, Type
+
+import bson
+
+from .crud import BaseCollection
+
+from .config import (  # isort: skip
+    BULK_WRITE_BATCH_BYTES,
+    BULK_WRITE_BATCH_SIZE,
+    BULK_WRITE_MAX_IN_FLIGHT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter:
+    """
+    Packs documents into size-bounded unordered insert_many batches and keeps
+    at most `max_in_flight` batches being written at the same time.
+    """
+
+    def __init__(
+        self,
+        collection: Type[BaseCollection],
+        batch_size: int = BULK_WRITE_BATCH_SIZE,
+        batch_bytes: int = BULK_WRITE_BATCH_BYTES,
+        max_in_flight: int = BULK_WRITE_MAX_IN_FLIGHT,
+    ):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.in_flight = Semaphore(max_in_flight)
+
+        self.batch: list[dict] = []
+        self.batch_bytes_count = 0
+        self.tasks: set[Task] = set()
+        self.error: Optional[BaseException] = None
+
+        self.docs_count = 0
+        self.started_at = time()
+
+    async def __aenter__(self) -> "BulkWriter":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            await gather(*self.tasks, return_exceptions=True)
+            return
+        await self.close()
+
+    async def add(self, document: dict):
+        size = len(bson.encode(document))
+        if self.batch and (
+            len(self.batch) >= self.batch_size
+            or self.batch_bytes_count + size > self.batch_bytes
+        ):
+            await self.flush()
+        self.batch.append(document)
+        self.batch_bytes_count += size
+
+    async def flush(self):
+        if self.error:
+            raise self.error
+        if not self.batch:
+            return
+
+        batch = self.batch
+        self.batch = []
+        self.batch_bytes_count = 0
+
+        await self.in_flight.acquire()
+        task = create_task(self.insert(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.on_inserted)
+
+    async def insert(self, batch: list[dict]):
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+            self.docs_count += len(batch)
+        finally:
+            self.in_flight.release()
+
+    def on_inserted(self, task: Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() and not self.error:
+            self.error = task.exception()
+
+    async def close(self):
+        await self.flush()
+        await gather(*self.tasks)
+        if self.error:
+            raise self.error
+
+        duration = time() - self.started_at
+        logger.info(
+            f"Saved {self.docs_count} docs to {self.collection.name()} "
+            f"[{duration}] - {self.docs_count / duration if duration else 0:.0f} docs/sec"
+        )
@@ -0,0 +1,95 @@
+import logging
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+Value = TypeVar("Value")
+
+
+class CacheStatisticInfo(BaseModel):
+    version: Optional[str]
+    entries: int
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+
+
+class SnapshotLRUCache(Generic[Value]):
+    """
+    LRU cache for values calculated from one version of cloud environment.
+    It is cleared when it's used with another version (after reload).
+    Values are put with the version they were calculated from: a value
+    calculated before a reload is not cached for the next version.
+    Bounded by count of entries and total `sizeof` of values.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        max_size: int,
+        sizeof: Callable[[Value], int] = len,
+    ):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof
+
+        self.version: Optional[Hashable] = None
+        self.items: OrderedDict[Hashable, tuple[Value, int]] = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_size > 0
+
+    def use_version(self, version: Hashable):
+        if version != self.version:
+            if self.items:
+                logger.debug(f"Clear cache of version {self.version}")
+            self.items.clear()
+            self.size = 0
+            self.version = version
+
+    def get(self, key: Hashable) -> Optional[Value]:
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return item[0]
+
+    def put(self, key: Hashable, value: Value, version: Optional[Hashable]):
+        if not self.enabled or version != self.version:
+            return
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+
+        old_item = self.items.pop(key, None)
+        if old_item:
+            self.size -= old_item[1]
+
+        self.items[key] = (value, size)
+        self.size += size
+        while len(self.items) > self.max_entries or self.size > self.max_size:
+            _, (_, evicted_size) = self.items.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def statistic(self) -> CacheStatisticInfo:
+        return CacheStatisticInfo(
+            version=str(self.version) if self.version else None,
+            entries=len(self.items),
+            size=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
@@ -21,3 +21,62 @@ CHECK_SERVICE_STATUS = os.getenv(CHECK_SERVICE_STATUS_KEY, 0)
 
 SAVE_SERVICE_STATISTIC_KEY = "SAVE_SERVICE_STATISTIC"
 SAVE_SERVICE_STATISTIC = os.getenv(SAVE_SERVICE_STATISTIC_KEY, 0)
+
+# Statistic and latency histograms are saved in background:
+# queue size / insert_many batch / max delay
+STATISTIC_QUEUE_MAX_SIZE = int(os.getenv("STATISTIC_QUEUE_MAX_SIZE", 100_000))
+STATISTIC_BATCH_SIZE = int(os.getenv("STATISTIC_BATCH_SIZE", 1000))
+STATISTIC_FLUSH_SECONDS = float(os.getenv("STATISTIC_FLUSH_SECONDS", 1))
+
+# Raw ResponseInfo and per-minute / per-hour rollups of it expire by TTL
+RESPONSE_INFO_TTL_SECONDS = int(os.getenv("RESPONSE_INFO_TTL_SECONDS", 24 * 60 * 60))
+MINUTE_ROLLUP_TTL_SECONDS = int(
+    os.getenv("MINUTE_ROLLUP_TTL_SECONDS", 7 * 24 * 60 * 60)
+)
+HOUR_ROLLUP_TTL_SECONDS = int(os.getenv("HOUR_ROLLUP_TTL_SECONDS", 400 * 24 * 60 * 60))
+# /stat/timeseries uses hour rollups when minute ones would be more points,
+# ranges with more hour points are rejected
+STAT_TIMESERIES_MAX_POINTS = int(os.getenv("STAT_TIMESERIES_MAX_POINTS", 1440))
+
+CLOUD_ENV_STREAMING_KEY = "CLOUD_ENV_STREAMING"
+CLOUD_ENV_STREAMING = os.getenv(CLOUD_ENV_STREAMING_KEY, 0)
+
+CLOUD_ENV_DELTA_KEY = "CLOUD_ENV_DELTA"
+CLOUD_ENV_DELTA = os.getenv(CLOUD_ENV_DELTA_KEY, 0)
+
+CLOUD_ENV_BATCH_SIZE = int(os.getenv("CLOUD_ENV_BATCH_SIZE", 10000))
+# Hashes of VMs / firewall rules are saved in buckets, delta reload reads only
+# the changed buckets back
+CLOUD_ENV_MANIFEST_BUCKETS = int(os.getenv("CLOUD_ENV_MANIFEST_BUCKETS", 4096))
+
+BULK_WRITE_BATCH_SIZE = int(os.getenv("BULK_WRITE_BATCH_SIZE", 1000))
+BULK_WRITE_BATCH_BYTES = int(os.getenv("BULK_WRITE_BATCH_BYTES", 8 * 1024 * 1024))
+BULK_WRITE_MAX_IN_FLIGHT = int(os.getenv("BULK_WRITE_MAX_IN_FLIGHT", 4))
+
+ACTIVE_SNAPSHOT_CACHE_SECONDS = float(os.getenv("ACTIVE_SNAPSHOT_CACHE_SECONDS", 1))
+
+ATTACK_RESOLVER_KEY = "ATTACK_RESOLVER"
+ATTACK_RESOLVER = os.getenv(ATTACK_RESOLVER_KEY, "mongo")
+
+TAG_CACHE_MAX_ENTRIES = int(os.getenv("TAG_CACHE_MAX_ENTRIES", 10000))
+TAG_CACHE_MAX_VM_IDS = int(os.getenv("TAG_CACHE_MAX_VM_IDS", 10_000_000))
+
+ATTACK_RESPONSE_CACHE_MAX_ENTRIES = int(
+    os.getenv("ATTACK_RESPONSE_CACHE_MAX_ENTRIES", 10000)
+)
+ATTACK_RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv("ATTACK_RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+
+ATTACK_PAGE_MAX_LIMIT = int(os.getenv("ATTACK_PAGE_MAX_LIMIT", 10000))
+ATTACK_STREAM_CHUNK_SIZE = int(os.getenv("ATTACK_STREAM_CHUNK_SIZE", 1000))
+ATTACK_PATHS_MAX_DEPTH = int(os.getenv("ATTACK_PATHS_MAX_DEPTH", 10))
+
+# Attackers of the most requested VMs are saved on load, 0 disables it
+MATERIALIZE_MAX_VMS = int(os.getenv("MATERIALIZE_MAX_VMS", 0))
+MATERIALIZE_MAX_BYTES = int(os.getenv("MATERIALIZE_MAX_BYTES", 64 * 1024 * 1024))
+
+# The most exposed VMs (by count of attackers) saved on load for /exposure/top
+EXPOSURE_ENABLED_KEY = "EXPOSURE_ENABLED"
+EXPOSURE_ENABLED = os.getenv(EXPOSURE_ENABLED_KEY, 1)
+EXPOSURE_TOP_MAX_K = int(os.getenv("EXPOSURE_TOP_MAX_K", 1000))
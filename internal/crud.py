@@ -1,22 +1,57 @@
+import heapq
 import logging
-from typing import AsyncIterable, Optional, Type, TypeVar
+import re
+from asyncio import CancelledError, Task, create_task, gather, sleep
+from datetime import datetime, timedelta
+from time import time
+from typing import AsyncIterable, Iterable, Optional, Type, TypeVar
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import OperationFailure
 
-from .config import MONGO_DB
 from .db import get_database
-from .logger import log_step_async
+from .histogram import LatencyHistogram
 
 from .models import (  # isort: skip
+    ExposureInfo,
+    ExposureTagSetInfo,
     FirewallRule,
+    MaterializedAttackInfo,
     ResponseInfoModel,
-    StatusModel,
+    ServiceCountersModel,
+    ServiceStatusModel,
     TagInfo,
+    TagSetInfo,
     VMInfo,
 )
 
+from .config import (  # isort: skip
+    ACTIVE_SNAPSHOT_CACHE_SECONDS,
+    HOUR_ROLLUP_TTL_SECONDS,
+    MINUTE_ROLLUP_TTL_SECONDS,
+    MONGO_DB,
+    RESPONSE_INFO_TTL_SECONDS,
+)
+
 Model = TypeVar("Model", bound="BaseModel")
 
 logger = logging.getLogger(__name__)
 
+MONGO_ARRAY_ELEMS_COUNT = (
+    100000  # For preventing having huge BSON. It leads to Mongo errors
+)
+INDEX_OPTIONS_CONFLICT = 85
+
+EPOCH = datetime(1970, 1, 1)
+
+SNAPSHOT_FORMAT = "%Y%m%d%H%M%S%f"
+SNAPSHOT_PATTERN = r"\d{20}"
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
 
 class GetNamedCollectionMixin:
     @classmethod
@@ -29,6 +64,201 @@ class GetNamedCollectionMixin:
         return db[cls.name()]
 
 
+class SnapshotCollectionMixin(GetNamedCollectionMixin):
+    """
+    Collection which data is saved in a separate generation for every loaded
+    cloud environment (e.g. VirtualMachine_20230601120000000000).
+    Readers use the generation which is active in ServiceStatus,
+    writers can bind the class to a new generation with for_snapshot.
+    A new generation is not seen by readers until it's complete and activated,
+    so writers fill it without deleting anything first.
+
+    A generation made by a delta reload is a layer over the full `base_snapshot`
+    generation with only the documents of changed keys (`key_field`): they shadow
+    all documents of the same key in the base, a removed key is shadowed by
+    a {"removed": True} document.
+    """
+
+    snapshot: Optional[str] = None
+    base_snapshot: Optional[str] = None
+    key_field: str = "_id"
+
+    @classmethod
+    def for_snapshot(cls, snapshot: str, base_snapshot: Optional[str] = None):
+        return type(
+            cls.__name__,
+            (cls,),
+            {"snapshot": snapshot, "base_snapshot": base_snapshot},
+        )
+
+    @classmethod
+    def snapshot_name(cls, snapshot: Optional[str]) -> str:
+        return f"{cls.name()}_{snapshot}" if snapshot else cls.name()
+
+    @classmethod
+    async def get_snapshots(cls) -> tuple[Optional[str], Optional[str]]:
+        """
+        Generation and its base, both from one status.
+        """
+        if cls.snapshot:
+            return cls.snapshot, cls.base_snapshot
+        status = await StatusCollection.get_active_status()
+        return (status.snapshot, status.base_snapshot) if status else (None, None)
+
+    @classmethod
+    async def get_snapshot(cls) -> Optional[str]:
+        snapshot, _ = await cls.get_snapshots()
+        return snapshot
+
+    @classmethod
+    async def get_collection(cls):
+        db = (await get_database())[MONGO_DB]
+        return db[cls.snapshot_name(await cls.get_snapshot())]
+
+    @classmethod
+    async def get_layers(cls) -> list:
+        """
+        Collections of the generation, the top one first.
+        """
+        snapshot, base_snapshot = await cls.get_snapshots()
+        db = (await get_database())[MONGO_DB]
+        layers = [db[cls.snapshot_name(snapshot)]]
+        if base_snapshot:
+            layers.append(db[cls.snapshot_name(base_snapshot)])
+        return layers
+
+    @classmethod
+    async def create_indexes(cls):
+        if cls.key_field != "_id":
+            await cls.create_index(cls.key_field)
+
+    @classmethod
+    async def find_layered(
+        cls, keys: Iterable, projection: Optional[dict] = None
+    ) -> AsyncIterable[dict]:
+        """
+        Documents of `keys`, every key is read from the top layer which has it.
+        """
+        keys = list(keys)
+        if projection is not None:
+            projection = {**projection, cls.key_field: True, "removed": True}
+        for layer in await cls.get_layers():
+            shadowed = set()
+            for keys_chunk in chunks(keys, MONGO_ARRAY_ELEMS_COUNT):
+                locator = {cls.key_field: {"$in": keys_chunk}}
+                async for doc in layer.find(locator, projection):
+                    shadowed.add(doc[cls.key_field])
+                    if not doc.get("removed"):
+                        yield doc
+            keys = [key for key in keys if key not in shadowed]
+            if not keys:
+                return
+
+    @classmethod
+    async def find_layered_by(
+        cls, locator: dict, projection: Optional[dict] = None
+    ) -> AsyncIterable[dict]:
+        """
+        Documents matching `locator` from the layers which aren't shadowed
+        for their keys.
+        """
+        if projection is not None:
+            projection = {**projection, cls.key_field: True, "removed": True}
+        layers = await cls.get_layers()
+        for i, layer in enumerate(layers):
+            docs = [doc async for doc in layer.find(locator, projection)]
+            keys = list({doc[cls.key_field] for doc in docs})
+            shadowed = set()
+            for upper_layer in layers[:i]:
+                for keys_chunk in chunks(keys, MONGO_ARRAY_ELEMS_COUNT):
+                    shadowed.update(
+                        await upper_layer.distinct(
+                            cls.key_field, {cls.key_field: {"$in": keys_chunk}}
+                        )
+                    )
+            for doc in docs:
+                if doc[cls.key_field] not in shadowed and not doc.get("removed"):
+                    yield doc
+
+    @classmethod
+    async def iter_layered(
+        cls, projection: Optional[dict] = None
+    ) -> AsyncIterable[dict]:
+        """
+        All documents of the generation. Keys of the upper layers are kept
+        in memory, they are only the changed ones.
+        """
+        if projection is not None:
+            projection = {**projection, cls.key_field: True, "removed": True}
+        layers = await cls.get_layers()
+        shadowed = set()
+        for i, layer in enumerate(layers):
+            is_bottom = i == len(layers) - 1
+            layer_keys = set()
+            async for doc in layer.find({}, projection):
+                key = doc[cls.key_field]
+                if key in shadowed:
+                    continue
+                if not is_bottom:
+                    layer_keys.add(key)
+                if not doc.get("removed"):
+                    yield doc
+            shadowed |= layer_keys
+
+    @classmethod
+    async def get_by_id(cls, id: str) -> Optional[Model]:
+        return (await cls.get_by_ids([id])).get(id)
+
+    @classmethod
+    async def get_by_ids(cls, ids: Iterable[str]) -> dict[str, Model]:
+        result = {}
+        async for doc in cls.find_layered(ids):
+            id = doc["_id"]
+            if cls.rename_id:
+                doc = cls.rename(doc)
+            result[id] = cls.get_model().parse_obj(doc)
+        return result
+
+    @classmethod
+    async def count_documents(cls) -> int:
+        """
+        Documents of the generation, shadowed ones of the base are not counted.
+        """
+        layers = await cls.get_layers()
+        count = await layers[-1].count_documents({})
+        if len(layers) == 1:
+            return count
+
+        top_layer, base = layers
+        keys = []
+        async for doc in top_layer.find({}, {cls.key_field: True, "removed": True}):
+            keys.append(doc[cls.key_field])
+            count += not doc.get("removed")
+        for keys_chunk in chunks(keys, MONGO_ARRAY_ELEMS_COUNT):
+            count -= await base.count_documents({cls.key_field: {"$in": keys_chunk}})
+        return count
+
+    @classmethod
+    async def copy_snapshot(cls, snapshot: str, new_snapshot: str):
+        """
+        Copies the generation on the server side, indexes are not copied.
+        """
+        db = (await get_database())[MONGO_DB]
+        await db[cls.snapshot_name(snapshot)].aggregate(
+            [{"$out": cls.snapshot_name(new_snapshot)}]
+        ).to_list(length=None)
+
+    @classmethod
+    async def drop_snapshots(cls, keep: Iterable[Optional[str]]):
+        db = (await get_database())[MONGO_DB]
+        kept_names = {cls.snapshot_name(snapshot) for snapshot in keep}
+        generation_name = re.compile(rf"{re.escape(cls.name())}(_{SNAPSHOT_PATTERN})?")
+        for name in await db.list_collection_names():
+            if generation_name.fullmatch(name) and name not in kept_names:
+                logger.debug(f"Drop collection {name}")
+                await db.drop_collection(name)
+
+
 class BaseCollection(GetNamedCollectionMixin):
     rename_id: bool = False
 
@@ -49,9 +279,39 @@ class BaseCollection(GetNamedCollectionMixin):
         return await collection.delete_many(locator)
 
     @classmethod
-    async def insert_many(cls, documents):
+    async def insert_many(cls, documents, **kwargs):
+        collection = await cls.get_collection()
+        return await collection.insert_many(documents, **kwargs)
+
+    @classmethod
+    async def count_documents(cls, locator=None) -> int:
+        collection = await cls.get_collection()
+        return await collection.count_documents(locator or {})
+
+    @classmethod
+    async def create_index(cls, keys, **kwargs):
+        collection = await cls.get_collection()
+        return await collection.create_index(keys, **kwargs)
+
+    @classmethod
+    async def create_ttl_index(cls, field: str, ttl_seconds: int):
+        collection = await cls.get_collection()
+        try:
+            await collection.create_index(field, expireAfterSeconds=ttl_seconds)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # TTL of the existing index was changed in config
+            await collection.database.command(
+                "collMod",
+                collection.name,
+                index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl_seconds},
+            )
+
+    @classmethod
+    async def bulk_write(cls, requests, **kwargs):
         collection = await cls.get_collection()
-        return await collection.insert_many(documents)
+        return await collection.bulk_write(requests, **kwargs)
 
     @classmethod
     async def rewrite(cls, documents):
@@ -78,6 +338,12 @@ class BaseCollection(GetNamedCollectionMixin):
             obj = cls.get_model().parse_obj(doc)
             yield obj
 
+    @classmethod
+    async def iter_raw(cls, locator=None, projection=None) -> AsyncIterable[dict]:
+        collection = await cls.get_collection()
+        async for doc in collection.find(locator or {}, projection):
+            yield doc
+
     @classmethod
     async def get_by_id(cls, id: str) -> Optional[Model]:
         collection = await cls.get_collection()
@@ -89,8 +355,20 @@ class BaseCollection(GetNamedCollectionMixin):
             result.append(cls.get_model().parse_obj(doc))
         return result[0] if result else None
 
+    @classmethod
+    async def get_by_ids(cls, ids: Iterable[str]) -> dict[str, Model]:
+        collection = await cls.get_collection()
+        result = {}
+        for ids_chunk in chunks(list(ids), MONGO_ARRAY_ELEMS_COUNT):
+            async for doc in collection.find({"_id": {"$in": ids_chunk}}):
+                id = doc["_id"]
+                if cls.rename_id:
+                    doc = cls.rename(doc)
+                result[id] = cls.get_model().parse_obj(doc)
+        return result
+
 
-class VirtualMachineCollection(BaseCollection):
+class VirtualMachineCollection(SnapshotCollectionMixin, BaseCollection):
     rename_id: bool = True
 
     @classmethod
@@ -101,9 +379,67 @@ class VirtualMachineCollection(BaseCollection):
     def get_model(cls):
         return VMInfo
 
+    @classmethod
+    async def get_tags_by_ids(cls, ids: Iterable[str]) -> dict[str, list[str]]:
+        """
+        Only tags are read, names and other fields of VMs are not transferred.
+        """
+        return {
+            doc["_id"]: doc["tags"]
+            async for doc in cls.find_layered(ids, {"tags": True})
+        }
 
-class FirewallRuleCollection(BaseCollection):
+    @classmethod
+    async def get_vm_ids_with_access_to_vm(cls, vm_id: str) -> Optional[list[str]]:
+        """
+        The whole VM -> tags -> tags with access -> VMs join in one aggregation.
+        Every $lookup is followed by $unwind, so Mongo coalesces them and
+        intermediate documents don't hit the BSON size limit, $group of
+        all attackers may spill to disk instead of failing at 100 MB.
+        None for a layered generation: $lookup can't skip shadowed documents.
+        """
+        snapshot, base_snapshot = await cls.get_snapshots()
+        if base_snapshot:
+            return None
+        db = (await get_database())[MONGO_DB]
+        collection = db[cls.snapshot_name(snapshot)]
+        tag_info_name = TagInfoCollection.snapshot_name(snapshot)
+        pipeline = [
+            {"$match": {"_id": vm_id}},
+            {"$unwind": "$tags"},
+            {
+                "$lookup": {
+                    "from": tag_info_name,
+                    "localField": "tags",
+                    "foreignField": "tag",
+                    "as": "tag_info",
+                }
+            },
+            {"$unwind": "$tag_info"},
+            {"$unwind": "$tag_info.tags_with_access"},
+            {"$group": {"_id": "$tag_info.tags_with_access"}},
+            {
+                "$lookup": {
+                    "from": tag_info_name,
+                    "localField": "_id",
+                    "foreignField": "tag",
+                    "as": "tag_info",
+                }
+            },
+            {"$unwind": "$tag_info"},
+            {"$unwind": "$tag_info.tagged_vm_ids"},
+            {"$match": {"tag_info.tagged_vm_ids": {"$ne": vm_id}}},
+            {"$group": {"_id": "$tag_info.tagged_vm_ids"}},
+        ]
+        return [
+            doc["_id"]
+            async for doc in collection.aggregate(pipeline, allowDiskUse=True)
+        ]
+
+
+class FirewallRuleCollection(SnapshotCollectionMixin, BaseCollection):
     rename_id: bool = True
+    key_field = "dest_tag"
 
     @classmethod
     def name(cls):
@@ -114,7 +450,9 @@ class FirewallRuleCollection(BaseCollection):
         return FirewallRule
 
 
-class TagInfoCollection(BaseCollection):
+class TagInfoCollection(SnapshotCollectionMixin, BaseCollection):
+    key_field = "tag"
+
     @classmethod
     def name(cls):
         return "TagInfo"
@@ -125,40 +463,383 @@ class TagInfoCollection(BaseCollection):
 
     @classmethod
     async def get_aggregated_tag_info(cls, tag: str) -> Optional[TagInfo]:
-        collection = await cls.get_collection()
-        cursor = collection.find({"tag": tag})
+        return (
+            await cls.get_aggregated_tags_info(
+                [tag], fields=("tagged_vm_ids", "tags_with_access", "accessible_tags")
+            )
+        ).get(tag)
 
-        has_tag_info = False
-        tag_info = TagInfo(tag=tag, tagged_vm_ids=[], tags_with_access=[])
-        for doc in await cursor.to_list(length=None):
-            has_tag_info = True
-            tag_info.tagged_vm_ids.extend(doc["tagged_vm_ids"])
-            tag_info.tags_with_access.extend(doc["tags_with_access"])
-        return tag_info if has_tag_info else None
+    @classmethod
+    async def get_aggregated_tags_info(
+        cls,
+        tags: Iterable[str],
+        fields: Iterable[str] = ("tagged_vm_ids", "tags_with_access"),
+    ) -> dict[str, TagInfo]:
+        """
+        Merges TagInfo chunks of all `tags` with one $in query per
+        MONGO_ARRAY_ELEMS_COUNT tags, only `fields` are loaded from DB.
+        """
+        tags = list(tags)
+        if not tags:
+            return {}
+
+        fields = list(fields)
+        projection = {"_id": False, "tag": True, **{field: True for field in fields}}
+
+        tags_info = {}
+        async for doc in cls.find_layered(tags, projection):
+            tag = doc["tag"]
+            if tag not in tags_info:
+                tags_info[tag] = TagInfo(tag=tag, tagged_vm_ids=[], tags_with_access=[])
+            for field in fields:
+                getattr(tags_info[tag], field).extend(doc.get(field, []))
+        return tags_info
+
+    @classmethod
+    async def has_tagged_vm_ids(cls, tags: Iterable[str], exclude: str) -> bool:
+        """
+        Whether any of `tags` has a VM other than `exclude`,
+        stops at the first matching TagInfo chunk.
+        """
+        tags = list(tags)
+        for layer in await cls.get_layers():
+            shadowed = set()
+            for tags_chunk in chunks(tags, MONGO_ARRAY_ELEMS_COUNT):
+                doc = await layer.find_one(
+                    {
+                        "tag": {"$in": tags_chunk},
+                        "tagged_vm_ids": {"$elemMatch": {"$ne": exclude}},
+                    },
+                    {"_id": True},
+                )
+                if doc is not None:
+                    return True
+                shadowed.update(
+                    await layer.distinct("tag", {"tag": {"$in": tags_chunk}})
+                )
+            tags = [tag for tag in tags if tag not in shadowed]
+            if not tags:
+                break
+        return False
+
+
+class TagSetCollection(SnapshotCollectionMixin, BaseCollection):
+    key_field = "signature"
+
+    @classmethod
+    def name(cls):
+        return "TagSet"
+
+    @classmethod
+    async def create_indexes(cls):
+        await gather(cls.create_index("signature"), cls.create_index("tags"))
+
+    @classmethod
+    def get_model(cls):
+        return TagSetInfo
+
+    @classmethod
+    async def get_attacker_vm_ids(cls, signature: str) -> Optional[list[str]]:
+        """
+        None if the tag set isn't saved.
+        """
+        has_tag_set = False
+        attacker_vm_ids = []
+        async for doc in cls.find_layered(
+            [signature], {"_id": False, "attacker_vm_ids": True}
+        ):
+            has_tag_set = True
+            attacker_vm_ids.extend(doc["attacker_vm_ids"])
+        return attacker_vm_ids if has_tag_set else None
+
+
+class MaterializedAttackCollection(SnapshotCollectionMixin, BaseCollection):
+    @classmethod
+    def name(cls):
+        return "MaterializedAttack"
+
+    @classmethod
+    def get_model(cls):
+        return MaterializedAttackInfo
+
+    @classmethod
+    async def get_attacker_vm_ids(cls, vm_id: str) -> Optional[list[str]]:
+        async for doc in cls.find_layered([vm_id]):
+            return doc["attacker_vm_ids"]
+        return None
+
+    @classmethod
+    async def get_vm_ids(cls) -> list[str]:
+        return [doc["_id"] async for doc in cls.iter_layered({"_id": True})]
+
+
+class ExposureCollection(SnapshotCollectionMixin, BaseCollection):
+    """
+    Attackers count of every tag set with its VMs: {signature, tags,
+    attackers_count, vm_ids}, VM IDs are chunked by MONGO_ARRAY_ELEMS_COUNT.
+    """
+
+    key_field = "signature"
+
+    @classmethod
+    def name(cls):
+        return "Exposure"
+
+    @classmethod
+    def get_model(cls):
+        return ExposureTagSetInfo
+
+    @classmethod
+    async def create_indexes(cls):
+        await gather(
+            cls.create_index("signature"),
+            cls.create_index("tags"),
+            cls.create_index([("attackers_count", DESCENDING)]),
+        )
+
+    @classmethod
+    async def get_top(cls, k: int) -> list[ExposureInfo]:
+        """
+        Tag sets are read by attackers count from all layers at once until
+        the k-th VM is found, ties are ordered by VM ID.
+        """
+        layers = await cls.get_layers()
+        shadowed_for_layer = [set()]
+        for layer in layers[:-1]:
+            shadowed_for_layer.append(
+                shadowed_for_layer[-1] | set(await layer.distinct(cls.key_field))
+            )
+
+        cursors = [
+            layer.find(
+                {"attackers_count": {"$gt": 0}},
+                {
+                    "_id": False,
+                    "signature": True,
+                    "attackers_count": True,
+                    "vm_ids": True,
+                },
+            ).sort([("attackers_count", DESCENDING)])
+            for layer in layers
+        ]
+        heads = []
+        for i, cursor in enumerate(cursors):
+            doc = await anext(cursor, None)
+            if doc is not None:
+                heapq.heappush(heads, (-doc["attackers_count"], i, doc))
+
+        top: list[tuple[int, str]] = []  # (-attackers_count, VM ID)
+        while heads:
+            negative_count, i, doc = heapq.heappop(heads)
+            if len(top) >= k and -negative_count < -top[k - 1][0]:
+                break
+            if doc["signature"] not in shadowed_for_layer[i]:
+                top.extend((negative_count, vm_id) for vm_id in doc["vm_ids"])
+            doc = await anext(cursors[i], None)
+            if doc is not None:
+                heapq.heappush(heads, (-doc["attackers_count"], i, doc))
+        return [
+            ExposureInfo(id=vm_id, attackers_count=-negative_count)
+            for negative_count, vm_id in heapq.nsmallest(k, top)
+        ]
+
+
+class ManifestCollection(SnapshotCollectionMixin, BaseCollection):
+    """
+    Buckets of VM / firewall rule hashes of a snapshot: {_id, digest, items}.
+    """
+
+    @classmethod
+    def name(cls):
+        return "CloudEnvironmentManifest"
+
+    @classmethod
+    async def get_digests(cls) -> dict[str, int]:
+        return {
+            doc["_id"]: doc["digest"]
+            async for doc in cls.iter_layered({"digest": True})
+        }
+
+    @classmethod
+    async def get_items(cls, bucket_ids: Iterable[str]) -> dict[str, list]:
+        return {doc["_id"]: doc["items"] async for doc in cls.find_layered(bucket_ids)}
 
 
 class StatusCollection(BaseCollection):
+    status_id = "status"
+    active_status: Optional[ServiceStatusModel] = None
+    active_status_checked_at: float = 0
+    watching: Optional[Task] = None
+
     @classmethod
     def name(cls):
         return "ServiceStatus"
 
     @classmethod
-    def get_model(cls) -> Type[StatusModel]:
-        return StatusModel
+    def get_model(cls) -> Type[ServiceStatusModel]:
+        return ServiceStatusModel
 
     @classmethod
-    async def rewrite(cls, status: StatusModel):
+    async def rewrite(cls, status: ServiceStatusModel):
         collection = await cls.get_collection()
-        await cls.delete_many()
-        return await collection.insert_one(status.dict())
+        result = await collection.replace_one(
+            {"_id": cls.status_id}, status.dict(), upsert=True
+        )
+        await cls.delete_many({"_id": {"$ne": cls.status_id}})
+        return result
 
     @classmethod
-    async def get_status(cls) -> Optional[StatusModel]:
+    async def get_status(cls) -> Optional[ServiceStatusModel]:
         collection = await cls.get_collection()
-        cursor = collection.find({})
+        doc = await collection.find_one({"_id": cls.status_id})
+        if doc is None:
+            return await cls.migrate_legacy_status()
+        return cls.get_model().parse_obj(doc)
 
-        for doc in await cursor.to_list(length=None):
-            return cls.get_model().parse_obj(doc)
+    @classmethod
+    async def migrate_legacy_status(cls) -> Optional[ServiceStatusModel]:
+        """
+        Status saved before snapshots has a generated ID and no snapshot,
+        so unversioned collections are used. It's moved to the fixed ID once.
+        """
+        collection = await cls.get_collection()
+        doc = await collection.find_one({"_id": {"$ne": cls.status_id}})
+        if doc is None:
+            return None
+        status = cls.get_model().parse_obj(doc)
+        logger.info(f"Legacy service status is migrated: {status}")
+        await cls.rewrite(status)
+        return status
+
+    @classmethod
+    async def get_active_status(cls) -> Optional[ServiceStatusModel]:
+        """
+        Status kept in memory, it's read from DB only when the watcher didn't
+        confirm it for ACTIVE_SNAPSHOT_CACHE_SECONDS.
+        """
+        if time() - cls.active_status_checked_at > ACTIVE_SNAPSHOT_CACHE_SECONDS:
+            cls.set_active_status(await cls.get_status())
+        return cls.active_status
+
+    @classmethod
+    def set_active_status(cls, status: Optional[ServiceStatusModel]):
+        cls.active_status = status
+        cls.active_status_checked_at = time()
+
+    @classmethod
+    def reset_active_status(cls):
+        cls.active_status = None
+        cls.active_status_checked_at = 0
+
+    @classmethod
+    async def start_watching(cls):
+        cls.watching = create_task(cls.watch_active_status())
+
+    @classmethod
+    async def stop_watching(cls):
+        if cls.watching:
+            cls.watching.cancel()
+            cls.watching = None
+
+    @classmethod
+    async def watch_active_status(cls):
+        """
+        Keeps active status up to date with a change stream of ServiceStatus.
+        Change streams need a replica set, status is polled without it.
+        """
+        try:
+            await cls.watch_status_changes()
+        except OperationFailure as e:
+            logger.info(f"Status is polled, change stream is not available: {e}")
+        except CancelledError:
+            raise
+        except Exception:
+            logger.exception("Status change stream is closed, status is polled")
+
+        while True:
+            try:
+                cls.set_active_status(await cls.get_status())
+            except Exception:
+                logger.exception("Status was not polled")
+            await sleep(ACTIVE_SNAPSHOT_CACHE_SECONDS / 2)
+
+    @classmethod
+    async def watch_status_changes(cls):
+        collection = await cls.get_collection()
+        async with collection.watch(
+            [{"$match": {"documentKey._id": cls.status_id}}],
+            full_document="updateLookup",
+            max_await_time_ms=int(ACTIVE_SNAPSHOT_CACHE_SECONDS * 1000 / 2),
+        ) as stream:
+            # read after the stream is opened, so changes between are not lost
+            cls.set_active_status(await cls.get_status())
+            while stream.alive:
+                change = await stream.try_next()
+                if change is None:
+                    # no changes while waiting, the status is still actual
+                    cls.active_status_checked_at = time()
+                    continue
+                doc = change.get("fullDocument")
+                cls.set_active_status(cls.get_model().parse_obj(doc) if doc else None)
+
+    @classmethod
+    async def get_active_version(cls) -> Optional[tuple[str, int]]:
+        status = await cls.get_active_status()
+        if not status or not status.snapshot:
+            return None
+        return status.snapshot, status.revision
+
+    @classmethod
+    async def get_active_snapshot(cls) -> Optional[str]:
+        status = await cls.get_active_status()
+        return status.snapshot if status else None
+
+
+class ServiceCountersCollection(BaseCollection):
+    """
+    One document with counters for /stat, they are changed incrementally
+    instead of counting documents of other collections.
+    """
+
+    counters_id = "counters"
+
+    @classmethod
+    def name(cls):
+        return "ServiceCounters"
+
+    @classmethod
+    def get_model(cls) -> Type[ServiceCountersModel]:
+        return ServiceCountersModel
+
+    @classmethod
+    async def set_vm_count(cls, vm_count: int):
+        collection = await cls.get_collection()
+        await collection.update_one(
+            {"_id": cls.counters_id}, {"$set": {"vm_count": vm_count}}, upsert=True
+        )
+
+    @classmethod
+    async def has_vm_count(cls) -> bool:
+        collection = await cls.get_collection()
+        doc = await collection.find_one(
+            {"_id": cls.counters_id, "vm_count": {"$exists": True}}, {"_id": True}
+        )
+        return doc is not None
+
+    @classmethod
+    async def add_requests(cls, request_count: int, duration_sum: float):
+        collection = await cls.get_collection()
+        await collection.update_one(
+            {"_id": cls.counters_id},
+            {"$inc": {"request_count": request_count, "duration_sum": duration_sum}},
+            upsert=True,
+        )
+
+    @classmethod
+    async def get_counters(cls) -> ServiceCountersModel:
+        collection = await cls.get_collection()
+        doc = await collection.find_one({"_id": cls.counters_id})
+        return cls.get_model().parse_obj(doc) if doc else cls.get_model()()
 
 
 class ResponseInfoCollection(BaseCollection):
@@ -171,14 +852,123 @@ class ResponseInfoCollection(BaseCollection):
         return ResponseInfoModel
 
     @classmethod
-    @log_step_async(logger, "insert request data to DB")
-    async def insert_one(cls, document):
+    async def create_indexes(cls):
+        await cls.create_ttl_index("created_at", RESPONSE_INFO_TTL_SECONDS)
+
+    @classmethod
+    async def delete_legacy(cls):
+        """
+        Documents saved before TTL retention have no `created_at`, so they never
+        expire. Nothing matches after the first startup with TTL.
+        """
+        collection = await cls.get_collection()
+        result = await collection.delete_many({"created_at": {"$exists": False}})
+        if result.deleted_count:
+            logger.info(f"{result.deleted_count} legacy ResponseInfo are deleted")
+
+    @classmethod
+    async def get_top_params(cls, path_suffix: str, limit: int) -> list[str]:
+        """
+        Query strings of requests to paths ending with `path_suffix` (any API version),
+        the most frequent first.
+        """
         collection = await cls.get_collection()
-        return await collection.insert_one(document)
+        pipeline = [
+            {"$match": {"path": {"$regex": f"{re.escape(path_suffix)}$"}}},
+            {"$group": {"_id": "$params", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            {"$limit": limit},
+        ]
+        return [info["_id"] async for info in collection.aggregate(pipeline)]
+
+
+class LatencyHistogramCollection(BaseCollection):
+    """
+    One document per path with request durations of all workers.
+    """
+
+    @classmethod
+    def name(cls):
+        return "LatencyHistogram"
+
+    @classmethod
+    async def add_histograms(cls, histograms: dict[str, LatencyHistogram]):
+        await cls.bulk_write(
+            [
+                UpdateOne({"_id": path}, histogram.to_update(), upsert=True)
+                for path, histogram in histograms.items()
+            ],
+            ordered=False,
+        )
 
     @classmethod
-    async def get_average_duration(cls):
+    async def get_histograms(cls) -> dict[str, LatencyHistogram]:
+        return {
+            doc["_id"]: LatencyHistogram.from_db(doc) async for doc in cls.iter_raw()
+        }
+
+
+RollupKey = tuple[str, datetime]  # path, start of period
+
+
+class ResponseRollupMixin:
+    """
+    Request durations of all workers per path and period, saved with $inc
+    like LatencyHistogram. Classes differ by period and TTL.
+    """
+
+    period_seconds: int
+    ttl_seconds: int
+
+    @classmethod
+    def get_period_start(cls, created_at: datetime) -> datetime:
+        period = timedelta(seconds=cls.period_seconds)
+        return EPOCH + (created_at - EPOCH) // period * period
+
+    @classmethod
+    async def create_indexes(cls):
+        await cls.create_index([("path", ASCENDING), ("start", ASCENDING)], unique=True)
+        await cls.create_ttl_index("start", cls.ttl_seconds)
+
+    @classmethod
+    async def add_rollups(cls, rollups: dict[RollupKey, LatencyHistogram]):
+        await cls.bulk_write(
+            [
+                UpdateOne(
+                    {"path": path, "start": start}, histogram.to_update(), upsert=True
+                )
+                for (path, start), histogram in rollups.items()
+            ],
+            ordered=False,
+        )
+
+    @classmethod
+    async def get_rollups(
+        cls, path: str, start: datetime, end: datetime
+    ) -> list[tuple[datetime, LatencyHistogram]]:
         collection = await cls.get_collection()
-        pipeline = [{"$group": {"_id": None, "avg_val": {"$avg": "$duration"}}}]
-        async for info in collection.aggregate(pipeline):
-            return info["avg_val"]
+        cursor = collection.find(
+            {"path": path, "start": {"$gte": start, "$lt": end}}
+        ).sort("start", ASCENDING)
+        return [(doc["start"], LatencyHistogram.from_db(doc)) async for doc in cursor]
+
+
+class MinuteRollupCollection(ResponseRollupMixin, BaseCollection):
+    period_seconds = 60
+    ttl_seconds = MINUTE_ROLLUP_TTL_SECONDS
+
+    @classmethod
+    def name(cls):
+        return "ResponseRollupMinute"
+
+
+class HourRollupCollection(ResponseRollupMixin, BaseCollection):
+    period_seconds = 60 * 60
+    ttl_seconds = HOUR_ROLLUP_TTL_SECONDS
+
+    @classmethod
+    def name(cls):
+        return "ResponseRollupHour"
+
+
+ROLLUP_COLLECTIONS = (MinuteRollupCollection, HourRollupCollection)
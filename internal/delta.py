@@ -0,0 +1,248 @@
+import logging
+from collections import defaultdict
+from itertools import chain
+from typing import Iterable, Iterator, Optional
+
+from pymongo import InsertOne, ReplaceOne
+
+from .config import BULK_WRITE_BATCH_SIZE
+from .logger import log_step, log_step_async
+from .models import FirewallRule, TagInfo, VMInfo
+
+from .crud import (  # isort: skip
+    MONGO_ARRAY_ELEMS_COUNT,
+    chunks,
+    FirewallRuleCollection,
+    TagInfoCollection,
+    VirtualMachineCollection,
+)
+
+logger = logging.getLogger(__name__)
+
+RulePair = tuple[str, str]
+
+TAG_INFO_FIELDS = ("tagged_vm_ids", "tags_with_access", "accessible_tags")
+
+
+class CloudEnvironmentDelta:
+    def __init__(self):
+        self.upserted_vms: list[VMInfo] = []
+        self.removed_vm_ids: list[str] = []
+        self.added_rules: set[RulePair] = set()
+        self.removed_rules: set[RulePair] = set()
+
+        self.added_vm_ids_for_tag: dict[str, list[str]] = defaultdict(list)
+        self.removed_vm_ids_for_tag: dict[str, list[str]] = defaultdict(list)
+        self.added_tags_with_access_for_tag: dict[str, set[str]] = defaultdict(set)
+        self.removed_tags_with_access_for_tag: dict[str, set[str]] = defaultdict(set)
+        self.added_accessible_tags_for_tag: dict[str, set[str]] = defaultdict(set)
+        self.removed_accessible_tags_for_tag: dict[str, set[str]] = defaultdict(set)
+
+    def __bool__(self):
+        return bool(
+            self.upserted_vms
+            or self.removed_vm_ids
+            or self.added_rules
+            or self.removed_rules
+        )
+
+    def __str__(self):
+        return (
+            f"VMs: {len(self.upserted_vms)} upserted, {len(self.removed_vm_ids)} removed; "
+            f"rules: {len(self.added_rules)} added, {len(self.removed_rules)} removed"
+        )
+
+
+@log_step(logger, "calculate cloud environment delta")
+def calculate_delta(
+    old_vms: dict[str, VMInfo],
+    new_vms: dict[str, VMInfo],
+    old_rules: set[RulePair],
+    new_rules: set[RulePair],
+) -> CloudEnvironmentDelta:
+    delta = CloudEnvironmentDelta()
+
+    for vm_id, old_vm in old_vms.items():
+        if vm_id in new_vms:
+            continue
+        delta.removed_vm_ids.append(vm_id)
+        for tag in set(old_vm.tags):
+            delta.removed_vm_ids_for_tag[tag].append(vm_id)
+
+    for vm_id, new_vm in new_vms.items():
+        old_vm = old_vms.get(vm_id)
+        if old_vm == new_vm:
+            continue
+        delta.upserted_vms.append(new_vm)
+
+        old_tags = set(old_vm.tags) if old_vm else set()
+        new_tags = set(new_vm.tags)
+        for tag in old_tags - new_tags:
+            delta.removed_vm_ids_for_tag[tag].append(vm_id)
+        for tag in new_tags - old_tags:
+            delta.added_vm_ids_for_tag[tag].append(vm_id)
+
+    delta.removed_rules = old_rules - new_rules
+    delta.added_rules = new_rules - old_rules
+    for source_tag, dest_tag in delta.removed_rules:
+        delta.removed_tags_with_access_for_tag[dest_tag].add(source_tag)
+        delta.removed_accessible_tags_for_tag[source_tag].add(dest_tag)
+    for source_tag, dest_tag in delta.added_rules:
+        delta.added_tags_with_access_for_tag[dest_tag].add(source_tag)
+        delta.added_accessible_tags_for_tag[source_tag].add(dest_tag)
+
+    return delta
+
+
+async def bulk_write(collection, requests: list):
+    for requests_chunk in chunks(requests, BULK_WRITE_BATCH_SIZE):
+        await collection.bulk_write(requests_chunk, ordered=False)
+
+
+def iter_tag_info_documents(tag_info: TagInfo) -> Iterator[dict]:
+    """
+    Chunks of one TagInfo like a full reload saves them,
+    a tag without VMs and rules is shadowed as removed.
+    """
+    tag = tag_info.tag
+    for vm_ids_chunk in chunks(tag_info.tagged_vm_ids, MONGO_ARRAY_ELEMS_COUNT):
+        yield TagInfo(tag=tag, tagged_vm_ids=vm_ids_chunk, tags_with_access=[]).dict()
+    for source_tags_chunk in chunks(tag_info.tags_with_access, MONGO_ARRAY_ELEMS_COUNT):
+        yield TagInfo(
+            tag=tag, tagged_vm_ids=[], tags_with_access=source_tags_chunk
+        ).dict()
+    for dest_tags_chunk in chunks(tag_info.accessible_tags, MONGO_ARRAY_ELEMS_COUNT):
+        yield TagInfo(
+            tag=tag,
+            tagged_vm_ids=[],
+            tags_with_access=[],
+            accessible_tags=dest_tags_chunk,
+        ).dict()
+    if not (
+        tag_info.tagged_vm_ids or tag_info.tags_with_access or tag_info.accessible_tags
+    ):
+        yield {"tag": tag, "removed": True}
+
+
+def get_new_tag_info(
+    tag: str, old_tag_info: Optional[TagInfo], delta: CloudEnvironmentDelta
+) -> TagInfo:
+    old_tag_info = old_tag_info or TagInfo(
+        tag=tag, tagged_vm_ids=[], tags_with_access=[]
+    )
+    removed_vm_ids = set(delta.removed_vm_ids_for_tag.get(tag, ()))
+    return TagInfo(
+        tag=tag,
+        tagged_vm_ids=[
+            vm_id for vm_id in old_tag_info.tagged_vm_ids if vm_id not in removed_vm_ids
+        ]
+        + delta.added_vm_ids_for_tag.get(tag, []),
+        tags_with_access=sorted(
+            set(old_tag_info.tags_with_access)
+            - delta.removed_tags_with_access_for_tag.get(tag, set())
+            | delta.added_tags_with_access_for_tag.get(tag, set())
+        ),
+        accessible_tags=sorted(
+            set(old_tag_info.accessible_tags)
+            - delta.removed_accessible_tags_for_tag.get(tag, set())
+            | delta.added_accessible_tags_for_tag.get(tag, set())
+        ),
+    )
+
+
+async def replace_keys(
+    collection, key_field: str, keys: list, documents: Iterable[dict]
+):
+    """
+    Documents of `keys` in the top layer are replaced with `documents`.
+    """
+    for keys_chunk in chunks(keys, MONGO_ARRAY_ELEMS_COUNT):
+        await collection.delete_many({key_field: {"$in": keys_chunk}})
+    await bulk_write(collection, [InsertOne(document) for document in documents])
+
+
+@log_step_async(logger, "apply cloud environment delta")
+async def apply_delta(
+    snapshot: str,
+    base_snapshot: str,
+    delta: CloudEnvironmentDelta,
+    rule_id_prefix: str,
+) -> set[str]:
+    """
+    Writes documents touched by `delta` to the `snapshot` layer over
+    `base_snapshot`: VMs are replaced or shadowed as removed, TagInfo and
+    firewall rules of every touched tag are read from the generation and
+    written with the changes applied. Returns tags which VMs got other attackers.
+    """
+    await bulk_write(
+        VirtualMachineCollection.for_snapshot(snapshot),
+        [
+            ReplaceOne({"_id": vm_id}, {"_id": vm_id, "removed": True}, upsert=True)
+            for vm_id in delta.removed_vm_ids
+        ]
+        + [
+            ReplaceOne({"_id": vm.id}, vm.to_db(), upsert=True)
+            for vm in delta.upserted_vms
+        ],
+    )
+
+    vm_tags = delta.added_vm_ids_for_tag.keys() | delta.removed_vm_ids_for_tag.keys()
+    dest_tags = (
+        delta.added_tags_with_access_for_tag.keys()
+        | delta.removed_tags_with_access_for_tag.keys()
+    )
+    touched_tags = (
+        vm_tags
+        | dest_tags
+        | delta.added_accessible_tags_for_tag.keys()
+        | delta.removed_accessible_tags_for_tag.keys()
+    )
+    old_tags_info = await TagInfoCollection.for_snapshot(
+        snapshot, base_snapshot
+    ).get_aggregated_tags_info(touched_tags, fields=TAG_INFO_FIELDS)
+    new_tags_info = {
+        tag: get_new_tag_info(tag, old_tags_info.get(tag), delta)
+        for tag in touched_tags
+    }
+
+    await replace_keys(
+        TagInfoCollection.for_snapshot(snapshot),
+        "tag",
+        list(touched_tags),
+        chain.from_iterable(
+            iter_tag_info_documents(tag_info) for tag_info in new_tags_info.values()
+        ),
+    )
+
+    rules = []
+    for dest_tag in dest_tags:
+        tags_with_access = new_tags_info[dest_tag].tags_with_access
+        for source_tag in tags_with_access:
+            rules.append(
+                FirewallRule(
+                    id=f"{rule_id_prefix}-{len(rules)}",
+                    source_tag=source_tag,
+                    dest_tag=dest_tag,
+                ).to_db()
+            )
+        if not tags_with_access:
+            rules.append(
+                {
+                    "_id": f"{rule_id_prefix}-{len(rules)}",
+                    "dest_tag": dest_tag,
+                    "removed": True,
+                }
+            )
+    await replace_keys(
+        FirewallRuleCollection.for_snapshot(snapshot),
+        "dest_tag",
+        list(dest_tags),
+        rules,
+    )
+
+    affected_tags = set(dest_tags)
+    for tag in vm_tags:
+        if tag in old_tags_info:
+            affected_tags.update(old_tags_info[tag].accessible_tags)
+        affected_tags.update(new_tags_info[tag].accessible_tags)
+    return affected_tags
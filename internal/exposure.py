@@ -0,0 +1,167 @@
+import logging
+from collections import defaultdict
+from itertools import chain
+from typing import Iterable, Iterator
+
+from .bulk_writer import BulkWriter
+from .config import EXPOSURE_ENABLED
+from .crud import MONGO_ARRAY_ELEMS_COUNT, ExposureCollection, chunks
+from .delta import CloudEnvironmentDelta
+from .logger import log_step_async
+from .models import ExposureTagSetInfo, VMInfo
+
+from .tag_sets import (  # isort: skip
+    TagSet,
+    get_attacker_vm_ids_for_tag_set,
+    get_tag_maps_for_tags,
+    get_tag_set,
+    get_tag_set_signature,
+    get_tags_for_tag_sets_with_tags,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def is_exposure_enabled() -> bool:
+    try:
+        return bool(int(EXPOSURE_ENABLED))
+    except ValueError:
+        return True
+
+
+def iter_tag_set_exposures(
+    vm_ids_for_tag_set: dict[TagSet, list[str]],
+    tags_with_access_for_tag: dict[str, set[str]],
+) -> Iterator[ExposureTagSetInfo]:
+    """
+    Every VM belongs to one tag set, so count of attackers is the sum of VM counts
+    of the tag sets with a tag with access: attackers are counted per tag set
+    without building lists of their IDs. A VM is its own attacker only if its
+    tag set is one of them, so it's the same for all VMs of the tag set.
+    """
+    tag_sets = list(vm_ids_for_tag_set)
+    tag_sets_for_tag: dict[str, list[int]] = defaultdict(list)
+    for i, tags in enumerate(tag_sets):
+        for tag in tags:
+            tag_sets_for_tag[tag].append(i)
+
+    for i, tags in enumerate(tag_sets):
+        attacker_tag_sets = set()
+        for tag in tags:
+            for tag_with_access in tags_with_access_for_tag.get(tag, ()):
+                attacker_tag_sets.update(tag_sets_for_tag.get(tag_with_access, ()))
+        attackers_count = sum(
+            len(vm_ids_for_tag_set[tag_sets[j]]) for j in attacker_tag_sets
+        ) - (i in attacker_tag_sets)
+        yield ExposureTagSetInfo(
+            signature=get_tag_set_signature(tags),
+            tags=list(tags),
+            attackers_count=attackers_count,
+            vm_ids=vm_ids_for_tag_set[tags],
+        )
+
+
+def iter_exposure_documents(exposure: ExposureTagSetInfo) -> Iterator[dict]:
+    """
+    Chunks of VM IDs with the same attackers count,
+    a tag set without VMs is shadowed as removed.
+    """
+    for vm_ids_chunk in chunks(exposure.vm_ids, MONGO_ARRAY_ELEMS_COUNT):
+        yield exposure.copy(update={"vm_ids": vm_ids_chunk}).dict()
+    if not exposure.vm_ids:
+        yield {"signature": exposure.signature, "removed": True}
+
+
+async def write_exposures(snapshot: str, exposures: Iterable[ExposureTagSetInfo]):
+    async with BulkWriter(ExposureCollection.for_snapshot(snapshot)) as writer:
+        for exposure in exposures:
+            for doc in iter_exposure_documents(exposure):
+                await writer.add(doc)
+
+
+@log_step_async(logger, "insert attackers count of all tag sets")
+async def add_exposure(
+    snapshot: str,
+    vm_ids_for_tag_set: dict[TagSet, list[str]],
+    tags_with_access_for_tag: dict[str, set[str]],
+):
+    """
+    All tag sets are saved with their VMs, so a delta reload can count
+    attackers again only for the changed ones.
+    """
+    await ExposureCollection.for_snapshot(snapshot).create_indexes()
+    await write_exposures(
+        snapshot, iter_tag_set_exposures(vm_ids_for_tag_set, tags_with_access_for_tag)
+    )
+
+
+@log_step_async(logger, "update attackers count of changed tag sets")
+async def update_exposure(
+    snapshot: str,
+    base_snapshot: str,
+    delta: CloudEnvironmentDelta,
+    old_vms: dict[str, VMInfo],
+    affected_tags: Iterable[str],
+):
+    """
+    Tag sets with any of `affected_tags` and tag sets which VMs were moved
+    by `delta` are written to the `snapshot` layer, others stay in the base.
+    """
+    exposure_collection = ExposureCollection.for_snapshot(snapshot, base_snapshot)
+    tags_for_tag_set = await get_tags_for_tag_sets_with_tags(
+        exposure_collection, affected_tags
+    )
+    moved_out_vm_ids: dict[str, set[str]] = defaultdict(set)
+    moved_in_vm_ids: dict[str, list[str]] = defaultdict(list)
+    for vm_id in delta.removed_vm_ids:
+        signature = get_tag_set_signature(old_vms[vm_id].tags)
+        moved_out_vm_ids[signature].add(vm_id)
+        tags_for_tag_set.setdefault(signature, list(get_tag_set(old_vms[vm_id].tags)))
+    for vm in delta.upserted_vms:
+        signature = get_tag_set_signature(vm.tags)
+        old_vm = old_vms.get(vm.id)
+        if old_vm:
+            old_signature = get_tag_set_signature(old_vm.tags)
+            if old_signature == signature:
+                continue
+            moved_out_vm_ids[old_signature].add(vm.id)
+            tags_for_tag_set.setdefault(old_signature, list(get_tag_set(old_vm.tags)))
+        moved_in_vm_ids[signature].append(vm.id)
+        tags_for_tag_set.setdefault(signature, list(get_tag_set(vm.tags)))
+
+    vm_ids_for_tag_set: dict[str, list[str]] = defaultdict(list)
+    async for doc in exposure_collection.find_layered(
+        tags_for_tag_set, {"_id": False, "vm_ids": True}
+    ):
+        vm_ids_for_tag_set[doc["signature"]].extend(doc["vm_ids"])
+    vm_ids_for_tag, tags_with_access_for_tag = await get_tag_maps_for_tags(
+        snapshot, base_snapshot, set(chain.from_iterable(tags_for_tag_set.values()))
+    )
+
+    exposures = []
+    for signature, tags in tags_for_tag_set.items():
+        vm_ids = [
+            vm_id
+            for vm_id in vm_ids_for_tag_set[signature]
+            if vm_id not in moved_out_vm_ids[signature]
+        ] + moved_in_vm_ids[signature]
+        attacker_vm_ids = set(
+            get_attacker_vm_ids_for_tag_set(
+                tags, vm_ids_for_tag, tags_with_access_for_tag
+            )
+        )
+        exposures.append(
+            ExposureTagSetInfo(
+                signature=signature,
+                tags=tags,
+                attackers_count=len(attacker_vm_ids)
+                - bool(vm_ids and vm_ids[0] in attacker_vm_ids),
+                vm_ids=vm_ids,
+            )
+        )
+
+    exposure_layer = ExposureCollection.for_snapshot(snapshot)
+    for signatures_chunk in chunks(list(tags_for_tag_set), MONGO_ARRAY_ELEMS_COUNT):
+        await exposure_layer.delete_many({"signature": {"$in": signatures_chunk}})
+    await write_exposures(snapshot, exposures)
+    logger.info(f"Attackers count of {len(exposures)} tag sets is updated")
@@ -1,11 +1,37 @@
+import json
 import logging
+import re
+from typing import Iterator, TextIO
 
-from .config import CLOUD_SCHEMA_PATH
+from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import ExtraError, MissingError
+
+from .config import CLOUD_ENV_BATCH_SIZE, CLOUD_SCHEMA_PATH
 from .logger import log_step, log_step_async
-from .models import CloudEnvironment
+
+from .models import (  # isort: skip
+    NOT_UNIQUE_RULE_IDS_MSG,
+    NOT_UNIQUE_VM_IDS_MSG,
+    CloudEnvironment,
+    StrictBaseModel,
+)
 
 logger = logging.getLogger(__name__)
 
+READ_CHUNK_SIZE = 1 << 16
+# their prefixes (and "-" of numbers) are values cut by the chunk border
+JSON_LITERALS = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+# fraction or exponent of a number which is cut by the chunk border
+NUMBER_TAIL = re.compile(r"(\.\d*)?([eE][-+]?\d*)?")
+
+NOT_UNIQUE_IDS_MSG_FOR_FIELD = {
+    "machines": NOT_UNIQUE_VM_IDS_MSG,
+    "rules": NOT_UNIQUE_RULE_IDS_MSG,
+}
+
+CloudEnvironmentBatch = tuple[str, list[StrictBaseModel]]
+
 
 @log_step(logger, "reading schema")
 def read_schema():
@@ -20,3 +46,183 @@ async def get_cloud_environment() -> CloudEnvironment:
     cloud_env = CloudEnvironment.parse_raw(content)
 
     return cloud_env
+
+
+def environment_error(exc: Exception, loc) -> ValidationError:
+    return ValidationError([ErrorWrapper(exc, loc=loc)], CloudEnvironment)
+
+
+class JSONStream:
+    """
+    Reads JSON values one by one from a file, keeping in memory only the
+    part of the file which is needed for decoding the current value.
+    """
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f: TextIO, chunk_size: int = READ_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            expected = " or ".join(f"'{c}'" for c in chars)
+            raise json.JSONDecodeError(f"Expecting {expected}", self.buffer, self.pos)
+        self.pos += 1
+        return char
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if not self.is_cut(e) or not self.read_more():
+                    raise
+                continue
+            # numbers can be cut by the chunk border, so they need the next chunk
+            if end == len(self.buffer) and self.read_more():
+                continue
+            self.pos = end
+            return value
+
+    def is_cut(self, e: json.JSONDecodeError) -> bool:
+        """
+        Only a value cut by the end of the buffer can be decoded with the next
+        chunk, other errors are raised at once instead of reading the whole file.
+        """
+        rest = self.buffer[e.pos :]
+        if e.msg.startswith("Unterminated string"):
+            return True
+        if e.msg.startswith("Invalid \\uXXXX escape"):
+            return len(rest) <= len("uXXXX")
+        if e.msg == "Expecting value":
+            return any(literal.startswith(rest) for literal in JSON_LITERALS)
+        return not rest.strip() or bool(NUMBER_TAIL.fullmatch(rest))
+
+    def decode_key(self) -> str:
+        if self.peek() != '"':
+            raise json.JSONDecodeError(
+                "Expecting property name enclosed in double quotes",
+                self.buffer,
+                self.pos,
+            )
+        key = self.decode_value()
+        self.expect(":")
+        return key
+
+
+def iter_array_batches(
+    stream: JSONStream, alias: str, field_name: str, batch_size: int
+) -> Iterator[CloudEnvironmentBatch]:
+    model = CloudEnvironment.__fields__[field_name].type_
+    seen_ids = set()
+    batch = []
+
+    stream.expect("[")
+    if stream.peek() == "]":
+        stream.pos += 1
+        return
+
+    index = 0
+    while True:
+        try:
+            obj = model.parse_obj(stream.decode_value())
+        except ValidationError as e:
+            raise environment_error(e, (alias, index))
+
+        if obj.id in seen_ids:
+            raise environment_error(
+                AssertionError(NOT_UNIQUE_IDS_MSG_FOR_FIELD[field_name]), (alias,)
+            )
+        seen_ids.add(obj.id)
+
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            yield field_name, batch
+            batch = []
+
+        index += 1
+        if stream.expect(",]") == "]":
+            break
+
+    if batch:
+        yield field_name, batch
+
+
+def iter_cloud_environment_from_file(
+    f: TextIO, batch_size: int, chunk_size: int = READ_CHUNK_SIZE
+) -> Iterator[CloudEnvironmentBatch]:
+    fields_by_alias = {
+        field.alias: field.name for field in CloudEnvironment.__fields__.values()
+    }
+    stream = JSONStream(f, chunk_size)
+    found_aliases = set()
+
+    try:
+        stream.expect("{")
+        if stream.peek() == "}":
+            stream.pos += 1
+        else:
+            while True:
+                alias = stream.decode_key()
+                if alias not in fields_by_alias:
+                    raise environment_error(ExtraError(), (alias,))
+                found_aliases.add(alias)
+
+                yield from iter_array_batches(
+                    stream, alias, fields_by_alias[alias], batch_size
+                )
+
+                if stream.expect(",}") == "}":
+                    break
+
+        if stream.peek():
+            raise json.JSONDecodeError("Extra data", stream.buffer, stream.pos)
+    except json.JSONDecodeError as e:
+        raise environment_error(e, "__root__")
+
+    missing_aliases = sorted(fields_by_alias.keys() - found_aliases)
+    if missing_aliases:
+        raise ValidationError(
+            [ErrorWrapper(MissingError(), loc=(alias,)) for alias in missing_aliases],
+            CloudEnvironment,
+        )
+
+
+def iter_cloud_environment_batches(
+    batch_size: int = CLOUD_ENV_BATCH_SIZE,
+) -> Iterator[CloudEnvironmentBatch]:
+    """
+    Streaming alternative for get_cloud_environment: validates VMs and firewall
+    rules one by one and yields them as ("machines" | "rules", batch) pairs,
+    so the whole cloud environment is never kept in memory.
+    """
+    logger.debug("Start streaming cloud environment")
+    with open(CLOUD_SCHEMA_PATH, "r") as f:
+        yield from iter_cloud_environment_from_file(f, batch_size)
+    logger.debug("Finish streaming cloud environment")
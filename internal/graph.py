@@ -0,0 +1,296 @@
+import heapq
+import logging
+from array import array
+from asyncio import Task, create_task, get_running_loop
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Iterable, Iterator, Optional
+
+from .bitmap import BitMap
+from .logger import log_step_async
+
+from .crud import (  # isort: skip
+    FirewallRuleCollection,
+    StatusCollection,
+    VirtualMachineCollection,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CSR:
+    """
+    Compressed sparse rows: values of row `i` are values[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, rows: Iterable[Iterable[int]]):
+        self.offsets = array("I", [0])
+        self.values = array("I")
+        for row in rows:
+            self.values.extend(row)
+            self.offsets.append(len(self.values))
+
+    def __getitem__(self, i: int) -> memoryview:
+        return memoryview(self.values)[self.offsets[i] : self.offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def merge_sorted_vms(
+    sorted_vms_rows: Iterable[Iterator[int]], exclude: int
+) -> Iterator[int]:
+    previous = None
+    for vm in heapq.merge(*sorted_vms_rows):
+        if vm != previous and vm != exclude:
+            yield vm
+        previous = vm
+
+
+class AttackGraph:
+    """
+    Cloud environment in process memory: VM IDs and tags are interned to integers,
+    VM -> tags, tag -> tags with access and tag -> accessible tags are kept
+    in CSR arrays,
+    VMs of every tag are kept in a compressed bitmap of VM indexes, so memory
+    is proportional to count of VM tags, not to count of tags * count of VMs,
+    and sets of VMs are combined without decoding them.
+    """
+
+    def __init__(
+        self,
+        vm_ids: list[str],
+        tags: list[str],
+        vm_tags: CSR,
+        tags_with_access: CSR,
+        accessible_tags: CSR,
+        version: tuple = (),
+    ):
+        self.vm_ids = vm_ids  # sorted, index of VM ID is its interned value
+        self.tags = tags
+        self.vm_tags = vm_tags
+        self.tags_with_access = tags_with_access
+        self.accessible_tags = accessible_tags
+        self.version = version
+
+        vms_for_tag = [[] for _ in tags]
+        for vm in range(len(vm_ids)):
+            for tag in vm_tags[vm]:
+                vms_for_tag[tag].append(vm)
+        self.tag_vms = [BitMap(vms) for vms in vms_for_tag]
+
+    @classmethod
+    def build(
+        cls,
+        vms: Iterable[tuple[str, list[str]]],
+        rules: Iterable[tuple[str, str]],
+        version: tuple = (),
+    ) -> "AttackGraph":
+        tag_index: dict[str, int] = {}
+
+        def intern_tag(tag: str) -> int:
+            return tag_index.setdefault(tag, len(tag_index))
+
+        interned_vms = sorted(
+            (vm_id, sorted({intern_tag(tag) for tag in tags})) for vm_id, tags in vms
+        )
+
+        sources_for_tag = defaultdict(set)
+        dests_for_tag = defaultdict(set)
+        for source_tag, dest_tag in rules:
+            source, dest = intern_tag(source_tag), intern_tag(dest_tag)
+            sources_for_tag[dest].add(source)
+            dests_for_tag[source].add(dest)
+
+        return cls(
+            vm_ids=[vm_id for vm_id, _ in interned_vms],
+            tags=list(tag_index),
+            vm_tags=CSR(tags for _, tags in interned_vms),
+            tags_with_access=CSR(
+                sorted(sources_for_tag.get(tag, ())) for tag in range(len(tag_index))
+            ),
+            accessible_tags=CSR(
+                sorted(dests_for_tag.get(tag, ())) for tag in range(len(tag_index))
+            ),
+            version=version,
+        )
+
+    def get_vm_index(self, vm_id: str) -> Optional[int]:
+        i = bisect_left(self.vm_ids, vm_id)
+        if i < len(self.vm_ids) and self.vm_ids[i] == vm_id:
+            return i
+        return None
+
+    def get_linked_vms(self, vm: int, linked_tags: CSR) -> BitMap:
+        vms = BitMap()
+        for tag in self.vm_tags[vm]:
+            for linked_tag in linked_tags[tag]:
+                vms |= self.tag_vms[linked_tag]
+        vms.discard(vm)
+        return vms
+
+    def get_attackers(self, vm: int) -> BitMap:
+        return self.get_linked_vms(vm, self.tags_with_access)
+
+    def get_targets(self, vm: int) -> BitMap:
+        return self.get_linked_vms(vm, self.accessible_tags)
+
+    def decode(self, vms: Iterable[int]) -> list[str]:
+        """
+        BitMap is iterated sorted, so IDs are sorted too.
+        """
+        return [self.vm_ids[vm] for vm in vms]
+
+    def get_vm_ids_with_access_to_vm(self, vm_id: str) -> list[str]:
+        vm = self.get_vm_index(vm_id)
+        if vm is None:
+            return []
+        return self.decode(self.get_attackers(vm))
+
+    def get_vm_ids_accessible_from_vm(self, vm_id: str) -> list[str]:
+        vm = self.get_vm_index(vm_id)
+        if vm is None:
+            return []
+        return self.decode(self.get_targets(vm))
+
+    def get_vm_distances_with_access_to_vm(
+        self, vm_id: str, max_depth: int
+    ) -> dict[str, int]:
+        """
+        BFS over tags: VMs of tags with access to the current targets' tags are
+        reached at the next hop, their tags become the next targets. Every tag
+        and every VM is visited once.
+        """
+        vm = self.get_vm_index(vm_id)
+        if vm is None:
+            return {}
+
+        visited_vms = BitMap([vm])
+        visited_target_tags = set(self.vm_tags[vm])
+        visited_source_tags = set()
+        target_tags = list(visited_target_tags)
+
+        distances = {}
+        for depth in range(1, max_depth + 1):
+            attackers = BitMap()
+            for tag in target_tags:
+                for tag_with_access in self.tags_with_access[tag]:
+                    if tag_with_access not in visited_source_tags:
+                        visited_source_tags.add(tag_with_access)
+                        attackers |= self.tag_vms[tag_with_access]
+            attackers -= visited_vms
+            if not attackers:
+                break
+            visited_vms |= attackers
+
+            target_tags = []
+            for attacker in attackers:
+                distances[self.vm_ids[attacker]] = depth
+                for tag in self.vm_tags[attacker]:
+                    if tag not in visited_target_tags:
+                        visited_target_tags.add(tag)
+                        target_tags.append(tag)
+        return distances
+
+    def count_vm_ids_with_access_to_vm(self, vm_id: str) -> int:
+        vm = self.get_vm_index(vm_id)
+        if vm is None:
+            return 0
+        source_tags = {
+            tag_with_access
+            for tag in self.vm_tags[vm]
+            for tag_with_access in self.tags_with_access[tag]
+        }
+        if len(source_tags) == 1:
+            vms = self.tag_vms[source_tags.pop()]
+            return len(vms) - (vm in vms)
+        return len(self.get_attackers(vm))
+
+    def has_vm_ids_with_access_to_vm(self, vm_id: str) -> bool:
+        vm = self.get_vm_index(vm_id)
+        if vm is None:
+            return False
+        for tag in self.vm_tags[vm]:
+            for tag_with_access in self.tags_with_access[tag]:
+                vms = self.tag_vms[tag_with_access]
+                if len(vms) > 1 or (vms and vm not in vms):
+                    return True
+        return False
+
+    def iter_vm_ids_with_access_to_vm(
+        self, vm_id: str, after: Optional[str] = None
+    ) -> Iterator[str]:
+        """
+        IDs are produced sorted, only the ones greater than `after`:
+        sorted VMs of every tag with access are merged lazily.
+        """
+        vm = self.get_vm_index(vm_id)
+        if vm is None:
+            return iter(())
+        start = -1 if after is None else bisect_right(self.vm_ids, after) - 1
+        rows = [
+            self.tag_vms[tag_with_access].iter_after(start)
+            for tag in self.vm_tags[vm]
+            for tag_with_access in self.tags_with_access[tag]
+        ]
+        return (self.vm_ids[attacker] for attacker in merge_sorted_vms(rows, vm))
+
+
+class AttackGraphLoader:
+    """
+    Keeps AttackGraph for the active snapshot. A new graph is loaded in background,
+    while it is loading callers get None and should use DB instead.
+    """
+
+    def __init__(self):
+        self.graph: Optional[AttackGraph] = None
+        self.loading: Optional[Task] = None
+
+    async def get_graph(self) -> Optional[AttackGraph]:
+        status = await StatusCollection.get_active_status()
+        if not status or not status.snapshot:
+            return None
+        version = (status.snapshot, status.revision)
+        if self.graph and self.graph.version == version:
+            return self.graph
+
+        if not self.loading or self.loading.done():
+            self.loading = create_task(self.load(version, status.base_snapshot))
+        return None
+
+    async def load(self, version: tuple, base_snapshot: Optional[str] = None):
+        try:
+            self.graph = await self.load_graph(version, base_snapshot)
+        except Exception:
+            logger.exception(f"Attack graph for {version} was not loaded")
+            return
+        logger.info(
+            f"Attack graph for {version} is loaded: "
+            f"{len(self.graph.vm_ids)} VMs, {len(self.graph.tags)} tags"
+        )
+
+    @log_step_async(logger, "load attack graph")
+    async def load_graph(
+        self, version: tuple, base_snapshot: Optional[str] = None
+    ) -> AttackGraph:
+        snapshot, _ = version
+        vms = [
+            (doc["_id"], doc["tags"])
+            async for doc in VirtualMachineCollection.for_snapshot(
+                snapshot, base_snapshot
+            ).iter_layered({"tags": True})
+        ]
+        rules = [
+            (doc["source_tag"], doc["dest_tag"])
+            async for doc in FirewallRuleCollection.for_snapshot(
+                snapshot, base_snapshot
+            ).iter_layered({"_id": False, "source_tag": True})
+        ]
+        # The build holds the GIL, in a thread it's only interleaved with requests
+        # of this worker, which are slower until the graph is loaded
+        return await get_running_loop().run_in_executor(
+            None, AttackGraph.build, vms, rules, version
+        )
+
+
+attack_graph_loader = AttackGraphLoader()
@@ -0,0 +1,99 @@
+import math
+from collections import defaultdict
+from typing import Optional
+
+from pydantic import BaseModel
+
+MIN_DURATION = 1e-6  # seconds, shorter durations are counted in the first bucket
+BUCKET_GROWTH = 1.05  # bucket bounds grow by 5%, so quantiles are within 2.5%
+
+
+def get_bucket(duration: float) -> int:
+    if duration <= MIN_DURATION:
+        return 0
+    return int(math.log(duration / MIN_DURATION, BUCKET_GROWTH))
+
+
+def get_bucket_value(bucket: int) -> float:
+    return MIN_DURATION * BUCKET_GROWTH ** (bucket + 0.5)
+
+
+class LatencyInfo(BaseModel):
+    count: int
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+
+class LatencyHistogram:
+    """
+    Durations counted in logarithmic buckets. Histograms are merged by adding
+    counts of the same buckets, so they can be saved with $inc from every worker.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets: dict[int, int] = defaultdict(int)
+
+    def add(self, duration: float):
+        self.count += 1
+        self.sum += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+        self.buckets[get_bucket(duration)] += 1
+
+    def merge(self, other: "LatencyHistogram"):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(get_bucket_value(bucket), self.max)
+        return self.max
+
+    def info(self) -> LatencyInfo:
+        return LatencyInfo(
+            count=self.count,
+            p50=self.quantile(0.5) or 0,
+            p95=self.quantile(0.95) or 0,
+            p99=self.quantile(0.99) or 0,
+            max=self.max,
+        )
+
+    def to_update(self) -> dict:
+        return {
+            "$inc": {
+                "count": self.count,
+                "sum": self.sum,
+                **{
+                    f"buckets.{bucket}": count for bucket, count in self.buckets.items()
+                },
+            },
+            "$min": {"min": self.min},
+            "$max": {"max": self.max},
+        }
+
+    @classmethod
+    def from_db(cls, doc: dict) -> "LatencyHistogram":
+        histogram = cls()
+        histogram.count = doc.get("count", 0)
+        histogram.sum = doc.get("sum", 0.0)
+        histogram.min = doc.get("min", math.inf)
+        histogram.max = doc.get("max", 0.0)
+        for bucket, count in doc.get("buckets", {}).items():
+            histogram.buckets[int(bucket)] = count
+        return histogram
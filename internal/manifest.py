@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+from collections import defaultdict
+from typing import Iterable, NamedTuple, Optional
+
+from pymongo import ReplaceOne
+
+from .bulk_writer import BulkWriter
+from .config import BULK_WRITE_BATCH_SIZE, CLOUD_ENV_MANIFEST_BUCKETS
+from .crud import ManifestCollection, chunks
+from .delta import RulePair
+from .logger import log_step_async
+from .models import VMInfo
+
+logger = logging.getLogger(__name__)
+
+
+def get_hash(value: str) -> int:
+    """
+    Stable between processes, unlike hash() of str.
+    """
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class Manifest:
+    """
+    Hashes of VMs and firewall rules grouped into buckets by VM ID / rule tags.
+    Buckets with the same digest have the same items, so a delta reload reads
+    back only the buckets which digests were changed.
+    Bucket IDs include the count of buckets: after it's changed in config,
+    all buckets are different and compared item by item.
+    """
+
+    def __init__(self, buckets_count: int = CLOUD_ENV_MANIFEST_BUCKETS):
+        self.buckets_count = buckets_count
+        self.vm_hashes: dict[str, dict[str, int]] = defaultdict(dict)
+        self.rules: dict[str, set[RulePair]] = defaultdict(set)
+
+    def get_bucket_id(self, kind: str, key: str) -> str:
+        return f"{kind}-{self.buckets_count}-{get_hash(key) % self.buckets_count}"
+
+    def add_vm(self, vm: VMInfo):
+        self.vm_hashes[self.get_bucket_id("vms", vm.id)][vm.id] = get_hash(vm.json())
+
+    def add_rule(self, rule: RulePair):
+        self.rules[self.get_bucket_id("rules", "\n".join(rule))].add(rule)
+
+    def get_items(self, bucket_id: str) -> list:
+        if bucket_id in self.vm_hashes:
+            return sorted([vm_id, h] for vm_id, h in self.vm_hashes[bucket_id].items())
+        return sorted(list(rule) for rule in self.rules.get(bucket_id, ()))
+
+    def get_document(self, bucket_id: str) -> dict:
+        items = self.get_items(bucket_id)
+        return {"_id": bucket_id, "digest": get_hash(json.dumps(items)), "items": items}
+
+    def get_bucket_ids(self) -> set[str]:
+        return self.vm_hashes.keys() | self.rules.keys()
+
+
+class ManifestChanges(NamedTuple):
+    bucket_ids: set[str]
+    old_vm_ids: list[str]  # changed and removed VMs
+    new_vm_ids: list[str]  # changed and added VMs
+    old_rules: set[RulePair]  # rules of the changed buckets
+    new_rules: set[RulePair]
+
+
+@log_step_async(logger, "find changed manifest buckets")
+async def get_manifest_changes(
+    snapshot: str, base_snapshot: Optional[str], manifest: Manifest
+) -> ManifestChanges:
+    manifest_collection = ManifestCollection.for_snapshot(snapshot, base_snapshot)
+    old_digests = await manifest_collection.get_digests()
+    new_digests = {
+        bucket_id: manifest.get_document(bucket_id)["digest"]
+        for bucket_id in manifest.get_bucket_ids()
+    }
+    bucket_ids = {
+        bucket_id
+        for bucket_id in old_digests.keys() | new_digests.keys()
+        if old_digests.get(bucket_id) != new_digests.get(bucket_id)
+    }
+    old_vm_hashes: dict[str, int] = {}
+    old_rules: set[RulePair] = set()
+    for bucket_id, items in (await manifest_collection.get_items(bucket_ids)).items():
+        if bucket_id.startswith("vms-"):
+            old_vm_hashes.update(items)
+        else:
+            old_rules.update(tuple(rule) for rule in items)
+
+    new_vm_hashes: dict[str, int] = {}
+    new_rules: set[RulePair] = set()
+    for bucket_id in bucket_ids:
+        new_vm_hashes.update(manifest.vm_hashes.get(bucket_id, {}))
+        new_rules.update(manifest.rules.get(bucket_id, ()))
+
+    changed_vm_ids = {
+        vm_id
+        for vm_id in old_vm_hashes.keys() | new_vm_hashes.keys()
+        if old_vm_hashes.get(vm_id) != new_vm_hashes.get(vm_id)
+    }
+    return ManifestChanges(
+        bucket_ids=bucket_ids,
+        old_vm_ids=sorted(changed_vm_ids & old_vm_hashes.keys()),
+        new_vm_ids=sorted(changed_vm_ids & new_vm_hashes.keys()),
+        old_rules=old_rules,
+        new_rules=new_rules,
+    )
+
+
+@log_step_async(logger, "insert manifest")
+async def add_manifest(snapshot: str, manifest: Manifest):
+    async with BulkWriter(ManifestCollection.for_snapshot(snapshot)) as writer:
+        for bucket_id in manifest.get_bucket_ids():
+            await writer.add(manifest.get_document(bucket_id))
+
+
+@log_step_async(logger, "update manifest")
+async def update_manifest(snapshot: str, manifest: Manifest, bucket_ids: Iterable[str]):
+    """
+    Writes only `bucket_ids` to the `snapshot` layer.
+    """
+    new_bucket_ids = manifest.get_bucket_ids()
+    requests = [
+        ReplaceOne(
+            {"_id": bucket_id},
+            manifest.get_document(bucket_id)
+            if bucket_id in new_bucket_ids
+            else {"_id": bucket_id, "removed": True},
+            upsert=True,
+        )
+        for bucket_id in bucket_ids
+    ]
+    manifest_collection = ManifestCollection.for_snapshot(snapshot)
+    for requests_chunk in chunks(requests, BULK_WRITE_BATCH_SIZE):
+        await manifest_collection.bulk_write(requests_chunk, ordered=False)
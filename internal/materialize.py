@@ -0,0 +1,140 @@
+import logging
+from itertools import chain
+from typing import Iterable
+from urllib.parse import parse_qs
+
+import bson
+from pymongo import ReplaceOne
+
+from .bulk_writer import BulkWriter
+from .config import MATERIALIZE_MAX_BYTES, MATERIALIZE_MAX_VMS
+from .delta import bulk_write
+from .logger import log_step_async
+from .models import MaterializedAttackInfo
+from .tag_sets import get_attacker_vm_ids_for_tag_set, get_tag_maps_for_tags
+
+from .crud import (  # isort: skip
+    MONGO_ARRAY_ELEMS_COUNT,
+    MaterializedAttackCollection,
+    ResponseInfoCollection,
+    VirtualMachineCollection,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def is_materialization_enabled() -> bool:
+    return MATERIALIZE_MAX_VMS > 0
+
+
+@log_step_async(logger, "get the most requested VMs")
+async def get_hot_vm_ids() -> list[str]:
+    """
+    By ResponseInfo which is not expired yet (RESPONSE_INFO_TTL_SECONDS).
+    """
+    hot_vm_ids = {}
+    for params in await ResponseInfoCollection.get_top_params(
+        "/attack", MATERIALIZE_MAX_VMS
+    ):
+        for vm_id in parse_qs(params).get("vm_id", [])[:1]:
+            hot_vm_ids[vm_id] = True
+    return list(hot_vm_ids)
+
+
+@log_step_async(logger, "insert attackers for the most requested VMs")
+async def add_materialized_attacks(
+    snapshot: str,
+    hot_vm_tags: Iterable[tuple[str, list[str]]],
+    vm_ids_for_tag: dict[str, list[str]],
+    tags_with_access_for_tag: dict[str, set[str]],
+):
+    """
+    `hot_vm_tags` are ordered by popularity. VMs are saved while their attackers
+    fit into MATERIALIZE_MAX_BYTES, others are calculated on request.
+    """
+    budget = MATERIALIZE_MAX_BYTES
+    materialized_count = 0
+    async with BulkWriter(
+        MaterializedAttackCollection.for_snapshot(snapshot)
+    ) as writer:
+        for vm_id, tags in hot_vm_tags:
+            attacker_vm_ids = [
+                attacker
+                for attacker in get_attacker_vm_ids_for_tag_set(
+                    tags, vm_ids_for_tag, tags_with_access_for_tag
+                )
+                if attacker != vm_id
+            ]
+            if len(attacker_vm_ids) > MONGO_ARRAY_ELEMS_COUNT:
+                continue
+
+            doc = MaterializedAttackInfo(
+                id=vm_id, attacker_vm_ids=attacker_vm_ids
+            ).dict(by_alias=True)
+            size = len(bson.encode(doc))
+            if size > budget:
+                continue
+            budget -= size
+            materialized_count += 1
+            await writer.add(doc)
+    logger.info(
+        f"Attackers for {materialized_count} VMs are saved, "
+        f"{MATERIALIZE_MAX_BYTES - budget} bytes"
+    )
+
+
+@log_step_async(logger, "update attackers of the materialized VMs")
+async def update_materialized_attacks(
+    snapshot: str,
+    base_snapshot: str,
+    changed_vm_ids: Iterable[str],
+    affected_tags: set[str],
+):
+    """
+    Materialized VMs which are changed or have any of `affected_tags` are written
+    to the `snapshot` layer, removed ones and ones with too many attackers are
+    shadowed as removed. The set of hot VMs is chosen again by a full reload.
+    """
+    materialized_collection = MaterializedAttackCollection.for_snapshot(
+        snapshot, base_snapshot
+    )
+    materialized_vm_ids = await materialized_collection.get_vm_ids()
+    vms = await VirtualMachineCollection.for_snapshot(
+        snapshot, base_snapshot
+    ).get_by_ids(materialized_vm_ids)
+    changed_vm_ids = set(changed_vm_ids)
+    updated_vm_ids = [
+        vm_id
+        for vm_id in materialized_vm_ids
+        if vm_id in changed_vm_ids
+        or vm_id not in vms
+        or not affected_tags.isdisjoint(vms[vm_id].tags)
+    ]
+    vm_ids_for_tag, tags_with_access_for_tag = await get_tag_maps_for_tags(
+        snapshot,
+        base_snapshot,
+        set(
+            chain.from_iterable(
+                vms[vm_id].tags for vm_id in updated_vm_ids if vm_id in vms
+            )
+        ),
+    )
+
+    requests = []
+    for vm_id in updated_vm_ids:
+        doc = {"_id": vm_id, "removed": True}
+        if vm_id in vms:
+            attacker_vm_ids = [
+                attacker
+                for attacker in get_attacker_vm_ids_for_tag_set(
+                    vms[vm_id].tags, vm_ids_for_tag, tags_with_access_for_tag
+                )
+                if attacker != vm_id
+            ]
+            if len(attacker_vm_ids) <= MONGO_ARRAY_ELEMS_COUNT:
+                doc = MaterializedAttackInfo(
+                    id=vm_id, attacker_vm_ids=attacker_vm_ids
+                ).dict(by_alias=True)
+        requests.append(ReplaceOne({"_id": vm_id}, doc, upsert=True))
+    await bulk_write(MaterializedAttackCollection.for_snapshot(snapshot), requests)
+    logger.info(f"Attackers for {len(requests)} materialized VMs are updated")
@@ -1,5 +1,6 @@
 import logging
-from typing import Type, TypeVar
+from datetime import datetime
+from typing import Optional, Type, TypeVar
 
 from pydantic import BaseModel, Extra, Field, validator
 
@@ -10,6 +11,9 @@ logger = logging.getLogger(__name__)
 
 Model = TypeVar("Model", bound="BaseModel")
 
+NOT_UNIQUE_VM_IDS_MSG = "VM IDs should be unique for one environment"
+NOT_UNIQUE_RULE_IDS_MSG = "Firewall Rule IDs should be unique for one environment"
+
 
 class StrictBaseModel(BaseModel):
     class Config:
@@ -45,11 +49,41 @@ class TagInfo(BaseModel):
     tag: str
     tagged_vm_ids: list[str]
     tags_with_access: list[str]
+    accessible_tags: list[str] = []
+
+    class Config:
+        allow_population_by_field_name = True
+
+
+class TagSetInfo(BaseModel):
+    signature: str
+    tags: list[str] = []
+    attacker_vm_ids: list[str]
+
+
+class MaterializedAttackInfo(BaseModel):
+    id: str = Field(alias="_id")
+    attacker_vm_ids: list[str]
+
+    class Config:
+        allow_population_by_field_name = True
+
+
+class ExposureInfo(BaseModel):
+    id: str = Field(alias="_id")
+    attackers_count: int
 
     class Config:
         allow_population_by_field_name = True
 
 
+class ExposureTagSetInfo(BaseModel):
+    signature: str
+    tags: list[str]
+    attackers_count: int
+    vm_ids: list[str]
+
+
 class CloudEnvironment(StrictBaseModel):
     machines: list[VMInfo] = Field(alias="vms")
     rules: list[FirewallRule] = Field(alias="fw_rules")
@@ -58,18 +92,14 @@ class CloudEnvironment(StrictBaseModel):
     @log_step(logger, "validate machine IDs")
     def unique_machine_ids(cls, machines):
         vm_ids = [vm.id for vm in machines]
-        assert len(vm_ids) == len(
-            set(vm_ids)
-        ), "VM IDs should be unique for one environment"
+        assert len(vm_ids) == len(set(vm_ids)), NOT_UNIQUE_VM_IDS_MSG
         return machines
 
     @validator("rules")
     @log_step(logger, "validate firewall rule IDs")
     def unique_rule_ids(cls, rules):
         fw_rule_ids = [fw_rule.id for fw_rule in rules]
-        assert len(fw_rule_ids) == len(
-            set(fw_rule_ids)
-        ), "Firewall Rule IDs should be unique for one environment"
+        assert len(fw_rule_ids) == len(set(fw_rule_ids)), NOT_UNIQUE_RULE_IDS_MSG
         return rules
 
     @classmethod
@@ -83,11 +113,21 @@ class StatusModel(BaseModel):
     error_msg: str = ""
 
 
+class ServiceStatusModel(StatusModel):
+    snapshot: Optional[str] = None  # active generation of cloud environment data
+    revision: int = 0  # number of delta reloads since the last full reload
+    base_snapshot: Optional[str] = None  # full generation under a delta layer
+    layout: int = 0  # format of the generation collections
+
+
+class ServiceCountersModel(BaseModel):
+    vm_count: int = 0  # VMs of the active snapshot
+    request_count: int = 0
+    duration_sum: float = 0
+
+
 class ResponseInfoModel(BaseModel):
-    id: str = Field(alias="_id")
+    created_at: datetime  # UTC, documents expire by TTL index on this field
     duration: float
     path: str
     params: str = ""
-
-    class Config:
-        allow_population_by_field_name = True
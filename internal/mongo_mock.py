@@ -0,0 +1,172 @@
+"""
+In-memory collections for tests of queries, only operators used by crud are supported.
+"""
+from collections import defaultdict
+from copy import deepcopy
+from typing import Optional
+from unittest import mock
+
+from pymongo import InsertOne, ReplaceOne
+
+from .config import MONGO_DB
+
+
+def matches_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+        values = value if isinstance(value, list) else [value]
+        for operator, operand in condition.items():
+            if operator == "$in":
+                if not any(item in operand for item in values):
+                    return False
+            elif operator == "$ne":
+                if value == operand or operand in values:
+                    return False
+            elif operator == "$gt":
+                if value is None or not value > operand:
+                    return False
+            elif operator == "$exists":
+                if (value is not None) != operand:
+                    return False
+            elif operator == "$elemMatch":
+                if not isinstance(value, list) or not any(
+                    matches_condition(item, operand) for item in value
+                ):
+                    return False
+            else:
+                raise NotImplementedError(operator)
+        return True
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+def matches(doc: dict, locator: Optional[dict]) -> bool:
+    return all(
+        matches_condition(doc.get(field), condition)
+        for field, condition in (locator or {}).items()
+    )
+
+
+def project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return deepcopy(doc)
+    if not any(include for field, include in projection.items() if field != "_id"):
+        excluded = {field for field, include in projection.items() if not include}
+        return {
+            field: deepcopy(value)
+            for field, value in doc.items()
+            if field not in excluded
+        }
+    included = {field for field, include in projection.items() if include}
+    if projection.get("_id", True):
+        included.add("_id")
+    return {field: deepcopy(value) for field, value in doc.items() if field in included}
+
+
+class CursorMock:
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+
+    def sort(self, keys, direction=None):
+        if isinstance(keys, str):
+            keys = [(keys, direction or 1)]
+        for field, direction in reversed(keys):
+            self.docs.sort(key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def limit(self, count: int):
+        self.docs = self.docs[:count]
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+    async def to_list(self, length=None):
+        docs, self.docs = self.docs, []
+        return docs
+
+
+class CollectionMock:
+    def __init__(self, docs: Optional[list[dict]] = None):
+        self.docs: list[dict] = []
+        for doc in docs or []:
+            self.add(doc)
+
+    def add(self, doc: dict):
+        doc = deepcopy(doc)
+        doc.setdefault("_id", object())
+        self.docs.append(doc)
+
+    def find(self, locator=None, projection=None) -> CursorMock:
+        return CursorMock(
+            [project(doc, projection) for doc in self.docs if matches(doc, locator)]
+        )
+
+    async def find_one(self, locator=None, projection=None) -> Optional[dict]:
+        docs = self.find(locator, projection).docs
+        return docs[0] if docs else None
+
+    async def distinct(self, field: str, locator=None) -> list:
+        values = []
+        for doc in self.docs:
+            if matches(doc, locator) and doc.get(field) not in values:
+                values.append(doc.get(field))
+        return values
+
+    async def count_documents(self, locator) -> int:
+        return len(self.find(locator).docs)
+
+    async def insert_many(self, docs, **kwargs):
+        for doc in docs:
+            self.add(doc)
+
+    async def delete_many(self, locator):
+        self.docs = [doc for doc in self.docs if not matches(doc, locator)]
+
+    async def bulk_write(self, requests, **kwargs):
+        for request in requests:
+            if isinstance(request, InsertOne):
+                self.add(request._doc)
+            elif isinstance(request, ReplaceOne):
+                await self.delete_many(request._filter)
+                self.add(request._doc)
+            else:
+                raise NotImplementedError(request)
+
+    async def create_index(self, keys, **kwargs):
+        pass
+
+
+class DatabaseMock(defaultdict):
+    """
+    Collections are created on first access like in Mongo.
+    """
+
+    def __init__(self):
+        super().__init__(CollectionMock)
+
+    def get_docs(self, name: str, projection: Optional[dict] = None) -> list[dict]:
+        return [project(doc, projection) for doc in self[name].docs]
+
+
+def get_collection_mock():
+    """
+    Collection class bound to any snapshot, for tests which check only calls.
+    """
+    collection = mock.MagicMock(
+        create_indexes=mock.AsyncMock(),
+        insert_many=mock.AsyncMock(),
+    )
+    collection.for_snapshot.return_value = collection
+    return collection
+
+
+def patch_database(db: DatabaseMock):
+    return mock.patch(
+        "internal.crud.get_database", mock.AsyncMock(return_value={MONGO_DB: db})
+    )
@@ -2,129 +2,431 @@ import logging
 from asyncio import gather, get_event_loop
 from collections import defaultdict
 from datetime import datetime
+from itertools import chain
+from typing import Iterable, Optional
 
 from pydantic import ValidationError
 
+from .bulk_writer import BulkWriter
+from .config import CLOUD_ENV_BATCH_SIZE, CLOUD_ENV_DELTA, CLOUD_ENV_STREAMING
 from .db import connect_to_mongo
-from .extractor import get_cloud_environment
+from .delta import apply_delta, calculate_delta
+from .exposure import add_exposure, is_exposure_enabled, update_exposure
+from .extractor import get_cloud_environment, iter_cloud_environment_batches
 from .logger import configure_logger, get_logger_filename, log_step_async
-from .models import FirewallRule, StatusModel, TagInfo
+from .models import FirewallRule, ServiceStatusModel, TagInfo, VMInfo
 
 from .crud import (  # isort: skip
+    MONGO_ARRAY_ELEMS_COUNT,
+    ROLLUP_COLLECTIONS,
+    SNAPSHOT_FORMAT,
+    chunks,
+    ExposureCollection,
     FirewallRuleCollection,
+    ManifestCollection,
+    MaterializedAttackCollection,
     StatusCollection,
     TagInfoCollection,
+    TagSetCollection,
     VirtualMachineCollection,
     ResponseInfoCollection,
+    ServiceCountersCollection,
 )
 
+from .manifest import (  # isort: skip
+    Manifest,
+    add_manifest,
+    get_manifest_changes,
+    update_manifest,
+)
 
-logger = logging.getLogger(__name__)
+from .tag_sets import (  # isort: skip
+    TagSet,
+    add_tag_sets,
+    get_tag_set,
+    get_tag_set_signature,
+    is_tag_set_resolver_enabled,
+    update_tag_sets,
+)
 
-MONGO_ARRAY_ELEMS_COUNT = (
-    100000  # For preventing having huge BSON. It leads to Mongo errors
+from .materialize import (  # isort: skip
+    add_materialized_attacks,
+    get_hot_vm_ids,
+    is_materialization_enabled,
+    update_materialized_attacks,
 )
 
 
-def chunks(items, size):
-    for i in range(0, len(items), size):
-        yield items[i : i + size]
+logger = logging.getLogger(__name__)
 
 
-@log_step_async(logger, "calculate VM IDs for tag")
-async def calculate_vm_ids_for_tags():
-    vm_ids_for_tag = defaultdict(list)
-    async for vm in VirtualMachineCollection.get_all_iter():
-        vm_id = vm.id
-        for tag in vm.tags:
-            vm_ids_for_tag[tag].append(vm_id)
-    return vm_ids_for_tag
+async def insert_data_about_one_tag_vms(writer: BulkWriter, tag, vm_ids):
+    for vm_ids_chunk in chunks(vm_ids, MONGO_ARRAY_ELEMS_COUNT):
+        await writer.add(
+            TagInfo(tag=tag, tagged_vm_ids=vm_ids_chunk, tags_with_access=[]).dict()
+        )
 
 
-@log_step_async(logger, "insert VMs for one tag")
-async def insert_data_about_one_tag_vms(tag, vm_ids):
-    collection = await TagInfoCollection.get_collection()
+@log_step_async(logger, "insert VMs for all tags")
+async def add_vms_for_tags(writer: BulkWriter, vm_ids_for_tag: dict[str, list[str]]):
+    for tag, vm_ids in vm_ids_for_tag.items():
+        await insert_data_about_one_tag_vms(writer, tag, vm_ids)
+
+
+async def insert_data_about_one_tag_tags_with_access(
+    writer: BulkWriter, tag, tags_with_access
+):
+    for tags_with_access_chunk in chunks(
+        list(tags_with_access), MONGO_ARRAY_ELEMS_COUNT
+    ):
+        await writer.add(
+            TagInfo(
+                tag=tag, tagged_vm_ids=[], tags_with_access=tags_with_access_chunk
+            ).dict()
+        )
+
+
+@log_step_async(logger, "insert Tags With Access for all tags")
+async def add_tags_with_access_for_tags(
+    writer: BulkWriter, tags_with_access_for_tag: dict[str, set[str]]
+):
+    for tag, tags_with_access in tags_with_access_for_tag.items():
+        await insert_data_about_one_tag_tags_with_access(writer, tag, tags_with_access)
+
+
+async def insert_data_about_one_tag_accessible_tags(
+    writer: BulkWriter, tag, accessible_tags
+):
+    for accessible_tags_chunk in chunks(list(accessible_tags), MONGO_ARRAY_ELEMS_COUNT):
+        await writer.add(
+            TagInfo(
+                tag=tag,
+                tagged_vm_ids=[],
+                tags_with_access=[],
+                accessible_tags=accessible_tags_chunk,
+            ).dict()
+        )
+
+
+@log_step_async(logger, "insert Accessible Tags for all tags")
+async def add_accessible_tags_for_tags(
+    writer: BulkWriter, accessible_tags_for_tag: dict[str, set[str]]
+):
+    for tag, accessible_tags in accessible_tags_for_tag.items():
+        await insert_data_about_one_tag_accessible_tags(writer, tag, accessible_tags)
+
+
+@log_step_async(logger, "insert TagInfo for all tags")
+async def add_tag_infos(
+    snapshot: str,
+    vm_ids_for_tag: dict[str, list[str]],
+    tags_with_access_for_tag: dict[str, set[str]],
+    accessible_tags_for_tag: dict[str, set[str]],
+):
+    tag_info_collection = TagInfoCollection.for_snapshot(snapshot)
+    await tag_info_collection.create_indexes()
+    async with BulkWriter(tag_info_collection) as writer:
+        await add_vms_for_tags(writer, vm_ids_for_tag)
+        await add_tags_with_access_for_tags(writer, tags_with_access_for_tag)
+        await add_accessible_tags_for_tags(writer, accessible_tags_for_tag)
+
+
+def is_streaming_enabled() -> bool:
+    try:
+        return bool(int(CLOUD_ENV_STREAMING))
+    except ValueError:
+        return True
+
+
+def is_delta_enabled() -> bool:
+    try:
+        return bool(int(CLOUD_ENV_DELTA))
+    except ValueError:
+        return True
+
+
+async def get_cloud_environment_batches():
+    if is_streaming_enabled():
+        for batch in iter_cloud_environment_batches():
+            yield batch
+        return
+
+    cloud_environment = await get_cloud_environment()
+    for machines in chunks(cloud_environment.machines, CLOUD_ENV_BATCH_SIZE):
+        yield "machines", machines
+    for rules in chunks(cloud_environment.rules, CLOUD_ENV_BATCH_SIZE):
+        yield "rules", rules
+
+
+@log_step_async(logger, "insert firewall rules")
+async def add_firewall_rules(
+    snapshot: str, tags_with_access_for_tag: dict[str, set[str]]
+):
+    async with BulkWriter(FirewallRuleCollection.for_snapshot(snapshot)) as writer:
+        rules_count = 0
+        for dest_tag, tags_with_access in tags_with_access_for_tag.items():
+            for source_tag in tags_with_access:
+                await writer.add(
+                    FirewallRule(
+                        id=f"fw-{rules_count}", source_tag=source_tag, dest_tag=dest_tag
+                    ).to_db()
+                )
+                rules_count += 1
+
+
+@log_step_async(logger, "save cloud environment")
+async def save_cloud_environment(snapshot: str, hot_vm_ids: list[str]) -> int:
+    """
+    Saves VMs to the `snapshot` generation while the cloud environment is being
+    parsed and collects tag -> VM IDs / tag -> tags with access / tag -> accessible
+    tags maps in the same pass, so TagInfo is built without reading VMs and rules
+    back from DB. Returns count of saved VMs.
+    """
+    vm_ids_for_tag: dict[str, list[str]] = defaultdict(list)
+    tags_with_access_for_tag: dict[str, set[str]] = defaultdict(set)
+    accessible_tags_for_tag: dict[str, set[str]] = defaultdict(set)
+    vm_ids_for_tag_set: dict[TagSet, list[str]] = defaultdict(list)
+    hot_vm_tags: dict[str, list[str]] = dict.fromkeys(hot_vm_ids)
+    manifest = Manifest()
+    vm_count = 0
+
+    async with BulkWriter(VirtualMachineCollection.for_snapshot(snapshot)) as writer:
+        async for field_name, batch in get_cloud_environment_batches():
+            if field_name == "machines":
+                vm_count += len(batch)
+                for vm in batch:
+                    for tag in vm.tags:
+                        vm_ids_for_tag[tag].append(vm.id)
+                    vm_ids_for_tag_set[get_tag_set(vm.tags)].append(vm.id)
+                    if vm.id in hot_vm_tags:
+                        hot_vm_tags[vm.id] = vm.tags
+                    manifest.add_vm(vm)
+                    await writer.add(vm.to_db())
+            else:
+                for rule in batch:
+                    tags_with_access_for_tag[rule.dest_tag].add(rule.source_tag)
+                    accessible_tags_for_tag[rule.source_tag].add(rule.dest_tag)
+                    manifest.add_rule((rule.source_tag, rule.dest_tag))
 
     await gather(
-        *[
-            collection.insert_one(
-                TagInfo(tag=tag, tagged_vm_ids=vm_ids_chunk, tags_with_access=[]).dict()
-            )
-            for vm_ids_chunk in chunks(vm_ids, MONGO_ARRAY_ELEMS_COUNT)
-        ]
+        add_firewall_rules(snapshot, tags_with_access_for_tag),
+        add_tag_infos(
+            snapshot, vm_ids_for_tag, tags_with_access_for_tag, accessible_tags_for_tag
+        ),
+        add_manifest(snapshot, manifest),
+    )
+    if is_exposure_enabled():
+        await add_exposure(snapshot, vm_ids_for_tag_set, tags_with_access_for_tag)
+    if is_tag_set_resolver_enabled():
+        await add_tag_sets(
+            snapshot,
+            {get_tag_set_signature(tags): list(tags) for tags in vm_ids_for_tag_set},
+            vm_ids_for_tag,
+            tags_with_access_for_tag,
+        )
+    if hot_vm_ids:
+        await add_materialized_attacks(
+            snapshot,
+            [(vm_id, tags) for vm_id, tags in hot_vm_tags.items() if tags is not None],
+            vm_ids_for_tag,
+            tags_with_access_for_tag,
+        )
+    return vm_count
+
+
+async def get_changed_vms(vm_ids: Iterable[str]) -> dict[str, VMInfo]:
+    """
+    VMs are read again from the cloud environment, only `vm_ids` are kept.
+    """
+    vm_ids = set(vm_ids)
+    vms = {}
+    if vm_ids:
+        async for field_name, batch in get_cloud_environment_batches():
+            if field_name == "machines":
+                vms.update((vm.id, vm) for vm in batch if vm.id in vm_ids)
+    if len(vms) != len(vm_ids):
+        raise ValueError("Cloud Environment was changed while it was read")
+    return vms
+
+
+@log_step_async(logger, "save cloud environment delta")
+async def save_cloud_environment_delta(
+    active_snapshot: str,
+    base_snapshot: Optional[str],
+    snapshot: str,
+    revision: int,
+) -> Optional[int]:
+    """
+    Compares cloud environment with the manifest of `active_snapshot`, only hashes
+    are kept while it's parsed and only changed VMs are read again. Changed
+    documents are written to the `snapshot` layer over the base of the active
+    generation, the unchanged ones are not copied.
+    Returns count of VMs, None if nothing was changed and no generation was made.
+    """
+    manifest = Manifest()
+    async for field_name, batch in get_cloud_environment_batches():
+        if field_name == "machines":
+            for vm in batch:
+                manifest.add_vm(vm)
+        else:
+            for rule in batch:
+                manifest.add_rule((rule.source_tag, rule.dest_tag))
+
+    changes = await get_manifest_changes(active_snapshot, base_snapshot, manifest)
+    old_vms = await VirtualMachineCollection.for_snapshot(
+        active_snapshot, base_snapshot
+    ).get_by_ids(changes.old_vm_ids)
+    delta = calculate_delta(
+        old_vms,
+        await get_changed_vms(changes.new_vm_ids),
+        changes.old_rules,
+        changes.new_rules,
+    )
+    logger.info(f"Cloud environment delta for snapshot {active_snapshot}: {delta}")
+    if not delta:
+        return None
+
+    # the layer of the active generation has changes of the previous delta reloads
+    await add_layer(active_snapshot if base_snapshot else None, snapshot)
+    base_snapshot = base_snapshot or active_snapshot
+    affected_tags, _ = await gather(
+        apply_delta(snapshot, base_snapshot, delta, rule_id_prefix=f"fw-{revision}"),
+        update_manifest(snapshot, manifest, changes.bucket_ids),
+    )
+    if is_exposure_enabled():
+        await update_exposure(snapshot, base_snapshot, delta, old_vms, affected_tags)
+    if is_tag_set_resolver_enabled():
+        await update_tag_sets(
+            snapshot, base_snapshot, delta.upserted_vms, affected_tags
+        )
+    if is_materialization_enabled():
+        await update_materialized_attacks(
+            snapshot,
+            base_snapshot,
+            chain(delta.removed_vm_ids, (vm.id for vm in delta.upserted_vms)),
+            affected_tags,
+        )
+    return sum(len(vm_hashes) for vm_hashes in manifest.vm_hashes.values())
+
+
+# generations saved by older versions can't be a base of a delta layer
+SNAPSHOT_LAYOUT = 1
+
+
+def new_snapshot_version() -> str:
+    return datetime.utcnow().strftime(SNAPSHOT_FORMAT)
+
+
+def get_snapshot_collections() -> tuple:
+    return (
+        VirtualMachineCollection,
+        FirewallRuleCollection,
+        TagInfoCollection,
+        ManifestCollection,
+        TagSetCollection,
+        MaterializedAttackCollection,
+        ExposureCollection,
     )
-    return
 
 
-@log_step_async(logger, "insert VMs for all tags")
-async def add_vms_for_tags():
-    vm_ids_for_tag = await calculate_vm_ids_for_tags()
+@log_step_async(logger, "add snapshot layer")
+async def add_layer(layer_snapshot: Optional[str], snapshot: str):
+    """
+    The new layer starts with a server-side copy of `layer_snapshot`,
+    it has only documents changed since the last full reload.
+    """
+    collections = get_snapshot_collections()
+    if layer_snapshot:
+        await gather(
+            *(
+                collection.copy_snapshot(layer_snapshot, snapshot)
+                for collection in collections
+            )
+        )
     await gather(
-        *[
-            insert_data_about_one_tag_vms(tag, vm_ids)
-            for tag, vm_ids in vm_ids_for_tag.items()
-        ]
+        *(
+            collection.for_snapshot(snapshot).create_indexes()
+            for collection in collections
+        )
     )
-    del vm_ids_for_tag
-    return
 
 
-@log_step_async(logger, "calculate Tags With Access for tag")
-async def calculate_tags_with_access_for_tags():
-    tags_with_access_for_tag = defaultdict(set)
-    async for rule in FirewallRuleCollection.get_all_iter():
-        tags_with_access_for_tag[rule.dest_tag].add(rule.source_tag)
-    return tags_with_access_for_tag
+def get_kept_snapshots(
+    snapshots: list[Optional[str]], base_snapshots: list[Optional[str]]
+) -> list[Optional[str]]:
+    """
+    Bases are kept with their layers. None is the unversioned legacy generation,
+    it's never a base.
+    """
+    return snapshots + [
+        base_snapshot
+        for base_snapshot in dict.fromkeys(base_snapshots)
+        if base_snapshot and base_snapshot not in snapshots
+    ]
 
 
-@log_step_async(logger, "insert Tags With Access for one tag")
-async def insert_data_about_one_tag_tags_with_access(tag, tags_with_access):
-    collection = await TagInfoCollection.get_collection()
+async def drop_snapshots(keep: list[Optional[str]]):
     await gather(
-        *[
-            collection.insert_one(
-                TagInfo(
-                    tag=tag, tagged_vm_ids=[], tags_with_access=tags_with_access_chunk
-                ).dict()
-            )
-            for tags_with_access_chunk in chunks(
-                list(tags_with_access), MONGO_ARRAY_ELEMS_COUNT
-            )
-        ]
+        *(collection.drop_snapshots(keep) for collection in get_snapshot_collections())
     )
-    return
 
 
-@log_step_async(logger, "insert Tags With Access for all tags")
-async def add_tags_with_access_for_tags():
-    tags_with_access_for_tag = await calculate_tags_with_access_for_tags()
+async def create_statistic_indexes():
+    """
+    Statistic is not cleared on startup, old documents expire by TTL.
+    """
     await gather(
-        *[
-            insert_data_about_one_tag_tags_with_access(tag, tags_with_access)
-            for tag, tags_with_access in tags_with_access_for_tag.items()
-        ]
+        ResponseInfoCollection.create_indexes(),
+        ResponseInfoCollection.delete_legacy(),
+        *(collection.create_indexes() for collection in ROLLUP_COLLECTIONS),
     )
-    del tags_with_access_for_tag
-    return
 
 
 @log_step_async(logger, "preparing server")
 async def prepare_server():
+    """
+    Loads cloud environment into a new generation of collections. The previous
+    generation is used by readers until the new one is activated in ServiceStatus.
+    """
     await connect_to_mongo()
 
-    await StatusCollection.rewrite(
-        StatusModel(
-            ok=False,
-            error_msg=(
-                f"Cloud Environment config reading is in progress. "
-                f"It was started at {datetime.utcnow()}"
-            ),
+    status = await StatusCollection.get_status()
+    active_snapshot = status.snapshot if status else None
+    if not active_snapshot:
+        await StatusCollection.rewrite(
+            ServiceStatusModel(
+                ok=False,
+                error_msg=(
+                    f"Cloud Environment config reading is in progress. "
+                    f"It was started at {datetime.utcnow()}"
+                ),
+            )
         )
+
+    active_base_snapshot = status.base_snapshot if status else None
+    is_delta = bool(
+        is_delta_enabled() and active_snapshot and status.layout == SNAPSHOT_LAYOUT
     )
+    hot_vm_ids = (
+        await get_hot_vm_ids() if is_materialization_enabled() and not is_delta else []
+    )
+    await create_statistic_indexes()
+
+    snapshot = new_snapshot_version()
+    base_snapshot = active_base_snapshot or active_snapshot if is_delta else None
+    revision = status.revision + 1 if is_delta else 0
 
     error_msg = None
     try:
-        cloud_environment = await get_cloud_environment()
+        if is_delta:
+            vm_count = await save_cloud_environment_delta(
+                active_snapshot, active_base_snapshot, snapshot, revision
+            )
+            if vm_count is None:
+                snapshot, base_snapshot = active_snapshot, active_base_snapshot
+                revision = status.revision
+        else:
+            vm_count = await save_cloud_environment(snapshot, hot_vm_ids)
     except ValidationError as e:
         msg = "Cloud Environment was not specified correctly"
         logger.exception(msg)
@@ -135,34 +437,50 @@ async def prepare_server():
         error_msg = f"{msg}:\n{e}"
 
     if error_msg:
-        await StatusCollection.rewrite(StatusModel(ok=False, error_msg=error_msg))
+        await drop_snapshots(
+            keep=get_kept_snapshots([active_snapshot], [active_base_snapshot])
+        )
+        await StatusCollection.rewrite(
+            ServiceStatusModel(
+                ok=bool(active_snapshot),
+                error_msg=(
+                    f"{error_msg}\nPrevious Cloud Environment is still used"
+                    if active_snapshot
+                    else error_msg
+                ),
+                snapshot=active_snapshot,
+                revision=status.revision if status else 0,
+                base_snapshot=active_base_snapshot,
+                layout=status.layout if status else 0,
+            )
+        )
         return
 
-    filtered_rules: set[tuple] = {
-        (rule.source_tag, rule.dest_tag) for rule in cloud_environment.rules
-    }
-
-    await gather(
-        VirtualMachineCollection.rewrite(
-            [obj.to_db() for obj in cloud_environment.machines]
-        ),
-        FirewallRuleCollection.rewrite(
-            [
-                FirewallRule(
-                    id=str(f"fw-{i}"), source_tag=rule_info[0], dest_tag=rule_info[1]
-                ).to_db()
-                for i, rule_info in enumerate(filtered_rules)
-            ]
-        ),
-        TagInfoCollection.delete_many(),
-        StatusCollection.delete_many(),
-        ResponseInfoCollection.delete_many(),
+    if vm_count is None and not await ServiceCountersCollection.has_vm_count():
+        # the active snapshot was loaded before VMs were counted, count them once
+        vm_count = await VirtualMachineCollection.for_snapshot(
+            snapshot, base_snapshot
+        ).count_documents()
+    if vm_count is not None:
+        # /stat has the count of the new snapshot as soon as it's active
+        await ServiceCountersCollection.set_vm_count(vm_count)
+    await StatusCollection.rewrite(
+        ServiceStatusModel(
+            ok=True,
+            error_msg="",
+            snapshot=snapshot,
+            revision=revision,
+            base_snapshot=base_snapshot,
+            layout=SNAPSHOT_LAYOUT,
+        )
+    )
+    logger.info(f"Snapshot {snapshot} (revision {revision}) is active")
+    # readers can still use the previous generation for a moment after switching
+    await drop_snapshots(
+        keep=get_kept_snapshots(
+            [snapshot, active_snapshot], [base_snapshot, active_base_snapshot]
+        )
     )
-
-    await add_vms_for_tags()
-    await add_tags_with_access_for_tags()
-
-    await StatusCollection.rewrite(StatusModel(ok=True, error_msg=""))
 
 
 if __name__ == "__main__":
@@ -1,65 +1,528 @@
+import heapq
 import logging
-from asyncio import gather
-from itertools import chain
-from typing import Optional
+from asyncio import Task, create_task, shield
+from bisect import bisect_left, bisect_right
+from itertools import chain, islice
+from typing import Awaitable, Callable, Iterable, Iterator, Optional, Sequence
 
-from .crud import TagInfoCollection, VirtualMachineCollection
+import orjson
+
+from .cache import SnapshotLRUCache
+from .graph import AttackGraph, attack_graph_loader
 from .logger import log_step_async
-from .models import TagInfo, VMInfo
+from .materialize import is_materialization_enabled
+from .models import VMInfo
+from .tag_sets import get_tag_set_signature
+
+from .config import (  # isort: skip
+    ATTACK_RESOLVER,
+    ATTACK_RESOLVER_KEY,
+    ATTACK_RESPONSE_CACHE_MAX_BYTES,
+    ATTACK_RESPONSE_CACHE_MAX_ENTRIES,
+    TAG_CACHE_MAX_ENTRIES,
+    TAG_CACHE_MAX_VM_IDS,
+)
+
+from .crud import (  # isort: skip
+    MaterializedAttackCollection,
+    StatusCollection,
+    TagInfoCollection,
+    TagSetCollection,
+    VirtualMachineCollection,
+)
 
 asyncio_logger = logging.getLogger("asyncio")
 asyncio_logger.setLevel(logging.DEBUG)
 
 logger = logging.getLogger(__name__)
 
+# tag -> IDs of VMs with access to this tag, for the active snapshot
+tag_attackers_cache: SnapshotLRUCache[tuple[str, ...]] = SnapshotLRUCache(
+    max_entries=TAG_CACHE_MAX_ENTRIES, max_size=TAG_CACHE_MAX_VM_IDS
+)
+# tag -> IDs of VMs this tag has access to, for the active snapshot
+tag_targets_cache: SnapshotLRUCache[tuple[str, ...]] = SnapshotLRUCache(
+    max_entries=TAG_CACHE_MAX_ENTRIES, max_size=TAG_CACHE_MAX_VM_IDS
+)
+# VM ID -> /attack response encoded to JSON, for the active snapshot
+attack_response_cache: SnapshotLRUCache[bytes] = SnapshotLRUCache(
+    max_entries=ATTACK_RESPONSE_CACHE_MAX_ENTRIES,
+    max_size=ATTACK_RESPONSE_CACHE_MAX_BYTES,
+)
+# tag set signature -> IDs of VMs with access to this tag set, for the active snapshot
+tag_set_attackers_cache: SnapshotLRUCache[tuple[str, ...]] = SnapshotLRUCache(
+    max_entries=TAG_CACHE_MAX_ENTRIES, max_size=TAG_CACHE_MAX_VM_IDS
+)
+
+
+class MaterializedVMIds:
+    """
+    IDs of VMs which attackers are materialized, loaded once for every version
+    of cloud environment: other VMs are calculated without a MaterializedAttack
+    query. Concurrent requests wait for the same load.
+    """
+
+    def __init__(self):
+        self.version: Optional[tuple[str, int]] = None
+        self.loading: Optional[Task] = None
+
+    async def get(self) -> set[str]:
+        version = await StatusCollection.get_active_version()
+        if self.loading is None or self.version != version:
+            self.version = version
+            self.loading = create_task(self.load())
+        loading = self.loading
+        try:
+            return await shield(loading)
+        except Exception:
+            if self.loading is loading:
+                self.loading = None
+            raise
+
+    async def load(self) -> set[str]:
+        vm_ids = set(await MaterializedAttackCollection.get_vm_ids())
+        logger.debug(f"Attackers of {len(vm_ids)} VMs are materialized")
+        return vm_ids
+
+
+materialized_vm_ids = MaterializedVMIds()
+
+
+@log_step_async(logger, "calculating VMs of tags linked to specified tags")
+async def get_vm_ids_of_linked_tags(
+    tags: list[str], link_field: str
+) -> dict[str, list[str]]:
+    """
+    VMs of the tags from `link_field` of every tag in `tags`: "tags_with_access" -
+    VMs with access to the tag, "accessible_tags" - VMs the tag has access to.
+    Needs 2 queries for any count of tags: one for linked tags of `tags`,
+    one for VMs of all these linked tags.
+    """
+    tags_info = await TagInfoCollection.get_aggregated_tags_info(
+        tags, fields=[link_field]
+    )
+    linked_tags_for_tag = {
+        tag: getattr(tags_info[tag], link_field) if tag in tags_info else []
+        for tag in tags
+    }
+    logger.debug(f"{link_field} of {tags}: {linked_tags_for_tag}")
+
+    linked_tags_info = await TagInfoCollection.get_aggregated_tags_info(
+        set(chain.from_iterable(linked_tags_for_tag.values())),
+        fields=["tagged_vm_ids"],
+    )
+
+    vm_ids_for_tag = {}
+    for tag, linked_tags in linked_tags_for_tag.items():
+        vm_ids_for_tag[tag] = list(
+            chain.from_iterable(
+                linked_tags_info[linked_tag].tagged_vm_ids
+                for linked_tag in linked_tags
+                if linked_tag in linked_tags_info
+            )
+        )
+        logger.debug(
+            f"VMs of {link_field} of specified TAG {tag} - {len(vm_ids_for_tag[tag])}"
+        )
+    return vm_ids_for_tag
+
+
+async def get_vm_ids_with_access_to_tags(tags: list[str]) -> dict[str, list[str]]:
+    return await get_vm_ids_of_linked_tags(tags, "tags_with_access")
+
+
+async def get_vm_ids_accessible_from_tags(tags: list[str]) -> dict[str, list[str]]:
+    return await get_vm_ids_of_linked_tags(tags, "accessible_tags")
+
+
+async def get_cached_vm_ids_for_tags(
+    tags: list[str],
+    cache: SnapshotLRUCache[tuple[str, ...]],
+    calculate: Callable[[list[str]], Awaitable[dict[str, list[str]]]],
+) -> dict[str, tuple[str, ...]]:
+    """
+    VM IDs for every tag are unique and sorted.
+    """
+    version = await StatusCollection.get_active_version()
+    cache.use_version(version)
+
+    vm_ids_for_tag = {}
+    for tag in tags:
+        vm_ids = cache.get(tag)
+        if vm_ids is not None:
+            vm_ids_for_tag[tag] = vm_ids
+
+    not_cached_tags = [tag for tag in tags if tag not in vm_ids_for_tag]
+    if not_cached_tags:
+        calculated = await calculate(not_cached_tags)
+        for tag, vm_ids in calculated.items():
+            vm_ids = tuple(sorted(set(vm_ids)))
+            cache.put(tag, vm_ids, version)
+            vm_ids_for_tag[tag] = vm_ids
+
+    return vm_ids_for_tag
+
+
+async def get_cached_vm_ids_with_access_to_tags(
+    tags: list[str],
+) -> dict[str, tuple[str, ...]]:
+    return await get_cached_vm_ids_for_tags(
+        tags, tag_attackers_cache, get_vm_ids_with_access_to_tags
+    )
+
+
+async def get_cached_vm_ids_accessible_from_tags(
+    tags: list[str],
+) -> dict[str, tuple[str, ...]]:
+    return await get_cached_vm_ids_for_tags(
+        tags, tag_targets_cache, get_vm_ids_accessible_from_tags
+    )
+
+
+def is_memory_resolver_enabled() -> bool:
+    return ATTACK_RESOLVER == "memory"
+
 
-@log_step_async(logger, "calculating VMs with access to specified tag")
-async def get_vm_ids_with_access_to_tag(
-    tag: str,
+async def get_attack_graph() -> Optional[AttackGraph]:
+    if not is_memory_resolver_enabled():
+        return None
+    graph = await attack_graph_loader.get_graph()
+    if not graph:
+        logger.debug("Attack graph is not loaded yet, use DB")
+    return graph
+
+
+async def preload_attack_graph():
+    if is_memory_resolver_enabled():
+        await attack_graph_loader.get_graph()
+
+
+def unite_vm_ids(
+    vm_id: str, tags: list[str], vm_ids_for_tag: dict[str, tuple[str, ...]]
 ) -> list[str]:
-    tag_info: Optional[TagInfo] = await TagInfoCollection.get_aggregated_tag_info(tag)
-    if not tag_info:
-        logger.debug(f"No tags with access to {tag}")
+    total_vm_ids = set(chain.from_iterable(vm_ids_for_tag[tag] for tag in tags))
+    logger.debug(f"VMs linked to specified VM - {len(total_vm_ids)}")
+
+    if vm_id in total_vm_ids:
+        logger.debug(f"Exclude {vm_id}")
+        total_vm_ids.remove(vm_id)
+
+    return list(total_vm_ids)
+
+
+async def get_cached_attacker_vm_ids_for_tag_set(
+    signature: str,
+) -> Optional[tuple[str, ...]]:
+    """
+    None if the tag set isn't saved for the active snapshot.
+    """
+    version = await StatusCollection.get_active_version()
+    tag_set_attackers_cache.use_version(version)
+
+    vm_ids = tag_set_attackers_cache.get(signature)
+    if vm_ids is None:
+        attacker_vm_ids = await TagSetCollection.get_attacker_vm_ids(signature)
+        if attacker_vm_ids is None:
+            return None
+        vm_ids = tuple(attacker_vm_ids)
+        tag_set_attackers_cache.put(signature, vm_ids, version)
+    return vm_ids
+
+
+async def get_vm_tags(vm_id: str) -> list[str]:
+    first_vm: Optional[VMInfo] = await VirtualMachineCollection.get_by_id(vm_id)
+    tags = list(dict.fromkeys(first_vm.tags)) if first_vm else []
+
+    logger.debug(f"VirtualMachine {vm_id} has tags: {tags}")
+    return tags
+
+
+async def get_vm_id_list_by_tags(vm_id: str) -> list[str]:
+    tags_in_danger = await get_vm_tags(vm_id)
+    if not tags_in_danger:
         return []
 
-    total_vm_ids_with_access_to_tag = []
-    tags_with_access = tag_info.tags_with_access
+    vm_ids_with_access_to_tag = await get_cached_vm_ids_with_access_to_tags(
+        tags_in_danger
+    )
+    return unite_vm_ids(vm_id, tags_in_danger, vm_ids_with_access_to_tag)
 
-    logger.debug(f"Tags with access to {tag}: {tags_with_access}")
 
-    for tag_with_access in tags_with_access:
-        tag_with_access_info: Optional[
-            TagInfo
-        ] = await TagInfoCollection.get_aggregated_tag_info(tag_with_access)
-        if tag_with_access_info:
-            total_vm_ids_with_access_to_tag.extend(tag_with_access_info.tagged_vm_ids)
-    logger.debug(
-        f"VMs who can attack specified TAG - {len(total_vm_ids_with_access_to_tag)}: "
-        "{total_vm_ids_with_access_to_tag[:4]}..."
+async def get_vm_id_list_by_tag_set(vm_id: str) -> list[str]:
+    tags_in_danger = await get_vm_tags(vm_id)
+    if not tags_in_danger:
+        return []
+
+    attacker_vm_ids = await get_cached_attacker_vm_ids_for_tag_set(
+        get_tag_set_signature(tags_in_danger)
     )
-    return total_vm_ids_with_access_to_tag
+    if attacker_vm_ids is None:
+        logger.debug(f"Tag set of {vm_id} is not saved, use TagInfo")
+        return await get_vm_id_list_by_tags(vm_id)
+    return [attacker for attacker in attacker_vm_ids if attacker != vm_id]
+
+
+async def get_vm_id_list_by_aggregation(vm_id: str) -> list[str]:
+    vm_ids = await VirtualMachineCollection.get_vm_ids_with_access_to_vm(vm_id)
+    if vm_ids is None:
+        logger.debug("Snapshot is layered, use TagInfo")
+        return await get_vm_id_list_by_tags(vm_id)
+    return vm_ids
+
+
+# ATTACK_RESOLVER -> how /attack is calculated when it's not materialized
+ATTACK_RESOLVERS: dict[str, Callable[[str], Awaitable[list[str]]]] = {
+    "mongo": get_vm_id_list_by_tags,
+    "memory": get_vm_id_list_by_tags,  # while attack graph is loading
+    "tag_set": get_vm_id_list_by_tag_set,
+    "aggregation": get_vm_id_list_by_aggregation,
+}
+
+
+def check_attack_resolver():
+    if ATTACK_RESOLVER not in ATTACK_RESOLVERS:
+        raise ValueError(
+            f"Unknown {ATTACK_RESOLVER_KEY} {ATTACK_RESOLVER!r}, "
+            f"use one of: {', '.join(ATTACK_RESOLVERS)}"
+        )
 
 
 @log_step_async(logger, "calculating VMs with access to specified VM")
 async def get_vm_id_list_with_access_to_vm(vm_id: str) -> list[str]:
-    first_vm: Optional[VMInfo] = await VirtualMachineCollection.get_by_id(vm_id)
-    tags_in_danger = first_vm.tags if first_vm else []
+    graph = await get_attack_graph()
+    if graph:
+        return graph.get_vm_ids_with_access_to_vm(vm_id)
+
+    if is_materialization_enabled() and vm_id in await materialized_vm_ids.get():
+        attacker_vm_ids = await MaterializedAttackCollection.get_attacker_vm_ids(vm_id)
+        if attacker_vm_ids is not None:
+            return attacker_vm_ids
+        logger.debug(f"Attackers of {vm_id} are not materialized, calculate them")
+
+    return await ATTACK_RESOLVERS[ATTACK_RESOLVER](vm_id)
+
+
+async def get_encoded_vm_id_list_with_access_to_vm(vm_id: str) -> bytes:
+    version = await StatusCollection.get_active_version()
+    attack_response_cache.use_version(version)
+
+    content = attack_response_cache.get(vm_id)
+    if content is None:
+        content = orjson.dumps(await get_vm_id_list_with_access_to_vm(vm_id))
+        attack_response_cache.put(vm_id, content, version)
+    return content
 
-    logger.debug(f"VirtualMachine {vm_id} has tags: {tags_in_danger}")
+
+@log_step_async(logger, "calculating VMs accessible from specified VM")
+async def get_vm_id_list_accessible_from_vm(vm_id: str) -> list[str]:
+    graph = await get_attack_graph()
+    if graph:
+        return graph.get_vm_ids_accessible_from_vm(vm_id)
+
+    tags = await get_vm_tags(vm_id)
+    if not tags:
+        return []
+
+    vm_ids_accessible_from_tag = await get_cached_vm_ids_accessible_from_tags(tags)
+    return unite_vm_ids(vm_id, tags, vm_ids_accessible_from_tag)
+
+
+async def get_sorted_vm_ids_lists(vm_id: str) -> list[tuple[str, ...]]:
+    tags_in_danger = await get_vm_tags(vm_id)
     if not tags_in_danger:
         return []
 
-    gather_results = await gather(
-        *[get_vm_ids_with_access_to_tag(tag) for tag in tags_in_danger]
+    vm_ids_with_access_to_tag = await get_cached_vm_ids_with_access_to_tags(
+        tags_in_danger
     )
+    return [vm_ids_with_access_to_tag[tag] for tag in tags_in_danger]
 
-    total_vm_id_list_with_access_to_vm = set(chain.from_iterable(gather_results))
-    logger.debug(
-        f"VMs who can attack specified VM - {len(total_vm_id_list_with_access_to_vm)}"
+
+def contains_sorted(vm_ids: Sequence[str], vm_id: str) -> bool:
+    i = bisect_left(vm_ids, vm_id)
+    return i < len(vm_ids) and vm_ids[i] == vm_id
+
+
+def merge_sorted_vm_ids(
+    sorted_vm_ids_lists: Iterable[Sequence[str]],
+    exclude: str,
+    after: Optional[str] = None,
+) -> Iterator[str]:
+    if after is not None:
+        sorted_vm_ids_lists = [
+            islice(vm_ids, bisect_right(vm_ids, after), None)
+            for vm_ids in sorted_vm_ids_lists
+        ]
+
+    previous = None
+    for vm_id in heapq.merge(*sorted_vm_ids_lists):
+        if vm_id != previous and vm_id != exclude:
+            yield vm_id
+        previous = vm_id
+
+
+def count_sorted_vm_ids(
+    sorted_vm_ids_lists: Iterable[Sequence[str]], exclude: str
+) -> int:
+    """
+    One list or lists with disjoint ranges of IDs are counted by their lengths,
+    only overlapping lists are merged.
+    """
+    vm_ids_lists = sorted(
+        (vm_ids for vm_ids in sorted_vm_ids_lists if vm_ids),
+        key=lambda vm_ids: vm_ids[0],
     )
+    if all(
+        previous[-1] < vm_ids[0]
+        for previous, vm_ids in zip(vm_ids_lists, vm_ids_lists[1:])
+    ):
+        return sum(len(vm_ids) for vm_ids in vm_ids_lists) - any(
+            contains_sorted(vm_ids, exclude) for vm_ids in vm_ids_lists
+        )
+    return sum(1 for _ in merge_sorted_vm_ids(vm_ids_lists, exclude=exclude))
 
-    if vm_id in total_vm_id_list_with_access_to_vm:
-        logger.debug(f"Exclude {vm_id}")
-        total_vm_id_list_with_access_to_vm.remove(vm_id)
 
-    return list(total_vm_id_list_with_access_to_vm)
+async def iter_vm_ids_with_access_to_vm(
+    vm_id: str, after: Optional[str] = None
+) -> Iterator[str]:
+    """
+    The same VMs as get_vm_id_list_with_access_to_vm returns, but sorted by ID,
+    greater than `after` and produced lazily: sorted VM IDs of every tag
+    are merged without building the whole list.
+    """
+    graph = await get_attack_graph()
+    if graph:
+        return graph.iter_vm_ids_with_access_to_vm(vm_id, after)
+
+    return merge_sorted_vm_ids(
+        await get_sorted_vm_ids_lists(vm_id), exclude=vm_id, after=after
+    )
+
+
+@log_step_async(logger, "counting VMs with access to specified VM")
+async def count_vm_ids_with_access_to_vm(vm_id: str) -> int:
+    graph = await get_attack_graph()
+    if graph:
+        return graph.count_vm_ids_with_access_to_vm(vm_id)
+
+    return count_sorted_vm_ids(await get_sorted_vm_ids_lists(vm_id), exclude=vm_id)
+
+
+@log_step_async(logger, "checking VMs with access to specified VM")
+async def has_vm_ids_with_access_to_vm(vm_id: str) -> bool:
+    graph = await get_attack_graph()
+    if graph:
+        return graph.has_vm_ids_with_access_to_vm(vm_id)
+
+    tags_in_danger = await get_vm_tags(vm_id)
+    if not tags_in_danger:
+        return False
+    tags_info = await TagInfoCollection.get_aggregated_tags_info(
+        tags_in_danger, fields=["tags_with_access"]
+    )
+    tags_with_access = set(
+        chain.from_iterable(info.tags_with_access for info in tags_info.values())
+    )
+    # VM IDs are not loaded, the first tag with another VM is enough
+    return await TagInfoCollection.has_tagged_vm_ids(tags_with_access, exclude=vm_id)
+
+
+@log_step_async(logger, "calculating VMs with multi-hop access to specified VM")
+async def get_vm_distances_with_access_to_vm(
+    vm_id: str, max_depth: int
+) -> dict[str, int]:
+    """
+    VMs which can reach `vm_id` through up to `max_depth - 1` intermediate VMs,
+    with count of hops. The same BFS over tags as AttackGraph does, every level
+    needs 3 queries: tags with access, their VMs and tags of these VMs.
+    """
+    graph = await get_attack_graph()
+    if graph:
+        return graph.get_vm_distances_with_access_to_vm(vm_id, max_depth)
+
+    target_tags = await get_vm_tags(vm_id)
+    visited_vm_ids = {vm_id}
+    visited_target_tags = set(target_tags)
+    visited_source_tags = set()
+
+    distances = {}
+    for depth in range(1, max_depth + 1):
+        if not target_tags:
+            break
+        tags_info = await TagInfoCollection.get_aggregated_tags_info(
+            target_tags, fields=["tags_with_access"]
+        )
+        source_tags = (
+            set(
+                chain.from_iterable(
+                    info.tags_with_access for info in tags_info.values()
+                )
+            )
+            - visited_source_tags
+        )
+        visited_source_tags.update(source_tags)
+
+        source_tags_info = await TagInfoCollection.get_aggregated_tags_info(
+            source_tags, fields=["tagged_vm_ids"]
+        )
+        attacker_ids = (
+            set(
+                chain.from_iterable(
+                    info.tagged_vm_ids for info in source_tags_info.values()
+                )
+            )
+            - visited_vm_ids
+        )
+        logger.debug(
+            f"VMs who can attack specified VM in {depth} hops - {len(attacker_ids)}"
+        )
+        if not attacker_ids:
+            break
+        visited_vm_ids.update(attacker_ids)
+        distances.update(dict.fromkeys(sorted(attacker_ids), depth))
+        if depth == max_depth:
+            break
+
+        tags_for_attacker = await VirtualMachineCollection.get_tags_by_ids(attacker_ids)
+        target_tags = list(
+            set(chain.from_iterable(tags_for_attacker.values())) - visited_target_tags
+        )
+        visited_target_tags.update(target_tags)
+    return distances
+
+
+@log_step_async(logger, "calculating VMs with access to specified VMs")
+async def get_vm_id_lists_with_access_to_vms(
+    vm_ids: list[str],
+) -> dict[str, list[str]]:
+    """
+    The same as get_vm_id_list_with_access_to_vm for every VM in `vm_ids`,
+    but VMs are loaded with one query and every tag is resolved once per batch.
+    """
+    vm_ids = list(dict.fromkeys(vm_ids))
+    graph = await get_attack_graph()
+    if graph:
+        return {vm_id: graph.get_vm_ids_with_access_to_vm(vm_id) for vm_id in vm_ids}
+
+    vms = await VirtualMachineCollection.get_by_ids(vm_ids)
+    tags_in_danger_for_vm = {
+        vm_id: list(dict.fromkeys(vm.tags)) for vm_id, vm in vms.items()
+    }
+    tags_in_danger = list(
+        dict.fromkeys(chain.from_iterable(tags_in_danger_for_vm.values()))
+    )
+    logger.debug(
+        f"VirtualMachines {len(vms)}/{len(vm_ids)} have tags: {tags_in_danger}"
+    )
+
+    vm_ids_with_access_to_tag = (
+        await get_cached_vm_ids_with_access_to_tags(tags_in_danger)
+        if tags_in_danger
+        else {}
+    )
+    return {
+        vm_id: unite_vm_ids(
+            vm_id, tags_in_danger_for_vm.get(vm_id, []), vm_ids_with_access_to_tag
+        )
+        for vm_id in vm_ids
+    }
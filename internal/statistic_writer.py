@@ -0,0 +1,193 @@
+import logging
+from asyncio import Event, Task, TimeoutError, create_task, wait_for
+from collections import defaultdict
+from typing import Awaitable, Callable, Hashable, Optional
+
+from pydantic import BaseModel
+from pymongo.errors import BulkWriteError
+
+from .histogram import LatencyHistogram
+from .logger import log_step_async
+from .models import ServiceCountersModel
+
+from .crud import (  # isort: skip
+    ROLLUP_COLLECTIONS,
+    LatencyHistogramCollection,
+    ResponseInfoCollection,
+    ServiceCountersCollection,
+)
+
+from .config import (  # isort: skip
+    STATISTIC_BATCH_SIZE,
+    STATISTIC_FLUSH_SECONDS,
+    STATISTIC_QUEUE_MAX_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StatisticWriterInfo(BaseModel):
+    queued: int
+    written: int
+    dropped: int
+
+
+class StatisticWriter:
+    """
+    Saves ResponseInfo documents in background: requests only put them into
+    a bounded queue, it is written with insert_many when `batch_size` documents
+    are queued or every `flush_seconds`. Documents which don't fit into the queue
+    or were not written are counted as dropped.
+    Durations are also added to request counters, latency histograms of paths
+    and their per-minute / per-hour rollups, which are saved as increments with
+    the queue, so all workers add up to the same counters and histograms.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = STATISTIC_QUEUE_MAX_SIZE,
+        batch_size: int = STATISTIC_BATCH_SIZE,
+        flush_seconds: float = STATISTIC_FLUSH_SECONDS,
+    ):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+
+        self.queue: list[dict] = []
+        self.histograms: dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.rollups = {
+            collection: defaultdict(LatencyHistogram)
+            for collection in ROLLUP_COLLECTIONS
+        }
+        self.request_count = 0
+        self.duration_sum = 0.0
+        self.batch_ready = Event()
+        self.closing = False
+        self.task: Optional[Task] = None
+
+        self.written = 0
+        self.dropped = 0
+
+    def add(self, document: dict):
+        self.request_count += 1
+        self.duration_sum += document["duration"]
+        self.histograms[document["path"]].add(document["duration"])
+        for collection, rollups in self.rollups.items():
+            period_start = collection.get_period_start(document["created_at"])
+            rollups[document["path"], period_start].add(document["duration"])
+        if len(self.queue) >= self.max_queue_size:
+            self.dropped += 1
+            return
+        self.queue.append(document)
+        if len(self.queue) >= self.batch_size:
+            self.batch_ready.set()
+
+    async def start(self):
+        self.closing = False
+        self.task = create_task(self.run())
+
+    async def run(self):
+        while not self.closing:
+            try:
+                await wait_for(self.batch_ready.wait(), self.flush_seconds)
+            except TimeoutError:
+                pass
+            self.batch_ready.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self.queue:
+            batch = self.queue[: self.batch_size]
+            del self.queue[: self.batch_size]
+            await self.insert(batch)
+        await self.save_counters()
+        await self.save_histograms()
+
+    async def insert(self, batch: list[dict]):
+        try:
+            await ResponseInfoCollection.insert_many(batch, ordered=False)
+            self.written += len(batch)
+        except BulkWriteError as e:
+            failed = len(e.details.get("writeErrors", []))
+            self.written += len(batch) - failed
+            self.dropped += failed
+            logger.warning(f"{failed} statistic documents were not written: {e}")
+        except Exception:
+            self.dropped += len(batch)
+            logger.exception(f"{len(batch)} statistic documents were not written")
+
+    async def save_counters(self):
+        if not self.request_count:
+            return
+        request_count, duration_sum = self.request_count, self.duration_sum
+        self.request_count, self.duration_sum = 0, 0.0
+        try:
+            await ServiceCountersCollection.add_requests(request_count, duration_sum)
+        except Exception:
+            logger.exception("Request counters were not saved")
+            self.request_count += request_count
+            self.duration_sum += duration_sum
+
+    async def get_counters(self) -> ServiceCountersModel:
+        counters = await ServiceCountersCollection.get_counters()
+        counters.request_count += self.request_count
+        counters.duration_sum += self.duration_sum
+        return counters
+
+    async def save_histograms(self):
+        if self.histograms:
+            histograms = self.histograms
+            self.histograms = defaultdict(LatencyHistogram)
+            await self.save_increments(
+                histograms, self.histograms, LatencyHistogramCollection.add_histograms
+            )
+        for collection in ROLLUP_COLLECTIONS:
+            rollups = self.rollups[collection]
+            if rollups:
+                self.rollups[collection] = defaultdict(LatencyHistogram)
+                await self.save_increments(
+                    rollups, self.rollups[collection], collection.add_rollups
+                )
+
+    async def save_increments(
+        self,
+        histograms: dict[Hashable, LatencyHistogram],
+        not_saved: dict[Hashable, LatencyHistogram],
+        save: Callable[[dict], Awaitable],
+    ):
+        try:
+            await save(histograms)
+        except Exception:
+            logger.exception(f"{len(histograms)} latency histograms were not saved")
+            for key, histogram in histograms.items():
+                not_saved[key].merge(histogram)
+
+    async def get_histograms(self) -> dict[str, LatencyHistogram]:
+        """
+        Saved histograms of all workers with not saved durations of this one.
+        """
+        histograms = await LatencyHistogramCollection.get_histograms()
+        for path, histogram in self.histograms.items():
+            histograms.setdefault(path, LatencyHistogram()).merge(histogram)
+        return histograms
+
+    @log_step_async(logger, "flush statistic on shutdown")
+    async def close(self):
+        self.closing = True
+        self.batch_ready.set()
+        if self.task:
+            await self.task
+            self.task = None
+        await self.flush()
+        logger.info(
+            f"Statistic writer is closed: {self.written} written, "
+            f"{self.dropped} dropped"
+        )
+
+    def statistic(self) -> StatisticWriterInfo:
+        return StatisticWriterInfo(
+            queued=len(self.queue), written=self.written, dropped=self.dropped
+        )
+
+
+statistic_writer = StatisticWriter()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+from itertools import chain
+from typing import Iterable, Optional, Type
+
+from .bulk_writer import BulkWriter
+from .config import ATTACK_RESOLVER
+from .logger import log_step_async
+from .models import TagSetInfo, VMInfo
+
+from .crud import (  # isort: skip
+    MONGO_ARRAY_ELEMS_COUNT,
+    chunks,
+    SnapshotCollectionMixin,
+    TagInfoCollection,
+    TagSetCollection,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def is_tag_set_resolver_enabled() -> bool:
+    return ATTACK_RESOLVER == "tag_set"
+
+
+TagSet = tuple[str, ...]
+
+
+def get_tag_set(tags: Iterable[str]) -> TagSet:
+    return tuple(sorted(set(tags)))
+
+
+def get_tag_set_signature(tags: Iterable[str]) -> str:
+    return hashlib.sha1(json.dumps(get_tag_set(tags)).encode()).hexdigest()
+
+
+def get_attacker_vm_ids_for_tag_set(
+    tags: Iterable[str],
+    vm_ids_for_tag: dict[str, list[str]],
+    tags_with_access_for_tag: dict[str, set[str]],
+) -> list[str]:
+    tags_with_access = set()
+    for tag in tags:
+        tags_with_access.update(tags_with_access_for_tag.get(tag, ()))
+
+    attacker_vm_ids = set()
+    for tag_with_access in tags_with_access:
+        attacker_vm_ids.update(vm_ids_for_tag.get(tag_with_access, ()))
+    return sorted(attacker_vm_ids)
+
+
+@log_step_async(logger, "insert attackers for all tag sets")
+async def add_tag_sets(
+    snapshot: str,
+    tags_for_tag_set: dict[str, list[str]],
+    vm_ids_for_tag: dict[str, list[str]],
+    tags_with_access_for_tag: dict[str, set[str]],
+):
+    """
+    VMs with the same set of tags have the same attackers (except themselves),
+    so attackers are saved once per tag set signature instead of once per VM.
+    """
+    tag_set_collection = TagSetCollection.for_snapshot(snapshot)
+    await tag_set_collection.create_indexes()
+    async with BulkWriter(tag_set_collection) as writer:
+        for signature, tags in tags_for_tag_set.items():
+            attacker_vm_ids = get_attacker_vm_ids_for_tag_set(
+                tags, vm_ids_for_tag, tags_with_access_for_tag
+            )
+            attacker_vm_ids_chunks = list(
+                chunks(attacker_vm_ids, MONGO_ARRAY_ELEMS_COUNT)
+            )
+            # tag set without attackers is saved too: a missing tag set means
+            # TagSet wasn't built for the snapshot
+            for attacker_vm_ids_chunk in attacker_vm_ids_chunks or [[]]:
+                await writer.add(
+                    TagSetInfo(
+                        signature=signature,
+                        tags=tags,
+                        attacker_vm_ids=attacker_vm_ids_chunk,
+                    ).dict()
+                )
+    logger.info(f"Attackers for {len(tags_for_tag_set)} tag sets are saved")
+
+
+async def get_tag_maps_for_tags(
+    snapshot: str, base_snapshot: Optional[str], tags: Iterable[str]
+) -> tuple[dict[str, list[str]], dict[str, set[str]]]:
+    """
+    Tags with access of `tags` and VMs of these tags with access from TagInfo.
+    """
+    tag_info_collection = TagInfoCollection.for_snapshot(snapshot, base_snapshot)
+    tags_with_access_for_tag = {
+        tag: set(tag_info.tags_with_access)
+        for tag, tag_info in (
+            await tag_info_collection.get_aggregated_tags_info(
+                tags, fields=["tags_with_access"]
+            )
+        ).items()
+    }
+    vm_ids_for_tag = {
+        tag: tag_info.tagged_vm_ids
+        for tag, tag_info in (
+            await tag_info_collection.get_aggregated_tags_info(
+                set(chain.from_iterable(tags_with_access_for_tag.values())),
+                fields=["tagged_vm_ids"],
+            )
+        ).items()
+    }
+    return vm_ids_for_tag, tags_with_access_for_tag
+
+
+async def get_tags_for_tag_sets_with_tags(
+    collection: Type[SnapshotCollectionMixin], tags: Iterable[str]
+) -> dict[str, list[str]]:
+    tags_for_tag_set = {}
+    for tags_chunk in chunks(list(tags), MONGO_ARRAY_ELEMS_COUNT):
+        async for doc in collection.find_layered_by(
+            {"tags": {"$in": tags_chunk}}, {"_id": False, "tags": True}
+        ):
+            tags_for_tag_set[doc["signature"]] = doc["tags"]
+    return tags_for_tag_set
+
+
+@log_step_async(logger, "update attackers of changed tag sets")
+async def update_tag_sets(
+    snapshot: str,
+    base_snapshot: str,
+    upserted_vms: Iterable[VMInfo],
+    affected_tags: Iterable[str],
+):
+    """
+    Tag sets with any of `affected_tags` and tag sets of `upserted_vms`
+    are written to the `snapshot` layer, others stay in the base.
+    """
+    tags_for_tag_set = await get_tags_for_tag_sets_with_tags(
+        TagSetCollection.for_snapshot(snapshot, base_snapshot), affected_tags
+    )
+    for vm in upserted_vms:
+        tags_for_tag_set.setdefault(
+            get_tag_set_signature(vm.tags), list(get_tag_set(vm.tags))
+        )
+    vm_ids_for_tag, tags_with_access_for_tag = await get_tag_maps_for_tags(
+        snapshot, base_snapshot, set(chain.from_iterable(tags_for_tag_set.values()))
+    )
+
+    tag_set_collection = TagSetCollection.for_snapshot(snapshot)
+    for signatures_chunk in chunks(list(tags_for_tag_set), MONGO_ARRAY_ELEMS_COUNT):
+        await tag_set_collection.delete_many({"signature": {"$in": signatures_chunk}})
+    await add_tag_sets(
+        snapshot, tags_for_tag_set, vm_ids_for_tag, tags_with_access_for_tag
+    )
@@ -0,0 +1,62 @@
+from array import array
+from unittest import TestCase
+
+from parameterized import parameterized
+
+from .bitmap import ARRAY_MAX_SIZE, BitMap
+
+SPARSE = [1, 5, 70000, 70001, 1 << 20]
+DENSE = list(range(0, 3 * ARRAY_MAX_SIZE, 2)) + [(1 << 16) + 3]
+
+
+class BitMapTestCase(TestCase):
+    def setUp(self) -> None:
+        self.longMessage = True
+
+    @parameterized.expand((("Arrays", SPARSE), ("Bitset", DENSE)))
+    def test_set_operations(self, reason, values):
+        other = [0, 5, 6, 70001, (1 << 16) + 3, 4 * ARRAY_MAX_SIZE]
+        bitmap = BitMap(reversed(values))
+
+        self.assertEqual(list(bitmap), values, reason)
+        self.assertEqual(len(bitmap), len(values), reason)
+        self.assertEqual(
+            list(bitmap | BitMap(other)), sorted(set(values) | set(other)), reason
+        )
+        self.assertEqual(
+            list(bitmap - BitMap(other)), sorted(set(values) - set(other)), reason
+        )
+        self.assertEqual(list(bitmap), values, "Operands are not changed")
+        self.assertEqual(
+            list(bitmap.iter_after(5)), [value for value in values if value > 5], reason
+        )
+        self.assertIn(values[-1], bitmap, reason)
+        self.assertNotIn(3, bitmap, reason)
+
+    def test_containers(self):
+        bitmap = BitMap(DENSE)
+
+        self.assertIsInstance(bitmap.containers[0], int, "Dense group is a bitset")
+        self.assertEqual(bitmap.containers[1], array("H", [3]), "Sparse is array")
+
+        bitmap -= BitMap(range(0, 2 * ARRAY_MAX_SIZE))
+
+        self.assertIsInstance(
+            bitmap.containers[0], array, "Bitset which became sparse is array"
+        )
+        self.assertEqual(len(bitmap), ARRAY_MAX_SIZE // 2 + 1)
+
+    def test_discard(self):
+        vms = BitMap([1, 2])
+        attackers = BitMap()
+        attackers |= vms
+
+        attackers.discard(1)
+        attackers.discard(3)
+
+        self.assertEqual(list(attackers), [2])
+        self.assertEqual(list(vms), [1, 2], "Shared containers are not changed")
+
+        attackers.discard(2)
+
+        self.assertFalse(attackers, "Empty groups are removed")
@@ -0,0 +1,77 @@
+from asyncio import Event, sleep
+from unittest import IsolatedAsyncioTestCase, mock
+
+from .bulk_writer import BulkWriter
+
+
+class BulkWriterTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+        self.collection = mock.MagicMock()
+        self.collection.insert_many = mock.AsyncMock()
+
+    def get_batches(self) -> list[list[dict]]:
+        return [call[0][0] for call in self.collection.insert_many.await_args_list]
+
+    async def test_batches_are_bounded_by_docs_count(self):
+        async with BulkWriter(self.collection, batch_size=2) as writer:
+            for i in range(5):
+                await writer.add({"_id": str(i)})
+
+        self.assertEqual(
+            self.get_batches(),
+            [
+                [{"_id": "0"}, {"_id": "1"}],
+                [{"_id": "2"}, {"_id": "3"}],
+                [{"_id": "4"}],
+            ],
+            "Documents should be split into batches with limited size",
+        )
+        for call in self.collection.insert_many.await_args_list:
+            self.assertEqual(call[1], {"ordered": False}, "Batches are unordered")
+
+    async def test_batches_are_bounded_by_bytes(self):
+        async with BulkWriter(
+            self.collection, batch_size=100, batch_bytes=100
+        ) as writer:
+            for i in range(3):
+                await writer.add({"_id": str(i), "payload": "x" * 60})
+
+        self.assertEqual(
+            [len(batch) for batch in self.get_batches()],
+            [1, 1, 1],
+            "Batch should not be bigger than limit in bytes",
+        )
+
+    async def test_in_flight_batches_are_limited(self):
+        in_flight = 0
+        max_in_flight = 0
+        release = Event()
+
+        async def insert_many(documents, ordered):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await release.wait()
+            in_flight -= 1
+
+        self.collection.insert_many = mock.AsyncMock(side_effect=insert_many)
+
+        writer = BulkWriter(self.collection, batch_size=1, max_in_flight=2)
+        await writer.add({"_id": "0"})
+        await writer.add({"_id": "1"})
+        await writer.add({"_id": "2"})
+        await sleep(0)
+        release.set()
+        await writer.add({"_id": "3"})
+        await writer.close()
+
+        self.assertEqual(max_in_flight, 2, "Only 2 batches can be written together")
+        self.assertEqual(writer.docs_count, 4, "All documents should be written")
+
+    async def test_insert_error_is_raised(self):
+        self.collection.insert_many = mock.AsyncMock(side_effect=ValueError("Mongo"))
+
+        with self.assertRaises(ValueError, msg="Write errors should not be lost"):
+            async with BulkWriter(self.collection) as writer:
+                await writer.add({"_id": "0"})
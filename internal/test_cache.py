@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+from .cache import SnapshotLRUCache
+
+
+class SnapshotLRUCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        self.longMessage = True
+
+    def test_cache_is_bounded_by_entries(self):
+        cache = SnapshotLRUCache(max_entries=2, max_size=100)
+        cache.use_version("v1")
+        cache.put("a", ("1",), "v1")
+        cache.put("b", ("2",), "v1")
+        cache.get("a")
+        cache.put("c", ("3",), "v1")
+
+        self.assertEqual(cache.get("b"), None, "Least recently used item is evicted")
+        self.assertEqual(cache.get("a"), ("1",), "Recently used item is kept")
+        self.assertEqual(cache.get("c"), ("3",), "New item is kept")
+        self.assertEqual(
+            cache.statistic().dict(),
+            {
+                "version": "v1",
+                "entries": 2,
+                "size": 2,
+                "hits": 3,
+                "misses": 1,
+                "evictions": 1,
+            },
+        )
+
+    def test_cache_is_bounded_by_size(self):
+        cache = SnapshotLRUCache(max_entries=100, max_size=3)
+        cache.use_version("v1")
+        cache.put("a", ("1", "2"), "v1")
+        cache.put("b", ("3", "4"), "v1")
+        cache.put("c", ("5", "6", "7", "8"), "v1")
+
+        self.assertEqual(list(cache.items), ["b"], "Size of values is limited")
+        self.assertEqual(cache.size, 2)
+
+    def test_cache_is_cleared_for_new_version(self):
+        cache = SnapshotLRUCache(max_entries=100, max_size=100)
+        cache.use_version("v1")
+        cache.put("a", ("1",), "v1")
+        cache.use_version("v1")
+        self.assertEqual(cache.get("a"), ("1",), "The same version")
+
+        cache.use_version("v2")
+        self.assertEqual(cache.get("a"), None, "Values of old version are removed")
+        self.assertEqual(cache.size, 0)
+
+    def test_value_of_old_version_is_not_cached(self):
+        cache = SnapshotLRUCache(max_entries=100, max_size=100)
+        cache.use_version("v1")
+        cache.use_version("v2")
+        cache.put("a", ("1",), "v1")
+        self.assertEqual(cache.get("a"), None, "Calculated before the reload")
+        self.assertEqual(cache.size, 0)
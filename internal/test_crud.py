@@ -0,0 +1,277 @@
+from unittest import IsolatedAsyncioTestCase, mock
+
+from pymongo.errors import OperationFailure
+
+from .models import ServiceStatusModel
+from .mongo_mock import CollectionMock, DatabaseMock, patch_database
+
+from .crud import (  # isort: skip
+    ExposureCollection,
+    StatusCollection,
+    TagInfoCollection,
+    VirtualMachineCollection,
+)
+
+
+def get_mock_path(item: str) -> str:
+    return f"internal.crud.{item}"
+
+
+class ChangeStreamMock:
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.alive = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def try_next(self):
+        if not self.changes:
+            self.alive = False
+            return None
+        return self.changes.pop(0)
+
+
+class StatusCollectionTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+        StatusCollection.reset_active_status()
+        self.addCleanup(StatusCollection.reset_active_status)
+
+    @mock.patch(get_mock_path("ACTIVE_SNAPSHOT_CACHE_SECONDS"), 60)
+    async def test_active_status_is_read_once(self):
+        status = ServiceStatusModel(ok=True, snapshot="s1")
+        with mock.patch.object(
+            StatusCollection, "get_status", mock.AsyncMock(return_value=status)
+        ) as get_status:
+            self.assertEqual(await StatusCollection.get_active_status(), status)
+            self.assertEqual(await StatusCollection.get_active_status(), status)
+
+            get_status.assert_awaited_once()
+
+            StatusCollection.reset_active_status()
+            await StatusCollection.get_active_status()
+            self.assertEqual(get_status.await_count, 2, "Reset cache is read again")
+
+    @mock.patch(get_mock_path("ACTIVE_SNAPSHOT_CACHE_SECONDS"), 0)
+    async def test_stale_status_is_read_again(self):
+        with mock.patch.object(
+            StatusCollection, "get_status", mock.AsyncMock(return_value=None)
+        ) as get_status:
+            await StatusCollection.get_active_status()
+            await StatusCollection.get_active_status()
+
+            self.assertEqual(get_status.await_count, 2)
+
+    @mock.patch(get_mock_path("ACTIVE_SNAPSHOT_CACHE_SECONDS"), 60)
+    async def test_status_is_changed_by_change_stream(self):
+        old_status = ServiceStatusModel(ok=True, snapshot="s1")
+        new_status = ServiceStatusModel(ok=True, snapshot="s2")
+        collection = mock.MagicMock()
+        collection.watch.return_value = ChangeStreamMock(
+            [None, {"fullDocument": new_status.dict()}]
+        )
+
+        with mock.patch.object(
+            StatusCollection, "get_collection", mock.AsyncMock(return_value=collection)
+        ), mock.patch.object(
+            StatusCollection, "get_status", mock.AsyncMock(return_value=old_status)
+        ) as get_status:
+            await StatusCollection.watch_status_changes()
+
+            self.assertEqual(await StatusCollection.get_active_status(), new_status)
+            get_status.assert_awaited_once()
+
+        collection.watch.return_value = ChangeStreamMock([{"operationType": "delete"}])
+        with mock.patch.object(
+            StatusCollection, "get_collection", mock.AsyncMock(return_value=collection)
+        ), mock.patch.object(
+            StatusCollection, "get_status", mock.AsyncMock(return_value=old_status)
+        ):
+            await StatusCollection.watch_status_changes()
+
+        self.assertIsNone(StatusCollection.active_status, "Status was deleted")
+
+    @mock.patch(get_mock_path("sleep"))
+    async def test_status_is_polled_without_change_streams(self, sleep):
+        status = ServiceStatusModel(ok=True, snapshot="s1")
+        sleep.side_effect = [None, StopAsyncIteration]
+
+        with mock.patch.object(
+            StatusCollection,
+            "watch_status_changes",
+            mock.AsyncMock(side_effect=OperationFailure("Not a replica set")),
+        ), mock.patch.object(
+            StatusCollection, "get_status", mock.AsyncMock(return_value=status)
+        ) as get_status:
+            with self.assertRaises(StopAsyncIteration):
+                await StatusCollection.watch_active_status()
+
+        self.assertEqual(get_status.await_count, 2, "Status is polled in loop")
+        self.assertEqual(StatusCollection.active_status, status)
+
+    async def test_legacy_status_is_migrated(self):
+        collection = mock.MagicMock(
+            find_one=mock.AsyncMock(
+                side_effect=[None, {"_id": "legacy", "ok": True, "error_msg": ""}]
+            ),
+            replace_one=mock.AsyncMock(),
+        )
+
+        with mock.patch.object(
+            StatusCollection, "get_collection", mock.AsyncMock(return_value=collection)
+        ), mock.patch.object(StatusCollection, "delete_many", mock.AsyncMock()):
+            status = await StatusCollection.get_status()
+
+        self.assertEqual(status, ServiceStatusModel(ok=True, snapshot=None))
+        collection.replace_one.assert_awaited_once_with(
+            {"_id": "status"}, status.dict(), upsert=True
+        )
+
+
+class SnapshotCollectionTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+
+    @mock.patch(get_mock_path("get_database"))
+    async def test_drop_snapshots(self, get_database):
+        db = mock.MagicMock(
+            list_collection_names=mock.AsyncMock(
+                return_value=[
+                    "VirtualMachine",
+                    "VirtualMachine_20230601120000000000",
+                    "VirtualMachine_20230601130000000000",
+                    "VirtualMachine_backup",
+                    "VirtualMachineTag_20230601120000000000",
+                ]
+            ),
+            drop_collection=mock.AsyncMock(),
+        )
+        get_database.return_value = mock.MagicMock(
+            __getitem__=mock.MagicMock(return_value=db)
+        )
+
+        await VirtualMachineCollection.drop_snapshots(["20230601130000000000"])
+
+        self.assertEqual(
+            [call[0][0] for call in db.drop_collection.await_args_list],
+            ["VirtualMachine", "VirtualMachine_20230601120000000000"],
+            "Only generations of the collection should be dropped",
+        )
+
+    @mock.patch(get_mock_path("MONGO_ARRAY_ELEMS_COUNT"), 2)
+    async def test_get_by_ids_is_chunked(self):
+        async def find(locator, projection):
+            for vm_id in locator["_id"]["$in"]:
+                yield {"_id": vm_id, "name": "", "tags": []}
+
+        collection = mock.MagicMock(find=mock.MagicMock(side_effect=find))
+        with mock.patch.object(
+            VirtualMachineCollection,
+            "get_layers",
+            mock.AsyncMock(return_value=[collection]),
+        ):
+            vms = await VirtualMachineCollection.get_by_ids(f"vm-{i}" for i in range(5))
+
+        self.assertEqual(list(vms), [f"vm-{i}" for i in range(5)])
+        self.assertEqual(
+            [call[0][0]["_id"]["$in"] for call in collection.find.call_args_list],
+            [["vm-0", "vm-1"], ["vm-2", "vm-3"], ["vm-4"]],
+            "$in is limited by count of elements",
+        )
+
+
+class LayeredCollectionTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+        self.db = DatabaseMock()
+        self.db["VirtualMachine_base"] = CollectionMock(
+            [{"_id": f"vm-{i}", "name": "base", "tags": ["t1"]} for i in range(4)]
+        )
+        self.db["VirtualMachine_layer"] = CollectionMock(
+            [
+                {"_id": "vm-1", "removed": True},
+                {"_id": "vm-2", "name": "layer", "tags": ["t2"]},
+                {"_id": "vm-5", "name": "layer", "tags": []},
+            ]
+        )
+        self.db["TagInfo_base"] = CollectionMock(
+            [
+                {"tag": "t1", "tagged_vm_ids": ["vm-0"], "tags_with_access": []},
+                {"tag": "t1", "tagged_vm_ids": ["vm-1"], "tags_with_access": []},
+                {"tag": "t2", "tagged_vm_ids": ["vm-0"], "tags_with_access": []},
+            ]
+        )
+        self.db["TagInfo_layer"] = CollectionMock(
+            [{"tag": "t1", "tagged_vm_ids": ["vm-3"], "tags_with_access": []}]
+        )
+        patcher = patch_database(self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.vm_collection = VirtualMachineCollection.for_snapshot("layer", "base")
+        self.tag_info_collection = TagInfoCollection.for_snapshot("layer", "base")
+
+    async def test_layer_shadows_base(self):
+        vms = await self.vm_collection.get_by_ids(["vm-0", "vm-1", "vm-2", "vm-5"])
+        all_vm_ids = [doc["_id"] async for doc in self.vm_collection.iter_layered()]
+        tags_info = await self.tag_info_collection.get_aggregated_tags_info(
+            ["t1", "t2"]
+        )
+
+        self.assertEqual(
+            {vm_id: vm.name for vm_id, vm in vms.items()},
+            {"vm-0": "base", "vm-2": "layer", "vm-5": "layer"},
+            "Removed vm-1 is shadowed",
+        )
+        self.assertEqual(sorted(all_vm_ids), ["vm-0", "vm-2", "vm-3", "vm-5"])
+        self.assertEqual(
+            await self.vm_collection.get_tags_by_ids(["vm-0", "vm-1"]),
+            {"vm-0": vms["vm-0"].tags},
+        )
+        self.assertEqual(await self.vm_collection.count_documents(), 4)
+        self.assertEqual(
+            {tag: info.tagged_vm_ids for tag, info in tags_info.items()},
+            {"t1": ["vm-3"], "t2": ["vm-0"]},
+            "All chunks of a tag are shadowed",
+        )
+
+    async def test_has_tagged_vm_ids(self):
+        self.assertTrue(
+            await self.tag_info_collection.has_tagged_vm_ids(["t1"], exclude="vm-0")
+        )
+        self.assertFalse(
+            await self.tag_info_collection.has_tagged_vm_ids(["t1"], exclude="vm-3"),
+            "vm-1 of the base is shadowed",
+        )
+        self.assertTrue(
+            await self.tag_info_collection.has_tagged_vm_ids(["t2"], exclude="vm-3")
+        )
+
+    async def test_aggregation_is_not_used_for_layers(self):
+        self.assertIsNone(await self.vm_collection.get_vm_ids_with_access_to_vm("vm-0"))
+
+    async def test_exposure_top(self):
+        self.db["Exposure_base"] = CollectionMock(
+            [
+                {"signature": "s1", "attackers_count": 5, "vm_ids": ["vm-1"]},
+                {"signature": "s2", "attackers_count": 3, "vm_ids": ["vm-3", "vm-2"]},
+                {"signature": "s3", "attackers_count": 1, "vm_ids": ["vm-4"]},
+            ]
+        )
+        self.db["Exposure_layer"] = CollectionMock(
+            [
+                {"signature": "s1", "removed": True},
+                {"signature": "s4", "attackers_count": 3, "vm_ids": ["vm-0"]},
+            ]
+        )
+        collection = ExposureCollection.for_snapshot("layer", "base")
+
+        self.assertEqual(
+            [(info.id, info.attackers_count) for info in await collection.get_top(2)],
+            [("vm-0", 3), ("vm-2", 3)],
+            "Shadowed s1 is skipped, ties are ordered by VM ID",
+        )
+        self.assertEqual(len(await collection.get_top(10)), 4)
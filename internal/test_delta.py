@@ -0,0 +1,147 @@
+from unittest import IsolatedAsyncioTestCase
+
+from .delta import apply_delta, calculate_delta
+from .models import VMInfo
+from .mongo_mock import CollectionMock, DatabaseMock, patch_database
+
+from .crud import (  # isort: skip
+    FirewallRuleCollection,
+    TagInfoCollection,
+    VirtualMachineCollection,
+)
+
+
+def get_vms(*vms: tuple[str, list[str]]) -> dict[str, VMInfo]:
+    return {vm_id: VMInfo(id=vm_id, name="", tags=tags) for vm_id, tags in vms}
+
+
+class DeltaTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+
+    def test_calculate_delta(self):
+        delta = calculate_delta(
+            old_vms=get_vms(("vm-1", ["t1"]), ("vm-2", ["t1", "t2"]), ("vm-3", ["t3"])),
+            new_vms=get_vms(("vm-2", ["t2", "t3"]), ("vm-3", ["t3"]), ("vm-4", ["t1"])),
+            old_rules={("t1", "t2"), ("t2", "t3")},
+            new_rules={("t2", "t3"), ("t3", "t1")},
+        )
+
+        self.assertEqual(delta.removed_vm_ids, ["vm-1"], "Removed VM")
+        self.assertEqual(
+            [vm.id for vm in delta.upserted_vms],
+            ["vm-2", "vm-4"],
+            "Changed and new VMs. Not changed VMs are skipped",
+        )
+        self.assertEqual(
+            dict(delta.removed_vm_ids_for_tag),
+            {"t1": ["vm-1", "vm-2"]},
+            "VMs which lost tags",
+        )
+        self.assertEqual(
+            dict(delta.added_vm_ids_for_tag),
+            {"t3": ["vm-2"], "t1": ["vm-4"]},
+            "VMs which got tags",
+        )
+        self.assertEqual(delta.removed_rules, {("t1", "t2")}, "Removed rule")
+        self.assertEqual(delta.added_rules, {("t3", "t1")}, "Added rule")
+        self.assertEqual(
+            dict(delta.removed_tags_with_access_for_tag),
+            {"t2": {"t1"}},
+            "Tags which lost access",
+        )
+        self.assertEqual(
+            dict(delta.added_tags_with_access_for_tag),
+            {"t1": {"t3"}},
+            "Tags which got access",
+        )
+        self.assertEqual(
+            dict(delta.removed_accessible_tags_for_tag),
+            {"t1": {"t2"}},
+            "Tags which lost accessible tags",
+        )
+        self.assertEqual(
+            dict(delta.added_accessible_tags_for_tag),
+            {"t3": {"t1"}},
+            "Tags which got accessible tags",
+        )
+
+    def test_calculate_delta_without_changes(self):
+        vms = get_vms(("vm-1", ["t1"]))
+
+        delta = calculate_delta(vms, dict(vms), {("t1", "t1")}, {("t1", "t1")})
+
+        self.assertFalse(delta, "Nothing should be changed")
+
+    async def test_apply_delta(self):
+        db = DatabaseMock()
+        db["VirtualMachine_base"] = CollectionMock(
+            [
+                {"_id": "vm-1", "name": "", "tags": ["t1", "t4"]},
+                {"_id": "vm-9", "name": "", "tags": ["t3"]},
+            ]
+        )
+        db["FirewallRule_base"] = CollectionMock(
+            [{"_id": "fw-0", "source_tag": "t1", "dest_tag": "t2"}]
+        )
+        db["TagInfo_base"] = CollectionMock(
+            [
+                {"tag": "t1", "tagged_vm_ids": ["vm-1"], "tags_with_access": []},
+                {"tag": "t1", "tagged_vm_ids": [], "accessible_tags": ["t2"]},
+                {"tag": "t2", "tagged_vm_ids": [], "tags_with_access": ["t1"]},
+                {"tag": "t3", "tagged_vm_ids": ["vm-9"], "tags_with_access": []},
+                {"tag": "t4", "tagged_vm_ids": ["vm-1"], "tags_with_access": []},
+            ]
+        )
+        delta = calculate_delta(
+            old_vms=get_vms(("vm-1", ["t1", "t4"])),
+            new_vms=get_vms(("vm-2", ["t1"])),
+            old_rules={("t1", "t2")},
+            new_rules={("t2", "t1")},
+        )
+
+        with patch_database(db):
+            affected_tags = await apply_delta(
+                "layer", "base", delta, rule_id_prefix="fw-1"
+            )
+            vms = await VirtualMachineCollection.for_snapshot(
+                "layer", "base"
+            ).get_by_ids(["vm-1", "vm-2", "vm-9"])
+            tags_info = await TagInfoCollection.for_snapshot(
+                "layer", "base"
+            ).get_aggregated_tags_info(
+                ["t1", "t2", "t3", "t4"],
+                fields=["tagged_vm_ids", "tags_with_access", "accessible_tags"],
+            )
+            rules = [
+                (doc["source_tag"], doc["dest_tag"])
+                async for doc in FirewallRuleCollection.for_snapshot(
+                    "layer", "base"
+                ).iter_layered({"source_tag": True})
+            ]
+
+        self.assertEqual(list(vms), ["vm-2", "vm-9"], "vm-1 is shadowed as removed")
+        self.assertEqual(
+            {
+                tag: (info.tagged_vm_ids, info.tags_with_access, info.accessible_tags)
+                for tag, info in tags_info.items()
+            },
+            {
+                "t1": (["vm-2"], ["t2"], []),
+                "t2": ([], [], ["t1"]),
+                "t3": (["vm-9"], [], []),
+            },
+            "TagInfo of touched tags is replaced, removed t4 is shadowed",
+        )
+        self.assertEqual(rules, [("t2", "t1")])
+        self.assertEqual(
+            db.get_docs("TagInfo_base", {"_id": False, "tag": True}),
+            [{"tag": "t1"}, {"tag": "t1"}, {"tag": "t2"}, {"tag": "t3"}, {"tag": "t4"}],
+            "Base is not changed",
+        )
+        self.assertNotIn(
+            "t3",
+            [doc["tag"] for doc in db.get_docs("TagInfo_layer")],
+            "Not touched tags are not copied",
+        )
+        self.assertEqual(affected_tags, {"t1", "t2"}, "Tags which attackers changed")
@@ -0,0 +1,138 @@
+from unittest import IsolatedAsyncioTestCase, mock
+
+from .crud import ExposureCollection
+from .delta import calculate_delta
+from .models import ExposureInfo, VMInfo
+from .tag_sets import get_tag_set_signature
+
+from .mongo_mock import (  # isort: skip
+    CollectionMock,
+    DatabaseMock,
+    get_collection_mock,
+    patch_database,
+)
+
+from .exposure import (  # isort: skip
+    add_exposure,
+    iter_tag_set_exposures,
+    update_exposure,
+)
+
+
+def get_mock_path(item: str) -> str:
+    return f"internal.exposure.{item}"
+
+
+VM_IDS_FOR_TAG_SET = {
+    ("t1",): ["vm-1", "vm-2"],
+    ("t2",): ["vm-3"],
+    ("t3",): ["vm-4"],
+    ("t1", "t3"): ["vm-5"],
+}
+TAGS_WITH_ACCESS_FOR_TAG = {"t1": {"t1"}, "t2": {"t1", "t3"}}
+
+
+class ExposureTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+
+    def test_tag_set_exposures(self):
+        result = iter_tag_set_exposures(VM_IDS_FOR_TAG_SET, TAGS_WITH_ACCESS_FOR_TAG)
+
+        self.assertEqual(
+            {tuple(exposure.tags): exposure.attackers_count for exposure in result},
+            {("t1",): 2, ("t2",): 4, ("t3",): 0, ("t1", "t3"): 2},
+            "VM is not its own attacker",
+        )
+
+    @mock.patch(get_mock_path("ExposureCollection"), new_callable=get_collection_mock)
+    async def test_add_exposure(self, exposure_collection):
+        await add_exposure(
+            "snapshot", {("t1",): ["vm-1"], ("t2",): ["vm-2"]}, {"t2": {"t1"}}
+        )
+
+        exposure_collection.for_snapshot.assert_called_with("snapshot")
+        exposure_collection.create_indexes.assert_awaited_once()
+        exposure_collection.insert_many.assert_awaited_once_with(
+            [
+                {
+                    "signature": get_tag_set_signature(["t1"]),
+                    "tags": ["t1"],
+                    "attackers_count": 0,
+                    "vm_ids": ["vm-1"],
+                },
+                {
+                    "signature": get_tag_set_signature(["t2"]),
+                    "tags": ["t2"],
+                    "attackers_count": 1,
+                    "vm_ids": ["vm-2"],
+                },
+            ],
+            ordered=False,
+        )
+
+    async def test_update_exposure(self):
+        signature_1 = get_tag_set_signature(["t1"])
+        signature_2 = get_tag_set_signature(["t2"])
+        db = DatabaseMock()
+        db["Exposure_base"] = CollectionMock(
+            [
+                {
+                    "signature": signature_1,
+                    "tags": ["t1"],
+                    "attackers_count": 0,
+                    "vm_ids": ["vm-1", "vm-2"],
+                },
+                {
+                    "signature": signature_2,
+                    "tags": ["t2"],
+                    "attackers_count": 2,
+                    "vm_ids": ["vm-3"],
+                },
+            ]
+        )
+        db["TagInfo_layer"] = CollectionMock(
+            [
+                {"tag": "t1", "tagged_vm_ids": ["vm-1"], "tags_with_access": []},
+                {
+                    "tag": "t2",
+                    "tagged_vm_ids": ["vm-3", "vm-2"],
+                    "tags_with_access": [],
+                },
+                {"tag": "t2", "tagged_vm_ids": [], "tags_with_access": ["t1"]},
+            ]
+        )
+        old_vms = {"vm-2": VMInfo(id="vm-2", name="", tags=["t1"])}
+        delta = calculate_delta(
+            old_vms, {"vm-2": VMInfo(id="vm-2", name="", tags=["t2"])}, set(), set()
+        )
+
+        with patch_database(db):
+            await update_exposure("layer", "base", delta, old_vms, {"t2"})
+            top = await ExposureCollection.for_snapshot("layer", "base").get_top(10)
+
+        self.assertEqual(
+            db.get_docs("Exposure_layer", {"_id": False}),
+            [
+                {
+                    "signature": signature_2,
+                    "tags": ["t2"],
+                    "attackers_count": 1,
+                    "vm_ids": ["vm-3", "vm-2"],
+                },
+                {
+                    "signature": signature_1,
+                    "tags": ["t1"],
+                    "attackers_count": 0,
+                    "vm_ids": ["vm-1"],
+                },
+            ],
+            "Tag sets with affected tags and of moved VMs are written to the layer",
+        )
+        self.assertEqual(
+            top,
+            [
+                ExposureInfo(id="vm-2", attackers_count=1),
+                ExposureInfo(id="vm-3", attackers_count=1),
+            ],
+        )
@@ -1,20 +1,13 @@
-from unittest import IsolatedAsyncioTestCase, mock
+from io import StringIO
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
 
 from parameterized import parameterized
 from pydantic import ValidationError
 
-from .extractor import get_cloud_environment
+from .extractor import get_cloud_environment, iter_cloud_environment_from_file
 from .models import CloudEnvironment, FirewallRule, VMInfo
 
-
-class ExtractorTestCase(IsolatedAsyncioTestCase):
-    async def asyncSetUp(self) -> None:
-        self.longMessage = True
-
-    @mock.patch(
-        "builtins.open",
-        new=mock.mock_open(
-            read_data="""{
+VALID_CLOUD_ENVIRONMENT = """{
     "vms": [
         {
             "vm_id": "vm-a211de",
@@ -41,7 +34,86 @@ class ExtractorTestCase(IsolatedAsyncioTestCase):
         }
     ]
 }"""
-        ),
+
+INVALID_CLOUD_ENVIRONMENTS = (
+    (
+        "Valid JSON with incorrect schema",
+        """
+            {
+                "additional_field": [],
+                "vms": [],
+                "fw_rules": []
+            }""",
+    ),
+    (
+        "Valid JSON with incorrect schema for inner models",
+        """
+            {
+                "vms": [{
+                        "vm_id": "id1",
+                        "name": "n1",
+                        "tags": [
+                        ],
+                        "problemfield": []
+                    }],
+                "fw_rules": []
+            }""",
+    ),
+    (
+        "VM IDs should be unique",
+        """
+            {
+                "vms": [],
+                "fw_rules": [
+                    {
+                    "fw_id": "id1",
+                    "source_tag": "ssh",
+                    "dest_tag": "dev"
+                },
+                {
+                    "fw_id": "id1",
+                    "source_tag": "ssh",
+                    "dest_tag": "dev"
+                }
+                ]
+            }""",
+    ),
+    (
+        "Firewall Rule IDs should be unique",
+        """
+            {
+                "vms": [
+                    {
+                        "vm_id": "vm1",
+                        "name": "n1",
+                        "tags": []
+                    },
+                    {
+                        "vm_id": "vm1",
+                        "name": "n1_1",
+                        "tags": []
+                    }
+                ],
+                "fw_rules": []
+            }""",
+    ),
+    (
+        "Invalid JSON",
+        """
+            {{
+                "fw_rules": []
+            }""",
+    ),
+)
+
+
+class ExtractorTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+
+    @mock.patch(
+        "builtins.open",
+        new=mock.mock_open(read_data=VALID_CLOUD_ENVIRONMENT),
         create=True,
     )
     async def test_extractor_positive(self):
@@ -59,78 +131,7 @@ class ExtractorTestCase(IsolatedAsyncioTestCase):
             "Valid JSON with valid models",
         )
 
-    @parameterized.expand(
-        (
-            (
-                "Valid JSON with incorrect schema",
-                """
-                    {
-                        "additional_field": [],
-                        "vms": [],
-                        "fw_rules": []
-                    }""",
-            ),
-            (
-                "Valid JSON with incorrect schema for inner models",
-                """
-                    {
-                        "vms": [{
-                                "vm_id": "id1",
-                                "name": "n1",
-                                "tags": [
-                                ],
-                                "problemfield": []
-                            }],
-                        "fw_rules": []
-                    }""",
-            ),
-            (
-                "VM IDs should be unique",
-                """
-                    {
-                        "vms": [],
-                        "fw_rules": [
-                            {
-                            "fw_id": "id1",
-                            "source_tag": "ssh",
-                            "dest_tag": "dev"
-                        },
-                        {
-                            "fw_id": "id1",
-                            "source_tag": "ssh",
-                            "dest_tag": "dev"
-                        }
-                        ]
-                    }""",
-            ),
-            (
-                "Firewall Rule IDs should be unique",
-                """
-                    {
-                        "vms": [
-                            {
-                                "vm_id": "vm1",
-                                "name": "n1",
-                                "tags": []
-                            },
-                            {
-                                "vm_id": "vm1",
-                                "name": "n1_1",
-                                "tags": []
-                            }
-                        ],
-                        "fw_rules": []
-                    }""",
-            ),
-            (
-                "Invalid JSON",
-                """
-                    {{
-                        "fw_rules": []
-                    }""",
-            ),
-        )
-    )
+    @parameterized.expand(INVALID_CLOUD_ENVIRONMENTS)
     async def test_extractor_validators(self, reason, file_content):
         with mock.patch(
             "builtins.open",
@@ -139,3 +140,76 @@ class ExtractorTestCase(IsolatedAsyncioTestCase):
         ):
             with self.assertRaises(ValidationError, msg=reason):
                 await get_cloud_environment()
+
+
+class StreamingExtractorTestCase(TestCase):
+    def setUp(self) -> None:
+        self.longMessage = True
+
+    @parameterized.expand(((1,), (7,), (1 << 16,)))
+    def test_streaming_extractor_positive(self, chunk_size):
+        result = list(
+            iter_cloud_environment_from_file(
+                StringIO(VALID_CLOUD_ENVIRONMENT), batch_size=1, chunk_size=chunk_size
+            )
+        )
+
+        self.assertEqual(
+            result,
+            [
+                (
+                    "machines",
+                    [VMInfo(id="vm-a211de", name="jira_server", tags=["ci", "dev"])],
+                ),
+                (
+                    "machines",
+                    [VMInfo(id="vm-c7bac01a07", name="bastion", tags=["ssh", "dev"])],
+                ),
+                (
+                    "rules",
+                    [FirewallRule(id="fw-82af742", source_tag="ssh", dest_tag="dev")],
+                ),
+            ],
+            "Valid JSON is returned in batches with valid models",
+        )
+
+    @parameterized.expand(INVALID_CLOUD_ENVIRONMENTS)
+    def test_streaming_extractor_validators(self, reason, file_content):
+        with self.assertRaises(ValidationError, msg=reason):
+            list(
+                iter_cloud_environment_from_file(
+                    StringIO(file_content), batch_size=1, chunk_size=7
+                )
+            )
+
+    def test_streaming_extractor_error_matches_parse_raw(self):
+        file_content = INVALID_CLOUD_ENVIRONMENTS[3][1]
+        with self.assertRaises(ValidationError) as expected:
+            CloudEnvironment.parse_raw(file_content)
+        with self.assertRaises(ValidationError) as streamed:
+            list(iter_cloud_environment_from_file(StringIO(file_content), batch_size=1))
+
+        self.assertEqual(
+            str(streamed.exception),
+            str(expected.exception),
+            "Streaming mode should report problems the same way",
+        )
+
+    @parameterized.expand(
+        (
+            ("Invalid value", "[1, x"),
+            ("Invalid number", "[1.x"),
+            ("Control character in a string", '["a\x01'),
+        )
+    )
+    def test_streaming_extractor_stops_on_invalid_value(self, reason, value):
+        f = StringIO(
+            '{"vms": [{"vm_id": "vm-1", "name": "", "tags": '
+            + value
+            + " " * 10000
+            + "]}]}"
+        )
+
+        with self.assertRaises(ValidationError, msg=reason):
+            list(iter_cloud_environment_from_file(f, batch_size=1, chunk_size=7))
+        self.assertLess(f.tell(), 100, "The rest of the file should not be read")
@@ -0,0 +1,248 @@
+import threading
+from unittest import IsolatedAsyncioTestCase, mock
+
+from parameterized import parameterized
+
+from .graph import AttackGraph, AttackGraphLoader
+from .models import ServiceStatusModel
+
+VMS = [
+    ("vm-1", ["tag-1_0"]),
+    ("vm-2", ["tag-1_1", "tag-2_0"]),
+    ("vm-3", ["tag-2_1"]),
+    ("vm-4", ["tag-3_0", "tag-3_1"]),
+    ("vm-5", ["tag-3_2"]),
+    ("vm-6", ["tag-3_3"]),
+    ("vm-7", ["tag-4_0", "tag-4_1"]),
+    ("vm-8", ["tag-4_1"]),
+]
+
+RULES = [
+    ("tag-1_1", "tag-1_0"),
+    ("tag-2_1", "tag-2_0"),
+    ("tag-2_1", "tag-2_0"),
+    ("tag-3_2", "tag-3_0"),
+    ("tag-3_3", "tag-3_1"),
+    ("tag-4_1", "tag-4_0"),
+]
+
+# vm-b -> vm-a, vm-c / vm-f -> vm-b, vm-d -> vm-c / vm-e, vm-a -> vm-d
+CHAIN_VMS = [
+    ("vm-a", ["t-a"]),
+    ("vm-b", ["t-b"]),
+    ("vm-c", ["t-c", "t-x"]),
+    ("vm-d", ["t-d"]),
+    ("vm-e", ["t-x"]),
+    ("vm-f", ["t-c"]),
+]
+
+CHAIN_RULES = [
+    ("t-b", "t-a"),
+    ("t-c", "t-b"),
+    ("t-d", "t-x"),
+    ("t-a", "t-d"),
+]
+
+
+def get_mock_path(item: str) -> str:
+    return f"internal.graph.{item}"
+
+
+def get_aiter_mock(items):
+    async def aiter_items(*args, **kwargs):
+        for item in items:
+            yield item
+
+    return aiter_items
+
+
+class AttackGraphTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+
+    @parameterized.expand(
+        (
+            ("Simple test", "vm-1", {"vm-2"}),
+            (
+                "Few Firewall rules have the same tags (IDs are different)",
+                "vm-2",
+                {"vm-3"},
+            ),
+            ("Specified VM has few tags", "vm-4", {"vm-5", "vm-6"}),
+            (
+                "Attacked VM has tag which is in danger. We don't need to show attacked VM",
+                "vm-7",
+                {"vm-8"},
+            ),
+            ("VM without tags in danger", "vm-8", set()),
+            ("VM ID is incorrect. No VMs are in danger", "unknown_vm_id", set()),
+        )
+    )
+    def test_graph_with_different_vms(self, reason, vm_id, expected_vm_ids):
+        graph = AttackGraph.build(reversed(VMS), RULES)
+
+        result = graph.get_vm_ids_with_access_to_vm(vm_id)
+
+        self.assertEqual(set(result), expected_vm_ids, reason)
+        self.assertEqual(len(result), len(expected_vm_ids), "IDs should be unique")
+
+    @parameterized.expand(
+        (
+            ("Simple test", "vm-2", {"vm-1"}),
+            ("Specified VM has access to few VMs", "vm-3", {"vm-2"}),
+            ("Tag of VM is accessible by itself", "vm-8", {"vm-7"}),
+            ("VM without accessible tags", "vm-1", set()),
+            ("VM ID is incorrect", "unknown_vm_id", set()),
+        )
+    )
+    def test_graph_targets(self, reason, vm_id, expected_vm_ids):
+        graph = AttackGraph.build(VMS, RULES)
+
+        result = graph.get_vm_ids_accessible_from_vm(vm_id)
+
+        self.assertEqual(set(result), expected_vm_ids, reason)
+        self.assertEqual(len(result), len(expected_vm_ids), "IDs should be unique")
+
+    @parameterized.expand(
+        (
+            ("One hop is the same as /attack", "vm-a", 1, {"vm-b": 1}),
+            ("Two hops", "vm-a", 2, {"vm-b": 1, "vm-c": 2, "vm-f": 2}),
+            (
+                "All hops, attacked VM is not shown in cycle",
+                "vm-a",
+                10,
+                {"vm-b": 1, "vm-c": 2, "vm-f": 2, "vm-d": 3},
+            ),
+            ("Not attacked VM", "vm-f", 10, {}),
+            ("VM ID is incorrect", "unknown_vm_id", 10, {}),
+        )
+    )
+    def test_graph_paths(self, reason, vm_id, max_depth, expected_distances):
+        graph = AttackGraph.build(CHAIN_VMS, CHAIN_RULES)
+
+        result = graph.get_vm_distances_with_access_to_vm(vm_id, max_depth)
+
+        self.assertEqual(result, expected_distances, reason)
+
+    def test_graph_iter_after(self):
+        graph = AttackGraph.build(VMS, RULES + [("tag-1_0", "tag-1_0")])
+
+        self.assertEqual(
+            list(graph.iter_vm_ids_with_access_to_vm("vm-1")),
+            ["vm-2"],
+            "Attacked VM should not be shown",
+        )
+        self.assertEqual(
+            list(graph.iter_vm_ids_with_access_to_vm("vm-4")), ["vm-5", "vm-6"]
+        )
+        self.assertEqual(
+            list(graph.iter_vm_ids_with_access_to_vm("vm-4", after="vm-5")), ["vm-6"]
+        )
+        self.assertEqual(
+            list(graph.iter_vm_ids_with_access_to_vm("vm-4", after="vm-6")), []
+        )
+        self.assertEqual(list(graph.iter_vm_ids_with_access_to_vm("unknown")), [])
+
+    def test_graph_iter_merges_tags(self):
+        graph = AttackGraph.build(
+            [
+                ("vm-1", ["t-1", "t-2"]),
+                ("vm-2", ["s-1", "s-2"]),
+                ("vm-3", ["s-1"]),
+                ("vm-4", ["s-2", "t-1"]),
+            ],
+            [("s-1", "t-1"), ("s-2", "t-2"), ("t-1", "t-1")],
+        )
+
+        self.assertEqual(
+            list(graph.iter_vm_ids_with_access_to_vm("vm-1")),
+            ["vm-2", "vm-3", "vm-4"],
+            "VM of few tags with access is produced once",
+        )
+        self.assertEqual(
+            list(graph.iter_vm_ids_with_access_to_vm("vm-1", after="vm-2")),
+            ["vm-3", "vm-4"],
+        )
+
+    @parameterized.expand(
+        (
+            ("Simple test", "vm-1", 1),
+            ("Specified VM has few tags", "vm-4", 2),
+            ("Attacked VM is the only VM with tag in danger", "vm-3", 0),
+            ("Attacked VM has tag which is in danger", "vm-7", 1),
+            ("VM ID is incorrect", "unknown_vm_id", 0),
+        )
+    )
+    def test_graph_count_and_exists(self, reason, vm_id, expected_count):
+        graph = AttackGraph.build(VMS, RULES + [("tag-2_1", "tag-2_1")])
+
+        self.assertEqual(
+            graph.count_vm_ids_with_access_to_vm(vm_id), expected_count, reason
+        )
+        self.assertEqual(
+            graph.has_vm_ids_with_access_to_vm(vm_id), expected_count > 0, reason
+        )
+
+    def test_tag_vms(self):
+        graph = AttackGraph.build(reversed(VMS), RULES)
+
+        tag_vms = {
+            tag: [graph.vm_ids[vm] for vm in graph.tag_vms[i]]
+            for i, tag in enumerate(graph.tags)
+        }
+
+        self.assertEqual(tag_vms["tag-4_1"], ["vm-7", "vm-8"], "VMs are sorted")
+        self.assertEqual(tag_vms["tag-1_0"], ["vm-1"])
+        self.assertEqual(
+            sum(len(vms) for vms in graph.tag_vms),
+            sum(len(tags) for _, tags in VMS),
+            "Only VMs of every tag are kept",
+        )
+
+    @mock.patch(get_mock_path("FirewallRuleCollection"))
+    @mock.patch(get_mock_path("VirtualMachineCollection"))
+    @mock.patch(get_mock_path("StatusCollection"))
+    async def test_loader(self, status_collection, vm_collection, fw_collection):
+        status_collection.get_active_status = mock.AsyncMock(
+            return_value=ServiceStatusModel(
+                snapshot="s1", revision=1, base_snapshot="s0"
+            )
+        )
+        vm_collection.for_snapshot.return_value.iter_layered = get_aiter_mock(
+            [{"_id": vm_id, "tags": tags} for vm_id, tags in VMS]
+        )
+        fw_collection.for_snapshot.return_value.iter_layered = get_aiter_mock(
+            [{"source_tag": source, "dest_tag": dest} for source, dest in RULES]
+        )
+        loader = AttackGraphLoader()
+        build_threads = []
+        build = AttackGraph.build
+
+        def build_in_thread(*args):
+            build_threads.append(threading.current_thread())
+            return build(*args)
+
+        with mock.patch.object(AttackGraph, "build", build_in_thread):
+            self.assertIsNone(
+                await loader.get_graph(),
+                "Graph is loaded in background, use DB for now",
+            )
+            await loader.loading
+        graph = await loader.get_graph()
+
+        self.assertNotIn(
+            threading.current_thread(),
+            build_threads,
+            "Graph is built outside of the event loop thread",
+        )
+
+        vm_collection.for_snapshot.assert_called_once_with("s1", "s0")
+        self.assertEqual(graph.version, ("s1", 1), "Graph for active snapshot")
+        self.assertEqual(graph.get_vm_ids_with_access_to_vm("vm-1"), ["vm-2"])
+
+        status_collection.get_active_status.return_value = ServiceStatusModel(
+            snapshot="s1", revision=2, base_snapshot="s0"
+        )
+        self.assertIsNone(
+            await loader.get_graph(), "Graph for old revision should not be used"
+        )
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from .histogram import LatencyHistogram
+
+
+class LatencyHistogramTestCase(TestCase):
+    def setUp(self) -> None:
+        self.longMessage = True
+
+    def assertAlmostEqualRelative(self, value, expected, msg=None):
+        self.assertLessEqual(abs(value - expected), expected * 0.025, msg)
+
+    def test_quantiles(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 1001):
+            histogram.add(ms / 1000)
+
+        info = histogram.info()
+
+        self.assertEqual(info.count, 1000)
+        self.assertAlmostEqualRelative(info.p50, 0.5, "p50 within bucket precision")
+        self.assertAlmostEqualRelative(info.p95, 0.95)
+        self.assertAlmostEqualRelative(info.p99, 0.99)
+        self.assertEqual(info.max, 1, "Max is exact")
+        self.assertAlmostEqual(histogram.sum, 500.5)
+
+    def test_empty(self):
+        info = LatencyHistogram().info()
+
+        self.assertEqual((info.count, info.p50, info.max), (0, 0, 0))
+
+    def test_tiny_durations(self):
+        histogram = LatencyHistogram()
+        histogram.add(0)
+
+        self.assertEqual(histogram.quantile(0.5), 0, "Not more than max")
+
+    def test_merge_is_the_same_as_one_histogram(self):
+        one, first, second = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+        for i in range(1, 101):
+            one.add(i / 100)
+            (first if i % 2 else second).add(i / 100)
+
+        first.merge(second)
+
+        self.assertEqual(first.info(), one.info())
+        self.assertEqual(dict(first.buckets), dict(one.buckets))
+
+    def test_db_round_trip(self):
+        histogram = LatencyHistogram()
+        histogram.add(0.01)
+        histogram.add(0.2)
+
+        update = histogram.to_update()
+        doc = {
+            "count": update["$inc"]["count"],
+            "sum": update["$inc"]["sum"],
+            "min": update["$min"]["min"],
+            "max": update["$max"]["max"],
+            "buckets": {
+                key.split(".")[1]: count
+                for key, count in update["$inc"].items()
+                if key.startswith("buckets.")
+            },
+        }
+        restored = LatencyHistogram.from_db(doc)
+
+        self.assertEqual(restored.info(), histogram.info())
+        self.assertEqual(dict(restored.buckets), dict(histogram.buckets))
+        self.assertEqual((restored.min, restored.sum), (0.01, histogram.sum))
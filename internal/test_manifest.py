@@ -0,0 +1,110 @@
+from unittest import IsolatedAsyncioTestCase, mock
+
+from pymongo import ReplaceOne
+
+from .manifest import Manifest, get_manifest_changes, update_manifest
+from .models import VMInfo
+
+
+def get_mock_path(item: str) -> str:
+    return f"internal.manifest.{item}"
+
+
+def get_manifest(vms: dict[str, list[str]], rules: set[tuple[str, str]], buckets=4):
+    manifest = Manifest(buckets)
+    for vm_id, tags in vms.items():
+        manifest.add_vm(VMInfo(id=vm_id, name="", tags=tags))
+    for rule in rules:
+        manifest.add_rule(rule)
+    return manifest
+
+
+def get_collection_mock(manifest: Manifest):
+    documents = {
+        bucket_id: manifest.get_document(bucket_id)
+        for bucket_id in manifest.get_bucket_ids()
+    }
+    collection = mock.MagicMock(
+        get_digests=mock.AsyncMock(
+            return_value={
+                bucket_id: document["digest"]
+                for bucket_id, document in documents.items()
+            }
+        ),
+        get_items=mock.AsyncMock(
+            side_effect=lambda bucket_ids: {
+                bucket_id: documents[bucket_id]["items"]
+                for bucket_id in bucket_ids
+                if bucket_id in documents
+            }
+        ),
+        bulk_write=mock.AsyncMock(),
+    )
+    collection.for_snapshot.return_value = collection
+    return collection
+
+
+OLD_VMS = {f"vm-{i}": ["t1"] for i in range(100)}
+OLD_RULES = {("t1", "t2"), ("t2", "t3")}
+
+
+class ManifestTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+
+    async def test_changes(self):
+        collection = get_collection_mock(get_manifest(OLD_VMS, OLD_RULES))
+        new_vms = dict(OLD_VMS, **{"vm-1": ["t2"], "vm-100": ["t1"]})
+        del new_vms["vm-2"]
+        manifest = get_manifest(new_vms, {("t1", "t2"), ("t3", "t1")})
+
+        with mock.patch(get_mock_path("ManifestCollection"), collection):
+            changes = await get_manifest_changes("snapshot", "base", manifest)
+
+        collection.for_snapshot.assert_called_once_with("snapshot", "base")
+        self.assertEqual(changes.old_vm_ids, ["vm-1", "vm-2"], "Changed and removed")
+        self.assertEqual(changes.new_vm_ids, ["vm-1", "vm-100"], "Changed and added")
+        self.assertEqual(changes.old_rules - changes.new_rules, {("t2", "t3")})
+        self.assertEqual(changes.new_rules - changes.old_rules, {("t3", "t1")})
+        read_bucket_ids = collection.get_items.await_args[0][0]
+        self.assertEqual(read_bucket_ids, changes.bucket_ids)
+        self.assertLess(
+            len(read_bucket_ids),
+            len(manifest.get_bucket_ids()),
+            "Only changed buckets are read",
+        )
+
+    async def test_changes_after_buckets_count_is_changed(self):
+        collection = get_collection_mock(get_manifest(OLD_VMS, OLD_RULES, buckets=4))
+        manifest = get_manifest(dict(OLD_VMS, **{"vm-1": ["t2"]}), OLD_RULES, buckets=8)
+
+        with mock.patch(get_mock_path("ManifestCollection"), collection):
+            changes = await get_manifest_changes("snapshot", "base", manifest)
+
+        self.assertEqual(
+            (changes.old_vm_ids, changes.new_vm_ids, changes.old_rules),
+            (["vm-1"], ["vm-1"], changes.new_rules),
+            "All buckets are compared item by item",
+        )
+
+    async def test_update_manifest(self):
+        collection = get_collection_mock(Manifest())
+        manifest = get_manifest({"vm-1": ["t1"]}, set())
+        (bucket_id,) = manifest.get_bucket_ids()
+
+        with mock.patch(get_mock_path("ManifestCollection"), collection):
+            await update_manifest("snapshot", manifest, [bucket_id, "rules-4-0"])
+
+        collection.bulk_write.assert_awaited_once_with(
+            [
+                ReplaceOne(
+                    {"_id": bucket_id}, manifest.get_document(bucket_id), upsert=True
+                ),
+                ReplaceOne(
+                    {"_id": "rules-4-0"},
+                    {"_id": "rules-4-0", "removed": True},
+                    upsert=True,
+                ),
+            ],
+            ordered=False,
+        )
@@ -0,0 +1,113 @@
+from unittest import IsolatedAsyncioTestCase, mock
+
+import bson
+
+from .crud import MaterializedAttackCollection
+
+from .mongo_mock import (  # isort: skip
+    CollectionMock,
+    DatabaseMock,
+    get_collection_mock,
+    patch_database,
+)
+
+from .materialize import (  # isort: skip
+    add_materialized_attacks,
+    get_hot_vm_ids,
+    update_materialized_attacks,
+)
+
+
+def get_mock_path(item: str) -> str:
+    return f"internal.materialize.{item}"
+
+
+class MaterializeTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+
+    @mock.patch(get_mock_path("ResponseInfoCollection"))
+    async def test_hot_vm_ids(self, response_info_collection):
+        response_info_collection.get_top_params = mock.AsyncMock(
+            return_value=["vm_id=vm-2", "vm_id=vm-1", "", "vm_id=vm-2&x=1"]
+        )
+
+        result = await get_hot_vm_ids()
+
+        self.assertEqual(
+            result, ["vm-2", "vm-1"], "Unique VM IDs, the most requested first"
+        )
+        self.assertEqual(
+            response_info_collection.get_top_params.await_args[0][0], "/attack"
+        )
+
+    @mock.patch(
+        get_mock_path("MaterializedAttackCollection"), new_callable=get_collection_mock
+    )
+    async def test_add_materialized_attacks(self, materialized_attack_collection):
+        vm_ids_for_tag = {"t1": ["vm-1", "vm-2"], "t2": ["vm-3"]}
+        tags_with_access_for_tag = {"t1": {"t1"}, "t2": {"t1"}}
+        doc_size = len(bson.encode({"_id": "vm-1", "attacker_vm_ids": ["vm-2"]}))
+
+        with mock.patch(get_mock_path("MATERIALIZE_MAX_BYTES"), doc_size * 2):
+            await add_materialized_attacks(
+                "snapshot",
+                [("vm-1", ["t1"]), ("vm-3", ["t2"]), ("vm-2", ["t1"])],
+                vm_ids_for_tag,
+                tags_with_access_for_tag,
+            )
+
+        materialized_attack_collection.for_snapshot.assert_called_once_with("snapshot")
+        materialized_attack_collection.insert_many.assert_awaited_once_with(
+            [
+                {"_id": "vm-1", "attacker_vm_ids": ["vm-2"]},
+                {"_id": "vm-2", "attacker_vm_ids": ["vm-1"]},
+            ],
+            ordered=False,
+        )
+
+    async def test_update_materialized_attacks(self):
+        db = DatabaseMock()
+        db["MaterializedAttack_base"] = CollectionMock(
+            [
+                {"_id": vm_id, "attacker_vm_ids": ["old"]}
+                for vm_id in ("vm-1", "vm-2", "vm-5")
+            ]
+        )
+        db["VirtualMachine_base"] = CollectionMock(
+            [
+                {"_id": "vm-1", "name": "", "tags": ["t1"]},
+                {"_id": "vm-2", "name": "", "tags": ["t2"]},
+                {"_id": "vm-5", "name": "", "tags": ["t1"]},
+            ]
+        )
+        db["VirtualMachine_layer"] = CollectionMock([{"_id": "vm-5", "removed": True}])
+        db["TagInfo_base"] = CollectionMock(
+            [
+                {"tag": "t1", "tagged_vm_ids": ["vm-1"], "tags_with_access": ["t3"]},
+                {
+                    "tag": "t3",
+                    "tagged_vm_ids": ["vm-3", "vm-1"],
+                    "tags_with_access": [],
+                },
+            ]
+        )
+
+        with patch_database(db):
+            await update_materialized_attacks("layer", "base", ["vm-5"], {"t1"})
+            collection = MaterializedAttackCollection.for_snapshot("layer", "base")
+            attacker_vm_ids = {
+                vm_id: await collection.get_attacker_vm_ids(vm_id)
+                for vm_id in ("vm-1", "vm-2", "vm-5")
+            }
+
+        self.assertEqual(
+            attacker_vm_ids,
+            {"vm-1": ["vm-3"], "vm-2": ["old"], "vm-5": None},
+            "Only VMs with affected tags are calculated again, removed VMs are not "
+            "materialized",
+        )
+        self.assertEqual(
+            [doc["_id"] for doc in db.get_docs("MaterializedAttack_layer")],
+            ["vm-1", "vm-5"],
+        )
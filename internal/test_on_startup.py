@@ -1,32 +1,70 @@
 from unittest import IsolatedAsyncioTestCase, mock
 
-from .models import CloudEnvironment, FirewallRule, VMInfo
-from .on_startup import prepare_server
+from .manifest import ManifestChanges
+from .models import CloudEnvironment, FirewallRule, ServiceStatusModel, VMInfo
+
+from .on_startup import (  # isort: skip
+    SNAPSHOT_LAYOUT,
+    prepare_server,
+    save_cloud_environment_delta,
+)
 
 
 def get_mock_path(item: str) -> str:
     return f"internal.on_startup.{item}"
 
 
-def get_aiter_mock(return_value):
-    async_mock = mock.AsyncMock()
-    async_mock.__aiter__.return_value = return_value
-    return async_mock
+def get_collection_mock():
+    return mock.MagicMock(
+        create_index=mock.AsyncMock(),
+        create_indexes=mock.AsyncMock(),
+        delete_legacy=mock.AsyncMock(),
+        delete_many=mock.AsyncMock(),
+        drop_snapshots=mock.AsyncMock(),
+        insert_many=mock.AsyncMock(),
+        has_vm_count=mock.AsyncMock(return_value=True),
+        set_vm_count=mock.AsyncMock(),
+    )
+
+
+RULE_TAGS = [
+    ("tag-1_1", "tag-1_0"),
+    ("tag-2_1", "tag-2_0"),
+    ("tag-3_2", "tag-3_0"),
+    ("tag-3_3", "tag-3_1"),
+    ("tag-4_1", "tag-4_0"),
+]
 
 
 class DBOnStartupTestCase(IsolatedAsyncioTestCase):
     async def asyncSetUp(self) -> None:
         self.longMessage = True
+        for item, new in (
+            ("ManifestCollection", get_collection_mock()),
+            ("add_manifest", mock.AsyncMock()),
+        ):
+            patcher = mock.patch(get_mock_path(item), new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     @mock.patch(get_mock_path("connect_to_mongo"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ROLLUP_COLLECTIONS"), (get_collection_mock(),))
+    @mock.patch(get_mock_path("add_exposure"), mock.AsyncMock())
     @mock.patch(get_mock_path("get_cloud_environment"))
     @mock.patch(get_mock_path("FirewallRuleCollection"))
     @mock.patch(get_mock_path("VirtualMachineCollection"))
     @mock.patch(get_mock_path("StatusCollection"))
     @mock.patch(get_mock_path("TagInfoCollection"))
     @mock.patch(get_mock_path("ResponseInfoCollection"))
+    @mock.patch(get_mock_path("TagSetCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("MaterializedAttackCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ExposureCollection"), get_collection_mock())
+    @mock.patch(
+        get_mock_path("ServiceCountersCollection"), new_callable=get_collection_mock
+    )
     async def test(
         self,
+        service_counters_collection,
         response_info_collection,
         tag_info_collection,
         status_collection,
@@ -59,8 +97,6 @@ class DBOnStartupTestCase(IsolatedAsyncioTestCase):
                 {"vm_id": "vm-8", "name": "", "tags": ["tag-4_1"]},
             ]
         }
-        vm_collection.get_all_iter.return_value = get_aiter_mock(list(vm_dict.values()))
-        vm_collection.get_by_id = mock.AsyncMock(side_effect=lambda id: vm_dict.get(id))
 
         fw_rule_dict = {
             obj["fw_id"]: FirewallRule.parse_obj(obj)
@@ -98,39 +134,73 @@ class DBOnStartupTestCase(IsolatedAsyncioTestCase):
             ]
         }
 
-        fw_collection.get_all_iter.return_value = get_aiter_mock(
-            list(fw_rule_dict.values())
+        cloud_environment_mock.return_value = CloudEnvironment(
+            machines=list(vm_dict.values()), rules=list(fw_rule_dict.values())
         )
-        fw_collection.get_by_id = mock.AsyncMock(
-            side_effect=lambda id: fw_rule_dict.get(id)
-        )
-
-        cloud_environment_mock.return_value = mock.AsyncMock(
-            return_value=CloudEnvironment(
-                machines=list(vm_dict.values()), rules=list(fw_rule_dict.values())
-            )
+        for collection in (vm_collection, fw_collection, tag_info_collection):
+            collection.for_snapshot.return_value = collection
+            collection.insert_many = mock.AsyncMock()
+            collection.drop_snapshots = mock.AsyncMock()
+            collection.create_indexes = mock.AsyncMock()
+        status_collection.get_status = mock.AsyncMock(
+            return_value=ServiceStatusModel(ok=True, snapshot="old")
         )
-        vm_collection.rewrite = mock.AsyncMock()
-        fw_collection.rewrite = mock.AsyncMock()
-        status_collection.delete_many = mock.AsyncMock()
         status_collection.rewrite = mock.AsyncMock()
+        response_info_collection.create_indexes = mock.AsyncMock()
+        response_info_collection.delete_legacy = mock.AsyncMock()
         response_info_collection.delete_many = mock.AsyncMock()
-        tag_info_collection.delete_many = mock.AsyncMock()
-        tag_info_insert_one = mock.AsyncMock()
-        tag_info_collection.get_collection = mock.AsyncMock(
-            return_value=mock.AsyncMock(insert_one=tag_info_insert_one)
-        )
 
         await prepare_server()
 
-        vm_collection.rewrite.assert_awaited_once()
-        fw_collection.rewrite.assert_awaited_once()
-        response_info_collection.delete_many.assert_awaited_once()
-        tag_info_collection.delete_many.assert_awaited_once()
+        status_collection.rewrite.assert_awaited_once()
+        new_snapshot = vm_collection.for_snapshot.call_args[0][0]
+        self.assertEqual(
+            status_collection.rewrite.await_args[0][0],
+            ServiceStatusModel(
+                ok=True, error_msg="", snapshot=new_snapshot, layout=SNAPSHOT_LAYOUT
+            ),
+            "New snapshot should be activated only when it is fully saved",
+        )
+        self.assertNotEqual(new_snapshot, "old", "Data is saved to new snapshot")
+        for collection in (vm_collection, fw_collection, tag_info_collection):
+            collection.for_snapshot.assert_called_with(new_snapshot)
+            collection.drop_snapshots.assert_awaited_once_with([new_snapshot, "old"])
+
+        vm_collection.insert_many.assert_awaited_once_with(
+            [vm.to_db() for vm in vm_dict.values()], ordered=False
+        )
+        fw_collection.insert_many.assert_awaited_once()
+        self.assertEqual(
+            {
+                (rule["source_tag"], rule["dest_tag"])
+                for rule in fw_collection.insert_many.await_args[0][0]
+            },
+            {(rule.source_tag, rule.dest_tag) for rule in fw_rule_dict.values()},
+            "Firewall rules with the same tags should be saved once",
+        )
+        self.assertEqual(
+            len(fw_collection.insert_many.await_args[0][0]),
+            5,
+            "Firewall rules with the same tags should be saved once",
+        )
+        response_info_collection.create_indexes.assert_awaited_once()
+        response_info_collection.delete_legacy.assert_awaited_once()
+        response_info_collection.delete_many.assert_not_awaited()
+        tag_info_collection.create_indexes.assert_awaited_once()
+        vm_collection.get_all_iter.assert_not_called()
+        fw_collection.get_all_iter.assert_not_called()
 
-        tag_info_insert_one.assert_has_awaits(
+        tag_info_collection.insert_many.assert_awaited_once()
+        tag_info_docs = tag_info_collection.insert_many.await_args[0][0]
+        self.assertCountEqual(
+            tag_info_docs,
             [
-                mock.call(dict(tag=tag, tagged_vm_ids=vm_ids, tags_with_access=[]))
+                dict(
+                    tag=tag,
+                    tagged_vm_ids=vm_ids,
+                    tags_with_access=[],
+                    accessible_tags=[],
+                )
                 for tag, vm_ids in [
                     ("tag-1_0", ["vm-1"]),
                     ("tag-1_1", ["vm-2"]),
@@ -143,28 +213,42 @@ class DBOnStartupTestCase(IsolatedAsyncioTestCase):
                     ("tag-4_0", ["vm-7"]),
                     ("tag-4_1", ["vm-7", "vm-8"]),
                 ]
-            ],
-            any_order=True,
-        )
-
-        tag_info_insert_one.assert_has_awaits(
-            [
-                mock.call(
-                    dict(tag=dest_tag, tagged_vm_ids=[], tags_with_access=[source_tag])
+            ]
+            + [
+                dict(
+                    tag=dest_tag,
+                    tagged_vm_ids=[],
+                    tags_with_access=[source_tag],
+                    accessible_tags=[],
                 )
-                for (source_tag, dest_tag) in [
-                    ("tag-1_1", "tag-1_0"),
-                    ("tag-2_1", "tag-2_0"),
-                    ("tag-3_2", "tag-3_0"),
-                    ("tag-3_3", "tag-3_1"),
-                    ("tag-4_1", "tag-4_0"),
-                ]
+                for (source_tag, dest_tag) in RULE_TAGS
+            ]
+            + [
+                dict(
+                    tag=source_tag,
+                    tagged_vm_ids=[],
+                    tags_with_access=[],
+                    accessible_tags=[dest_tag],
+                )
+                for (source_tag, dest_tag) in RULE_TAGS
             ],
-            any_order=True,
+            "TagInfo documents should be saved with one unordered batch",
+        )
+        tag_info_collection.insert_many.assert_awaited_once_with(
+            tag_info_docs, ordered=False
         )
+        service_counters_collection.set_vm_count.assert_awaited_once_with(len(vm_dict))
 
     @mock.patch(get_mock_path("connect_to_mongo"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ROLLUP_COLLECTIONS"), (get_collection_mock(),))
     @mock.patch(get_mock_path("get_cloud_environment"))
+    @mock.patch(get_mock_path("FirewallRuleCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("VirtualMachineCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("TagInfoCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("TagSetCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("MaterializedAttackCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ExposureCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ResponseInfoCollection"), get_collection_mock())
     @mock.patch(get_mock_path("StatusCollection"))
     async def test_with_validation_problem(
         self, status_collection, cloud_environment_mock
@@ -178,6 +262,7 @@ class DBOnStartupTestCase(IsolatedAsyncioTestCase):
                 rules=[],
             )
         )
+        status_collection.get_status = mock.AsyncMock(return_value=None)
         status_collection.rewrite = mock.AsyncMock()
 
         await prepare_server()
@@ -186,6 +271,10 @@ class DBOnStartupTestCase(IsolatedAsyncioTestCase):
         self.assertEqual(
             status_collection.rewrite.await_args_list[-1][0][0].dict(),
             {
+                "snapshot": None,
+                "revision": 0,
+                "base_snapshot": None,
+                "layout": 0,
                 "ok": False,
                 "error_msg": """Cloud Environment was not specified correctly:
 1 validation error for CloudEnvironment
@@ -194,3 +283,475 @@ vms
             },
             "Save info about failed processing",
         )
+
+    @mock.patch(get_mock_path("connect_to_mongo"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ROLLUP_COLLECTIONS"), (get_collection_mock(),))
+    @mock.patch(get_mock_path("get_cloud_environment"))
+    @mock.patch(get_mock_path("FirewallRuleCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("VirtualMachineCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("TagInfoCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("TagSetCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("MaterializedAttackCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ExposureCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ResponseInfoCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("StatusCollection"))
+    async def test_with_validation_problem_keeps_active_snapshot(
+        self, status_collection, cloud_environment_mock
+    ):
+        cloud_environment_mock.side_effect = ValueError("Broken file")
+        status_collection.get_status = mock.AsyncMock(
+            return_value=ServiceStatusModel(ok=True, snapshot="old")
+        )
+        status_collection.rewrite = mock.AsyncMock()
+
+        await prepare_server()
+
+        status_collection.rewrite.assert_awaited_once()
+        status = status_collection.rewrite.await_args[0][0]
+        self.assertEqual(
+            (status.ok, status.snapshot),
+            (True, "old"),
+            "Previous snapshot should be used when reload failed",
+        )
+        self.assertIn("Broken file", status.error_msg, "Save info about failed reload")
+
+    @mock.patch(get_mock_path("connect_to_mongo"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ROLLUP_COLLECTIONS"), (get_collection_mock(),))
+    @mock.patch(get_mock_path("CLOUD_ENV_DELTA"), "1")
+    @mock.patch(get_mock_path("save_cloud_environment"))
+    @mock.patch(get_mock_path("save_cloud_environment_delta"))
+    @mock.patch(get_mock_path("drop_snapshots"))
+    @mock.patch(get_mock_path("ResponseInfoCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ServiceCountersCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("StatusCollection"))
+    async def test_delta_reload(
+        self,
+        status_collection,
+        drop_snapshots,
+        save_cloud_environment_delta,
+        save_cloud_environment,
+    ):
+        status_collection.get_status = mock.AsyncMock(
+            return_value=ServiceStatusModel(
+                ok=True, snapshot="old", revision=2, layout=SNAPSHOT_LAYOUT
+            )
+        )
+        status_collection.rewrite = mock.AsyncMock()
+
+        await prepare_server()
+
+        save_cloud_environment.assert_not_awaited()
+        save_cloud_environment_delta.assert_awaited_once()
+        (
+            active_snapshot,
+            active_base_snapshot,
+            snapshot,
+            revision,
+        ) = save_cloud_environment_delta.await_args[0]
+        self.assertEqual(
+            (active_snapshot, active_base_snapshot, revision), ("old", None, 3)
+        )
+        self.assertNotEqual(snapshot, "old", "Delta is applied to a new generation")
+        status_collection.rewrite.assert_awaited_once_with(
+            ServiceStatusModel(
+                ok=True,
+                error_msg="",
+                snapshot=snapshot,
+                revision=3,
+                base_snapshot="old",
+                layout=SNAPSHOT_LAYOUT,
+            )
+        )
+        drop_snapshots.assert_awaited_once_with(keep=[snapshot, "old"])
+
+        save_cloud_environment_delta.return_value = None
+        status_collection.rewrite.reset_mock()
+        await prepare_server()
+
+        # without changes the active snapshot is kept
+        status_collection.rewrite.assert_awaited_once_with(
+            ServiceStatusModel(
+                ok=True,
+                error_msg="",
+                snapshot="old",
+                revision=2,
+                layout=SNAPSHOT_LAYOUT,
+            )
+        )
+
+        save_cloud_environment_delta.side_effect = ValueError("Mongo")
+        status_collection.rewrite.reset_mock()
+        drop_snapshots.reset_mock()
+        await prepare_server()
+
+        drop_snapshots.assert_awaited_once_with(keep=["old"])
+        status = status_collection.rewrite.await_args[0][0]
+        self.assertEqual(
+            (status.ok, status.snapshot, status.revision),
+            (True, "old", 2),
+            "Not changed active snapshot is still used after failed delta",
+        )
+
+    @mock.patch(get_mock_path("connect_to_mongo"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ROLLUP_COLLECTIONS"), (get_collection_mock(),))
+    @mock.patch(get_mock_path("CLOUD_ENV_DELTA"), "1")
+    @mock.patch(get_mock_path("save_cloud_environment"))
+    @mock.patch(get_mock_path("save_cloud_environment_delta"))
+    @mock.patch(get_mock_path("drop_snapshots"))
+    @mock.patch(get_mock_path("ResponseInfoCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ServiceCountersCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("StatusCollection"))
+    async def test_delta_reload_of_layer(
+        self,
+        status_collection,
+        drop_snapshots,
+        save_cloud_environment_delta,
+        save_cloud_environment,
+    ):
+        status_collection.get_status = mock.AsyncMock(
+            return_value=ServiceStatusModel(
+                ok=True,
+                snapshot="old",
+                revision=2,
+                base_snapshot="base",
+                layout=SNAPSHOT_LAYOUT,
+            )
+        )
+        status_collection.rewrite = mock.AsyncMock()
+
+        await prepare_server()
+
+        (
+            active_snapshot,
+            active_base_snapshot,
+            snapshot,
+            _,
+        ) = save_cloud_environment_delta.await_args[0]
+        self.assertEqual((active_snapshot, active_base_snapshot), ("old", "base"))
+        self.assertEqual(
+            status_collection.rewrite.await_args[0][0].base_snapshot,
+            "base",
+            "New layer is over the same base",
+        )
+        drop_snapshots.assert_awaited_once_with(keep=[snapshot, "old", "base"])
+
+        status_collection.get_status.return_value = ServiceStatusModel(
+            ok=True, snapshot="old", revision=2, base_snapshot="base"
+        )
+        await prepare_server()
+
+        save_cloud_environment.assert_awaited_once()
+        self.assertIsNone(
+            status_collection.rewrite.await_args[0][0].base_snapshot,
+            "Generation of an older layout is reloaded in full",
+        )
+
+    @mock.patch(get_mock_path("connect_to_mongo"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ROLLUP_COLLECTIONS"), (get_collection_mock(),))
+    @mock.patch(get_mock_path("CLOUD_ENV_DELTA"), "1")
+    @mock.patch(get_mock_path("save_cloud_environment_delta"))
+    @mock.patch(get_mock_path("drop_snapshots"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ResponseInfoCollection"), get_collection_mock())
+    @mock.patch(
+        get_mock_path("ServiceCountersCollection"), new_callable=get_collection_mock
+    )
+    @mock.patch(get_mock_path("VirtualMachineCollection"))
+    @mock.patch(get_mock_path("StatusCollection"))
+    async def test_vm_count(
+        self,
+        status_collection,
+        vm_collection,
+        service_counters_collection,
+        save_cloud_environment_delta,
+    ):
+        status_collection.get_status = mock.AsyncMock(
+            return_value=ServiceStatusModel(
+                ok=True, snapshot="old", revision=2, layout=SNAPSHOT_LAYOUT
+            )
+        )
+        calls = mock.MagicMock(rewrite=mock.AsyncMock(), set_vm_count=mock.AsyncMock())
+        status_collection.rewrite = calls.rewrite
+        service_counters_collection.set_vm_count = calls.set_vm_count
+        save_cloud_environment_delta.return_value = 3
+
+        await prepare_server()
+
+        self.assertEqual(
+            [call[0] for call in calls.mock_calls],
+            ["set_vm_count", "rewrite"],
+            "Count of VMs is saved before the new snapshot is activated",
+        )
+
+        save_cloud_environment_delta.return_value = None
+        service_counters_collection.has_vm_count.return_value = False
+        vm_collection.for_snapshot.return_value.count_documents = mock.AsyncMock(
+            return_value=5
+        )
+        calls.reset_mock()
+        await prepare_server()
+
+        vm_collection.for_snapshot.assert_called_once_with("old", None)
+        calls.set_vm_count.assert_awaited_once_with(5)
+
+    @mock.patch(get_mock_path("connect_to_mongo"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ROLLUP_COLLECTIONS"), (get_collection_mock(),))
+    @mock.patch(get_mock_path("is_tag_set_resolver_enabled"), lambda: True)
+    @mock.patch(get_mock_path("add_exposure"))
+    @mock.patch(get_mock_path("get_cloud_environment"))
+    @mock.patch(get_mock_path("add_tag_sets"))
+    @mock.patch(
+        get_mock_path("FirewallRuleCollection"), new_callable=get_collection_mock
+    )
+    @mock.patch(
+        get_mock_path("VirtualMachineCollection"), new_callable=get_collection_mock
+    )
+    @mock.patch(get_mock_path("TagInfoCollection"), new_callable=get_collection_mock)
+    @mock.patch(get_mock_path("TagSetCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("MaterializedAttackCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ExposureCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ServiceCountersCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ResponseInfoCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("StatusCollection"))
+    async def test_tag_sets(
+        self,
+        status_collection,
+        tag_info_collection,
+        vm_collection,
+        fw_collection,
+        add_tag_sets,
+        cloud_environment_mock,
+        add_exposure,
+    ):
+        cloud_environment_mock.return_value = CloudEnvironment(
+            machines=[
+                VMInfo(id="vm-1", name="", tags=["t1", "t2"]),
+                VMInfo(id="vm-2", name="", tags=["t2", "t1"]),
+                VMInfo(id="vm-3", name="", tags=["t3"]),
+            ],
+            rules=[FirewallRule(id="fw-1", source_tag="t3", dest_tag="t1")],
+        )
+        for collection in (vm_collection, fw_collection, tag_info_collection):
+            collection.for_snapshot.return_value = collection
+        status_collection.get_status = mock.AsyncMock(return_value=None)
+        status_collection.rewrite = mock.AsyncMock()
+
+        await prepare_server()
+
+        add_tag_sets.assert_awaited_once()
+        (
+            snapshot,
+            tags_for_tag_set,
+            vm_ids_for_tag,
+            tags_with_access_for_tag,
+        ) = add_tag_sets.await_args[0]
+        self.assertEqual(
+            sorted(tags_for_tag_set.values()),
+            [["t1", "t2"], ["t3"]],
+            "VMs with the same tags should have one tag set",
+        )
+        self.assertEqual(vm_ids_for_tag["t1"], ["vm-1", "vm-2"])
+        self.assertEqual(dict(tags_with_access_for_tag), {"t1": {"t3"}})
+        self.assertEqual(
+            dict(add_exposure.await_args[0][1]),
+            {("t1", "t2"): ["vm-1", "vm-2"], ("t3",): ["vm-3"]},
+            "Exposure should be calculated from the same tag sets",
+        )
+        self.assertTrue(status_collection.rewrite.await_args[0][0].ok)
+
+    @mock.patch(get_mock_path("connect_to_mongo"), mock.AsyncMock())
+    @mock.patch(get_mock_path("ROLLUP_COLLECTIONS"), (get_collection_mock(),))
+    @mock.patch(get_mock_path("is_materialization_enabled"), lambda: True)
+    @mock.patch(get_mock_path("add_exposure"), mock.AsyncMock())
+    @mock.patch(get_mock_path("get_hot_vm_ids"))
+    @mock.patch(get_mock_path("get_cloud_environment"))
+    @mock.patch(get_mock_path("add_materialized_attacks"))
+    @mock.patch(
+        get_mock_path("FirewallRuleCollection"), new_callable=get_collection_mock
+    )
+    @mock.patch(
+        get_mock_path("VirtualMachineCollection"), new_callable=get_collection_mock
+    )
+    @mock.patch(get_mock_path("TagInfoCollection"), new_callable=get_collection_mock)
+    @mock.patch(get_mock_path("TagSetCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("MaterializedAttackCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ExposureCollection"), get_collection_mock())
+    @mock.patch(get_mock_path("ServiceCountersCollection"), get_collection_mock())
+    @mock.patch(
+        get_mock_path("ResponseInfoCollection"), new_callable=get_collection_mock
+    )
+    @mock.patch(get_mock_path("StatusCollection"))
+    async def test_materialization(
+        self,
+        status_collection,
+        response_info_collection,
+        tag_info_collection,
+        vm_collection,
+        fw_collection,
+        add_materialized_attacks,
+        cloud_environment_mock,
+        get_hot_vm_ids,
+    ):
+        cloud_environment_mock.return_value = CloudEnvironment(
+            machines=[
+                VMInfo(id="vm-1", name="", tags=["t1"]),
+                VMInfo(id="vm-2", name="", tags=["t2"]),
+            ],
+            rules=[FirewallRule(id="fw-1", source_tag="t2", dest_tag="t1")],
+        )
+        for collection in (vm_collection, fw_collection, tag_info_collection):
+            collection.for_snapshot.return_value = collection
+        get_hot_vm_ids.return_value = ["vm-2", "removed", "vm-1"]
+        status_collection.get_status = mock.AsyncMock(return_value=None)
+        status_collection.rewrite = mock.AsyncMock()
+
+        await prepare_server()
+
+        get_hot_vm_ids.assert_awaited_once()
+        response_info_collection.delete_many.assert_not_awaited()
+        (
+            snapshot,
+            hot_vm_tags,
+            vm_ids_for_tag,
+            tags_with_access_for_tag,
+        ) = add_materialized_attacks.await_args[0]
+        self.assertEqual(
+            hot_vm_tags,
+            [("vm-2", ["t2"]), ("vm-1", ["t1"])],
+            "Existing VMs in order of popularity",
+        )
+        self.assertEqual(dict(tags_with_access_for_tag), {"t1": {"t2"}})
+        self.assertTrue(status_collection.rewrite.await_args[0][0].ok)
+
+
+async def iter_batches():
+    yield "machines", [
+        VMInfo(id="vm-1", name="", tags=["t1"]),
+        VMInfo(id="vm-2", name="", tags=["t2"]),
+        VMInfo(id="vm-3", name="", tags=["t3"]),
+    ]
+    yield "rules", [FirewallRule(id="fw-1", source_tag="t2", dest_tag="t1")]
+
+
+@mock.patch(get_mock_path("get_cloud_environment_batches"), iter_batches)
+class DeltaOnStartupTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+        self.mocks = {}
+        for item in (
+            "get_manifest_changes",
+            "add_layer",
+            "apply_delta",
+            "update_manifest",
+            "update_exposure",
+            "update_tag_sets",
+            "update_materialized_attacks",
+        ):
+            patcher = mock.patch(get_mock_path(item), mock.AsyncMock())
+            self.mocks[item] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.mocks["apply_delta"].return_value = {"t1"}
+        patcher = mock.patch(get_mock_path("VirtualMachineCollection"))
+        self.vm_collection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.vm_collection.for_snapshot.return_value = self.vm_collection
+        old_vms = {"vm-2": VMInfo(id="vm-2", name="", tags=["t1"])}
+        self.vm_collection.get_by_ids = mock.AsyncMock(
+            side_effect=lambda ids: {id: old_vms[id] for id in ids if id in old_vms}
+        )
+
+    def set_changes(self, old_vm_ids, new_vm_ids, old_rules=(), new_rules=()):
+        self.mocks["get_manifest_changes"].return_value = ManifestChanges(
+            bucket_ids={"vms-4-1", "rules-4-2"},
+            old_vm_ids=old_vm_ids,
+            new_vm_ids=new_vm_ids,
+            old_rules=set(old_rules),
+            new_rules=set(new_rules),
+        )
+
+    async def test_delta_is_applied_to_new_layer(self):
+        self.set_changes(
+            ["vm-2"],
+            ["vm-2", "vm-3"],
+            old_rules={("t1", "t2")},
+            new_rules={("t2", "t1")},
+        )
+
+        vm_count = await save_cloud_environment_delta("old", None, "new", 3)
+
+        self.assertEqual(vm_count, 3)
+        self.mocks["get_manifest_changes"].assert_awaited_once_with(
+            "old", None, mock.ANY
+        )
+        self.vm_collection.for_snapshot.assert_called_once_with("old", None)
+        self.vm_collection.get_by_ids.assert_awaited_once_with(["vm-2"])
+        self.mocks["add_layer"].assert_awaited_once_with(None, "new")
+        snapshot, base_snapshot, delta = self.mocks["apply_delta"].await_args[0]
+        self.assertEqual(
+            (snapshot, base_snapshot), ("new", "old"), "Layer over the active snapshot"
+        )
+        self.assertEqual(
+            (delta.removed_vm_ids, [vm.id for vm in delta.upserted_vms]),
+            ([], ["vm-2", "vm-3"]),
+            "Only VMs of the changed buckets are compared",
+        )
+        self.assertEqual(
+            (delta.removed_rules, delta.added_rules), ({("t1", "t2")}, {("t2", "t1")})
+        )
+        self.mocks["update_manifest"].assert_awaited_once_with(
+            "new", mock.ANY, {"vms-4-1", "rules-4-2"}
+        )
+        self.mocks["update_exposure"].assert_awaited_once_with(
+            "new", "old", delta, {"vm-2": mock.ANY}, {"t1"}
+        )
+
+    async def test_delta_over_layer(self):
+        self.set_changes(["vm-2"], ["vm-2"])
+
+        await save_cloud_environment_delta("old", "base", "new", 3)
+
+        self.vm_collection.for_snapshot.assert_called_once_with("old", "base")
+        self.mocks["add_layer"].assert_awaited_once_with("old", "new")
+        self.assertEqual(
+            self.mocks["apply_delta"].await_args[0][:2],
+            ("new", "base"),
+            "Changes of the active layer are copied, the base is the same",
+        )
+
+    @mock.patch(get_mock_path("is_tag_set_resolver_enabled"), lambda: True)
+    @mock.patch(get_mock_path("is_materialization_enabled"), lambda: True)
+    async def test_delta_updates_new_layer(self):
+        self.set_changes(["vm-2"], ["vm-2"])
+
+        await save_cloud_environment_delta("old", None, "new", 3)
+
+        self.mocks["update_tag_sets"].assert_awaited_once_with(
+            "new", "old", [VMInfo(id="vm-2", name="", tags=["t2"])], {"t1"}
+        )
+        snapshot, base_snapshot, changed_vm_ids, affected_tags = self.mocks[
+            "update_materialized_attacks"
+        ].await_args[0]
+        self.assertEqual(
+            (snapshot, base_snapshot, list(changed_vm_ids), affected_tags),
+            ("new", "old", ["vm-2"], {"t1"}),
+        )
+
+    @mock.patch(get_mock_path("is_exposure_enabled"), lambda: False)
+    async def test_delta_without_exposure(self):
+        self.set_changes(["vm-2"], ["vm-2"])
+
+        await save_cloud_environment_delta("old", None, "new", 3)
+
+        self.mocks["apply_delta"].assert_awaited_once()
+        self.mocks["update_exposure"].assert_not_awaited()
+
+    async def test_without_changes(self):
+        self.set_changes([], [])
+
+        self.assertIsNone(await save_cloud_environment_delta("old", None, "new", 3))
+        self.mocks["add_layer"].assert_not_awaited()
+
+    async def test_changed_vm_is_missing(self):
+        self.set_changes([], ["vm-4"])
+
+        with self.assertRaises(ValueError, msg="File was changed between reads"):
+            await save_cloud_environment_delta("old", None, "new", 3)
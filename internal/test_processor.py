@@ -2,18 +2,58 @@ from unittest import IsolatedAsyncioTestCase, mock
 
 from parameterized import parameterized
 
+from .cache import SnapshotLRUCache
 from .models import TagInfo, VMInfo
-from .processor import get_vm_id_list_with_access_to_vm
+from .tag_sets import get_tag_set_signature
+
+from .processor import (  # isort: skip
+    MaterializedVMIds,
+    check_attack_resolver,
+    count_sorted_vm_ids,
+    count_vm_ids_with_access_to_vm,
+    get_encoded_vm_id_list_with_access_to_vm,
+    get_vm_distances_with_access_to_vm,
+    get_vm_id_list_accessible_from_vm,
+    get_vm_id_list_with_access_to_vm,
+    get_vm_id_lists_with_access_to_vms,
+    has_vm_ids_with_access_to_vm,
+    iter_vm_ids_with_access_to_vm,
+    merge_sorted_vm_ids,
+)
 
 
 def get_mock_path(item: str) -> str:
     return f"internal.processor.{item}"
 
 
+def get_aggregated_tags_info_mock(tag_info_dict: dict[str, TagInfo]):
+    return mock.AsyncMock(
+        side_effect=lambda tags, fields: {
+            tag: tag_info_dict[tag] for tag in tags if tag in tag_info_dict
+        }
+    )
+
+
 class ProcessorTestCase(IsolatedAsyncioTestCase):
     async def asyncSetUp(self) -> None:
         self.longMessage = True
 
+        self.cache = SnapshotLRUCache(max_entries=100, max_size=100)
+        self.active_version = mock.AsyncMock(return_value=("snapshot", 0))
+        for target, new in (
+            ("tag_attackers_cache", self.cache),
+            (
+                "tag_set_attackers_cache",
+                SnapshotLRUCache(max_entries=100, max_size=100),
+            ),
+            ("tag_targets_cache", SnapshotLRUCache(max_entries=100, max_size=100)),
+            ("materialized_vm_ids", MaterializedVMIds()),
+            ("StatusCollection.get_active_version", self.active_version),
+        ):
+            patcher = mock.patch(get_mock_path(target), new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     async def test_processor_positive(self):
         with mock.patch(get_mock_path("TagInfoCollection")) as tag_info_collection_mock:
             tag_info_dict = {
@@ -26,8 +66,8 @@ class ProcessorTestCase(IsolatedAsyncioTestCase):
                     tagged_vm_ids=["id2"],
                 ),
             }
-            tag_info_collection_mock.get_aggregated_tag_info = mock.AsyncMock(
-                side_effect=lambda id: tag_info_dict.get(id)
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
             )
             with mock.patch(
                 get_mock_path("VirtualMachineCollection")
@@ -106,8 +146,8 @@ class ProcessorTestCase(IsolatedAsyncioTestCase):
                     tag="tag-4_1", tags_with_access=[], tagged_vm_ids=["vm-7", "vm-8"]
                 ),
             }
-            tag_info_collection_mock.get_aggregated_tag_info = mock.AsyncMock(
-                side_effect=lambda id: tag_info_dict.get(id)
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
             )
             with mock.patch(
                 get_mock_path("VirtualMachineCollection")
@@ -143,3 +183,458 @@ class ProcessorTestCase(IsolatedAsyncioTestCase):
             expected_vm_ids,
             reason,
         )
+        self.assertLessEqual(
+            tag_info_collection_mock.get_aggregated_tags_info.await_count,
+            2,
+            "TagInfo for all tags should be loaded with fixed count of queries",
+        )
+
+    async def test_processor_caches_tags(self):
+        tag_info_dict = {
+            "t1": TagInfo(tag="t1", tags_with_access=[], tagged_vm_ids=["id1"]),
+            "t2": TagInfo(tag="t2", tags_with_access=["t1"], tagged_vm_ids=["id2"]),
+        }
+        vm_dict = {
+            "id2": VMInfo(id="id2", name="n2", tags=["t2"]),
+            "id3": VMInfo(id="id3", name="n3", tags=["t2"]),
+        }
+        with mock.patch(
+            get_mock_path("TagInfoCollection")
+        ) as tag_info_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
+            )
+            vm_collection_mock.get_by_id = mock.AsyncMock(
+                side_effect=lambda id: vm_dict.get(id)
+            )
+
+            self.assertEqual(await get_vm_id_list_with_access_to_vm("id2"), ["id1"])
+            self.assertEqual(await get_vm_id_list_with_access_to_vm("id3"), ["id1"])
+            self.assertEqual(
+                tag_info_collection_mock.get_aggregated_tags_info.await_count,
+                2,
+                "VMs with the same tag should use cached info about tag",
+            )
+            self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+            self.active_version.return_value = ("new_snapshot", 0)
+            await get_vm_id_list_with_access_to_vm("id2")
+            self.assertEqual(
+                tag_info_collection_mock.get_aggregated_tags_info.await_count,
+                4,
+                "Cache should be cleared when new snapshot is loaded",
+            )
+
+    async def test_processor_batch(self):
+        tag_info_dict = {
+            "t1": TagInfo(
+                tag="t1", tags_with_access=["t2"], tagged_vm_ids=["id1", "id3"]
+            ),
+            "t2": TagInfo(tag="t2", tags_with_access=["t1"], tagged_vm_ids=["id2"]),
+            "t3": TagInfo(tag="t3", tags_with_access=["t1"], tagged_vm_ids=["id3"]),
+        }
+        vm_dict = {
+            "id1": VMInfo(id="id1", name="n1", tags=["t1"]),
+            "id2": VMInfo(id="id2", name="n2", tags=["t2"]),
+            "id3": VMInfo(id="id3", name="n3", tags=["t1", "t3"]),
+        }
+        with mock.patch(
+            get_mock_path("TagInfoCollection")
+        ) as tag_info_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
+            )
+            vm_collection_mock.get_by_ids = mock.AsyncMock(
+                side_effect=lambda ids: {id: vm_dict[id] for id in ids if id in vm_dict}
+            )
+
+            result = await get_vm_id_lists_with_access_to_vms(
+                ["id1", "id2", "id3", "id1", "unknown_vm_id"]
+            )
+
+        self.assertEqual(
+            {vm_id: set(vm_ids) for vm_id, vm_ids in result.items()},
+            {
+                "id1": {"id2"},
+                "id2": {"id1", "id3"},
+                "id3": {"id1", "id2"},
+                "unknown_vm_id": set(),
+            },
+            "Every VM should get the same result as from single VM request",
+        )
+        vm_collection_mock.get_by_ids.assert_awaited_once()
+        self.assertEqual(
+            tag_info_collection_mock.get_aggregated_tags_info.await_count,
+            2,
+            "TagInfo for all VMs of batch should be loaded together",
+        )
+
+    @parameterized.expand(
+        (
+            ("All VMs", None, ["id1", "id2", "id4", "id5"]),
+            ("Page after VM", "id2", ["id4", "id5"]),
+            ("Page after excluded VM", "id3", ["id4", "id5"]),
+            ("Last page", "id5", []),
+        )
+    )
+    def test_merge_sorted_vm_ids(self, reason, after, expected_vm_ids):
+        result = merge_sorted_vm_ids(
+            [("id1", "id3", "id5"), ("id2", "id3", "id4"), ()],
+            exclude="id3",
+            after=after,
+        )
+
+        self.assertEqual(list(result), expected_vm_ids, reason)
+
+    @parameterized.expand(
+        (
+            ("One list", [("id1", "id3")], "id3", 1),
+            ("Disjoint lists are summed", [("id4", "id5"), ("id1", "id3")], "id3", 3),
+            ("Overlapping lists are merged", [("id1", "id4"), ("id2", "id4")], "", 3),
+            ("Empty lists", [(), ()], "id1", 0),
+        )
+    )
+    def test_count_sorted_vm_ids(self, reason, vm_ids_lists, exclude, expected):
+        self.assertEqual(
+            count_sorted_vm_ids(vm_ids_lists, exclude=exclude), expected, reason
+        )
+
+    async def test_processor_iter(self):
+        tag_info_dict = {
+            "t1": TagInfo(tag="t1", tags_with_access=[], tagged_vm_ids=["id3", "id1"]),
+            "t2": TagInfo(
+                tag="t2", tags_with_access=["t1", "t2"], tagged_vm_ids=["id2"]
+            ),
+        }
+        with mock.patch(
+            get_mock_path("TagInfoCollection")
+        ) as tag_info_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
+            )
+            vm_collection_mock.get_by_id = mock.AsyncMock(
+                return_value=VMInfo(id="id2", name="n2", tags=["t2", "t2"])
+            )
+
+            result = await iter_vm_ids_with_access_to_vm("id2")
+            self.assertEqual(list(result), ["id1", "id3"], "Sorted without VM itself")
+
+            result = await iter_vm_ids_with_access_to_vm("id2", after="id1")
+            self.assertEqual(list(result), ["id3"], "VMs after `after` only")
+
+    @parameterized.expand(
+        (
+            ("One tag in danger", ["t2"], 2),
+            ("Few tags in danger, VMs are counted once", ["t2", "t5"], 3),
+            ("Attacked VM is the only VM with tag in danger", ["t3"], 0),
+            ("VM without tags", [], 0),
+        )
+    )
+    async def test_processor_count_and_exists(self, reason, tags, expected_count):
+        tag_info_dict = {
+            "t1": TagInfo(tag="t1", tags_with_access=[], tagged_vm_ids=["id3", "id1"]),
+            "t2": TagInfo(tag="t2", tags_with_access=["t1"], tagged_vm_ids=["id2"]),
+            "t3": TagInfo(tag="t3", tags_with_access=["t3"], tagged_vm_ids=["id2"]),
+            "t4": TagInfo(tag="t4", tags_with_access=[], tagged_vm_ids=["id1", "id4"]),
+            "t5": TagInfo(tag="t5", tags_with_access=["t4"], tagged_vm_ids=["id2"]),
+        }
+        with mock.patch(
+            get_mock_path("TagInfoCollection")
+        ) as tag_info_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
+            )
+            tag_info_collection_mock.has_tagged_vm_ids = mock.AsyncMock(
+                side_effect=lambda tags, exclude: any(
+                    set(tag_info_dict[tag].tagged_vm_ids) - {exclude} for tag in tags
+                )
+            )
+            vm_collection_mock.get_by_id = mock.AsyncMock(
+                return_value=VMInfo(id="id2", name="n2", tags=tags)
+            )
+
+            count = await count_vm_ids_with_access_to_vm("id2")
+            exists = await has_vm_ids_with_access_to_vm("id2")
+
+        self.assertEqual(count, expected_count, reason)
+        self.assertEqual(exists, expected_count > 0, reason)
+        self.assertEqual(
+            tag_info_collection_mock.has_tagged_vm_ids.await_count,
+            1 if tags else 0,
+            "Existence is checked by DB without loading VM IDs",
+        )
+
+    async def test_processor_targets(self):
+        tag_info_dict = {
+            "t1": TagInfo(
+                tag="t1",
+                tags_with_access=[],
+                tagged_vm_ids=["id1", "id3"],
+                accessible_tags=["t2", "t3"],
+            ),
+            "t2": TagInfo(tag="t2", tags_with_access=["t1"], tagged_vm_ids=["id2"]),
+            "t3": TagInfo(tag="t3", tags_with_access=["t1"], tagged_vm_ids=["id3"]),
+        }
+        vm_dict = {
+            "id1": VMInfo(id="id1", name="n1", tags=["t1"]),
+            "id2": VMInfo(id="id2", name="n2", tags=["t2"]),
+            "id3": VMInfo(id="id3", name="n3", tags=["t1", "t3"]),
+        }
+        with mock.patch(
+            get_mock_path("TagInfoCollection")
+        ) as tag_info_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
+            )
+            vm_collection_mock.get_by_id = mock.AsyncMock(
+                side_effect=lambda id: vm_dict.get(id)
+            )
+
+            self.assertEqual(
+                set(await get_vm_id_list_accessible_from_vm("id1")),
+                {"id2", "id3"},
+                "VMs with tags accessible from VM's tags",
+            )
+            self.assertEqual(
+                set(await get_vm_id_list_accessible_from_vm("id3")),
+                {"id2"},
+                "VM itself should be excluded",
+            )
+            self.assertEqual(await get_vm_id_list_accessible_from_vm("id2"), [])
+
+        self.assertEqual(
+            tag_info_collection_mock.get_aggregated_tags_info.await_args_list[0],
+            mock.call(["t1"], fields=["accessible_tags"]),
+            "Reverse query should use accessible tags",
+        )
+        self.assertEqual(self.cache.misses, 0, "Attackers cache is not used")
+
+    @parameterized.expand(
+        (
+            ("One hop is the same as /attack", "vm-a", 1, {"vm-b": 1}),
+            (
+                "All hops, attacked VM is not shown in cycle",
+                "vm-a",
+                10,
+                {"vm-b": 1, "vm-c": 2, "vm-f": 2, "vm-d": 3},
+            ),
+            ("Not attacked VM", "vm-f", 10, {}),
+            ("VM ID is incorrect", "unknown_vm_id", 10, {}),
+        )
+    )
+    async def test_processor_paths(self, reason, vm_id, max_depth, expected_distances):
+        # vm-b -> vm-a, vm-c / vm-f -> vm-b, vm-d -> vm-c / vm-e, vm-a -> vm-d
+        tag_info_dict = {
+            "t-a": TagInfo(tag="t-a", tags_with_access=["t-b"], tagged_vm_ids=["vm-a"]),
+            "t-b": TagInfo(tag="t-b", tags_with_access=["t-c"], tagged_vm_ids=["vm-b"]),
+            "t-c": TagInfo(
+                tag="t-c", tags_with_access=[], tagged_vm_ids=["vm-c", "vm-f"]
+            ),
+            "t-d": TagInfo(tag="t-d", tags_with_access=["t-a"], tagged_vm_ids=["vm-d"]),
+            "t-x": TagInfo(
+                tag="t-x", tags_with_access=["t-d"], tagged_vm_ids=["vm-c", "vm-e"]
+            ),
+        }
+        vm_dict = {
+            vm_id: VMInfo(id=vm_id, name="", tags=tags)
+            for vm_id, tags in [
+                ("vm-a", ["t-a"]),
+                ("vm-b", ["t-b"]),
+                ("vm-c", ["t-c", "t-x"]),
+                ("vm-d", ["t-d"]),
+                ("vm-e", ["t-x"]),
+                ("vm-f", ["t-c"]),
+            ]
+        }
+        with mock.patch(
+            get_mock_path("TagInfoCollection")
+        ) as tag_info_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
+            )
+            vm_collection_mock.get_by_id = mock.AsyncMock(
+                side_effect=lambda id: vm_dict.get(id)
+            )
+            vm_collection_mock.get_tags_by_ids = mock.AsyncMock(
+                side_effect=lambda ids: {id: vm_dict[id].tags for id in ids}
+            )
+
+            result = await get_vm_distances_with_access_to_vm(vm_id, max_depth)
+
+        self.assertEqual(result, expected_distances, reason)
+
+    @mock.patch(get_mock_path("ATTACK_RESOLVER"), "tag_set")
+    async def test_processor_tag_set(self):
+        vm_dict = {
+            "id1": VMInfo(id="id1", name="n1", tags=["t1", "t2"]),
+            "id2": VMInfo(id="id2", name="n2", tags=["t2", "t1"]),
+        }
+        with mock.patch(
+            get_mock_path("TagSetCollection")
+        ) as tag_set_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            tag_set_collection_mock.get_attacker_vm_ids = mock.AsyncMock(
+                return_value=["id1", "id2", "id3"]
+            )
+            vm_collection_mock.get_by_id = mock.AsyncMock(
+                side_effect=lambda id: vm_dict.get(id)
+            )
+
+            self.assertEqual(
+                await get_vm_id_list_with_access_to_vm("id1"),
+                ["id2", "id3"],
+                "Attackers of tag set without VM itself",
+            )
+            self.assertEqual(
+                await get_vm_id_list_with_access_to_vm("id2"), ["id1", "id3"]
+            )
+            self.assertEqual(await get_vm_id_list_with_access_to_vm("unknown"), [])
+
+        tag_set_collection_mock.get_attacker_vm_ids.assert_awaited_once_with(
+            get_tag_set_signature(["t1", "t2"])
+        )
+
+    @mock.patch(get_mock_path("ATTACK_RESOLVER"), "tag_set")
+    async def test_processor_tag_set_is_not_saved(self):
+        tag_info_dict = {
+            "t1": TagInfo(tag="t1", tags_with_access=["t2"], tagged_vm_ids=["id1"]),
+            "t2": TagInfo(tag="t2", tags_with_access=[], tagged_vm_ids=["id2"]),
+        }
+        with mock.patch(
+            get_mock_path("TagSetCollection")
+        ) as tag_set_collection_mock, mock.patch(
+            get_mock_path("TagInfoCollection")
+        ) as tag_info_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            tag_set_collection_mock.get_attacker_vm_ids = mock.AsyncMock(
+                return_value=None
+            )
+            tag_info_collection_mock.get_aggregated_tags_info = (
+                get_aggregated_tags_info_mock(tag_info_dict)
+            )
+            vm_collection_mock.get_by_id = mock.AsyncMock(
+                return_value=VMInfo(id="id1", name="n1", tags=["t1"])
+            )
+
+            result = await get_vm_id_list_with_access_to_vm("id1")
+
+        self.assertEqual(result, ["id2"], "TagInfo is used without TagSet")
+
+    @mock.patch(get_mock_path("is_materialization_enabled"), lambda: True)
+    async def test_processor_materialized(self):
+        with mock.patch(
+            get_mock_path("MaterializedAttackCollection")
+        ) as materialized_attack_collection_mock, mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock:
+            materialized_attack_collection_mock.get_attacker_vm_ids = mock.AsyncMock(
+                return_value=["id1"]
+            )
+            materialized_attack_collection_mock.get_vm_ids = mock.AsyncMock(
+                return_value=["hot"]
+            )
+            vm_collection_mock.get_by_id = mock.AsyncMock(return_value=None)
+
+            self.assertEqual(
+                await get_vm_id_list_with_access_to_vm("hot"),
+                ["id1"],
+                "Materialized attackers should be returned as is",
+            )
+            vm_collection_mock.get_by_id.assert_not_awaited()
+
+            self.assertEqual(
+                await get_vm_id_list_with_access_to_vm("cold"),
+                [],
+                "Not materialized VMs should be calculated",
+            )
+            vm_collection_mock.get_by_id.assert_awaited_once_with("cold")
+            materialized_attack_collection_mock.get_attacker_vm_ids.assert_awaited_once_with(
+                "hot"
+            )
+            materialized_attack_collection_mock.get_vm_ids.assert_awaited_once()
+
+            self.active_version.return_value = ("snapshot", 1)
+            await get_vm_id_list_with_access_to_vm("cold")
+            self.assertEqual(
+                materialized_attack_collection_mock.get_vm_ids.await_count,
+                2,
+                "Materialized VMs are loaded again for a new version",
+            )
+
+    @mock.patch(get_mock_path("ATTACK_RESOLVER"), "aggregation")
+    async def test_processor_aggregation(self):
+        with mock.patch(
+            get_mock_path("VirtualMachineCollection")
+        ) as vm_collection_mock, mock.patch(
+            get_mock_path("TagInfoCollection")
+        ) as tag_info_collection_mock:
+            vm_collection_mock.get_vm_ids_with_access_to_vm = mock.AsyncMock(
+                return_value=["id1"]
+            )
+
+            result = await get_vm_id_list_with_access_to_vm("id2")
+
+        self.assertEqual(result, ["id1"], "Result of aggregation should be returned")
+        vm_collection_mock.get_vm_ids_with_access_to_vm.assert_awaited_once_with("id2")
+        tag_info_collection_mock.get_aggregated_tags_info.assert_not_called()
+
+    def test_check_attack_resolver(self):
+        for resolver in ("mongo", "memory", "tag_set", "aggregation"):
+            with mock.patch(get_mock_path("ATTACK_RESOLVER"), resolver):
+                check_attack_resolver()
+
+        with mock.patch(get_mock_path("ATTACK_RESOLVER"), "unknown"):
+            with self.assertRaises(
+                ValueError, msg="Unknown resolver is a config error"
+            ):
+                check_attack_resolver()
+
+    async def test_encoded_response_cache(self):
+        cache = SnapshotLRUCache(max_entries=100, max_size=1000)
+        with mock.patch(get_mock_path("attack_response_cache"), cache), mock.patch(
+            get_mock_path("get_vm_id_list_with_access_to_vm"),
+            mock.AsyncMock(return_value=["id1", "id2"]),
+        ) as get_vm_id_list_with_access_to_vm_mock:
+            first = await get_encoded_vm_id_list_with_access_to_vm("id3")
+            second = await get_encoded_vm_id_list_with_access_to_vm("id3")
+            self.active_version.return_value = ("new_snapshot", 0)
+            await get_encoded_vm_id_list_with_access_to_vm("id3")
+
+        self.assertEqual(first, b'["id1","id2"]', "Response should be encoded to JSON")
+        self.assertIs(second, first, "Encoded response should be reused")
+        self.assertEqual(
+            get_vm_id_list_with_access_to_vm_mock.await_count,
+            2,
+            "Response should be calculated again for new snapshot",
+        )
+
+    async def test_response_of_old_snapshot_is_not_cached(self):
+        cache = SnapshotLRUCache(max_entries=100, max_size=1000)
+
+        async def get_vm_ids_during_reload(vm_id):
+            # a concurrent request uses the cache after the reload
+            cache.use_version(("new_snapshot", 0))
+            return ["id1"]
+
+        with mock.patch(get_mock_path("attack_response_cache"), cache), mock.patch(
+            get_mock_path("get_vm_id_list_with_access_to_vm"),
+            mock.AsyncMock(side_effect=get_vm_ids_during_reload),
+        ):
+            await get_encoded_vm_id_list_with_access_to_vm("id3")
+
+        self.assertEqual(cache.version, ("new_snapshot", 0))
+        self.assertEqual(cache.items, {}, "Response of old snapshot isn't cached")
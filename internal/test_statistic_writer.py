@@ -0,0 +1,243 @@
+from asyncio import sleep
+from datetime import datetime
+from unittest import IsolatedAsyncioTestCase, mock
+
+from pymongo.errors import BulkWriteError
+
+from .crud import HourRollupCollection, MinuteRollupCollection
+from .histogram import LatencyHistogram
+from .models import ServiceCountersModel
+from .statistic_writer import StatisticWriter
+
+
+def get_document(
+    id: str,
+    path: str = "/api/v1/attack",
+    duration: float = 0.1,
+    created_at: datetime = datetime(2023, 1, 1, 12),
+):
+    return {
+        "_id": id,
+        "created_at": created_at,
+        "duration": duration,
+        "path": path,
+        "params": "",
+    }
+
+
+class StatisticWriterTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+        patcher = mock.patch("internal.statistic_writer.ResponseInfoCollection")
+        self.collection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.collection.insert_many = mock.AsyncMock()
+        patcher = mock.patch(
+            "internal.statistic_writer.LatencyHistogramCollection",
+            add_histograms=mock.AsyncMock(),
+            get_histograms=mock.AsyncMock(return_value={}),
+        )
+        self.histogram_collection = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch(
+            "internal.statistic_writer.ServiceCountersCollection",
+            add_requests=mock.AsyncMock(),
+            get_counters=mock.AsyncMock(),
+        )
+        self.counters_collection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.add_rollups = {}
+        for collection in (MinuteRollupCollection, HourRollupCollection):
+            patcher = mock.patch.object(collection, "add_rollups", mock.AsyncMock())
+            self.add_rollups[collection] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_batches(self) -> list[list[dict]]:
+        return [call[0][0] for call in self.collection.insert_many.await_args_list]
+
+    async def test_batches_are_written_on_close(self):
+        writer = StatisticWriter(batch_size=2)
+        for i in range(5):
+            writer.add(get_document(str(i)))
+
+        self.collection.insert_many.assert_not_awaited()
+        await writer.close()
+
+        self.assertEqual(
+            self.get_batches(),
+            [
+                [get_document("0"), get_document("1")],
+                [get_document("2"), get_document("3")],
+                [get_document("4")],
+            ],
+            "Queue should be written by batches on shutdown",
+        )
+        self.assertEqual(writer.statistic().written, 5)
+
+    async def test_batch_is_written_when_it_is_full(self):
+        writer = StatisticWriter(batch_size=2, flush_seconds=60)
+        await writer.start()
+
+        writer.add(get_document("0"))
+        await sleep(0.01)
+        self.collection.insert_many.assert_not_awaited()
+        writer.add(get_document("1"))
+        await sleep(0.01)
+
+        self.assertEqual(self.get_batches(), [[get_document("0"), get_document("1")]])
+        await writer.close()
+
+    async def test_queue_is_written_by_time(self):
+        writer = StatisticWriter(batch_size=100, flush_seconds=0.01)
+        await writer.start()
+
+        writer.add(get_document("0"))
+        await sleep(0.05)
+
+        self.assertEqual(
+            self.get_batches(),
+            [[get_document("0")]],
+            "Not full batch should be written after flush_seconds",
+        )
+        await writer.close()
+
+    async def test_queue_is_bounded(self):
+        writer = StatisticWriter(max_queue_size=2)
+        for i in range(3):
+            writer.add(get_document(str(i)))
+
+        self.assertEqual(writer.statistic().queued, 2)
+        self.assertEqual(writer.statistic().dropped, 1, "Extra document is dropped")
+
+    async def test_write_errors_are_counted_as_dropped(self):
+        self.collection.insert_many.side_effect = [
+            BulkWriteError({"writeErrors": [{"index": 0}]}),
+            ValueError("Mongo"),
+        ]
+        writer = StatisticWriter(batch_size=2)
+        for i in range(4):
+            writer.add(get_document(str(i)))
+
+        await writer.close()
+
+        self.assertEqual(writer.statistic().written, 1)
+        self.assertEqual(
+            writer.statistic().dropped, 3, "Write errors should not stop the writer"
+        )
+
+    async def test_latency_histograms(self):
+        saved = LatencyHistogram()
+        saved.add(1)
+        self.histogram_collection.get_histograms.return_value = {
+            "/api/v1/attack": saved
+        }
+        writer = StatisticWriter(max_queue_size=1)
+        writer.add(get_document("0", duration=0.1))
+        writer.add(get_document("1", path="/api/v1/stat", duration=0.2))
+
+        histograms = await writer.get_histograms()
+
+        self.assertEqual(
+            {path: histogram.count for path, histogram in histograms.items()},
+            {"/api/v1/attack": 2, "/api/v1/stat": 1},
+            "Saved histograms are merged with not saved durations, "
+            "dropped documents are counted too",
+        )
+
+        await writer.close()
+
+        histograms = self.histogram_collection.add_histograms.await_args[0][0]
+        self.assertEqual(
+            {path: histogram.count for path, histogram in histograms.items()},
+            {"/api/v1/attack": 1, "/api/v1/stat": 1},
+            "Only not saved durations are added",
+        )
+        self.assertEqual(writer.histograms, {}, "Saved durations are not kept")
+
+    async def test_latency_histograms_are_kept_on_error(self):
+        self.histogram_collection.add_histograms.side_effect = ValueError("Mongo")
+        writer = StatisticWriter()
+        writer.add(get_document("0"))
+
+        await writer.close()
+
+        self.assertEqual(writer.histograms["/api/v1/attack"].count, 1)
+
+    async def test_request_counters(self):
+        self.counters_collection.get_counters.return_value = ServiceCountersModel(
+            vm_count=5, request_count=10, duration_sum=1
+        )
+        writer = StatisticWriter(max_queue_size=1)
+        writer.add(get_document("0", duration=0.1))
+        writer.add(get_document("1", duration=0.2))
+
+        counters = await writer.get_counters()
+
+        self.assertEqual(
+            (counters.vm_count, counters.request_count),
+            (5, 12),
+            "Saved counters with not saved requests, dropped documents too",
+        )
+        self.assertAlmostEqual(counters.duration_sum, 1.3)
+
+        await writer.close()
+
+        self.counters_collection.add_requests.assert_awaited_once()
+        request_count, duration_sum = self.counters_collection.add_requests.await_args[
+            0
+        ]
+        self.assertEqual(request_count, 2)
+        self.assertAlmostEqual(duration_sum, 0.3)
+        self.assertEqual(writer.request_count, 0, "Saved requests are not kept")
+
+        self.counters_collection.add_requests.side_effect = ValueError("Mongo")
+        writer.add(get_document("2", duration=0.1))
+        await writer.close()
+
+        self.assertEqual(writer.request_count, 1, "Not saved requests are kept")
+
+    async def test_rollups(self):
+        writer = StatisticWriter()
+        writer.add(get_document("0", created_at=datetime(2023, 1, 1, 12, 0, 10)))
+        writer.add(get_document("1", created_at=datetime(2023, 1, 1, 12, 0, 50)))
+        writer.add(get_document("2", created_at=datetime(2023, 1, 1, 12, 1)))
+
+        await writer.close()
+
+        for collection, expected in (
+            (
+                MinuteRollupCollection,
+                {
+                    ("/api/v1/attack", datetime(2023, 1, 1, 12)): 2,
+                    ("/api/v1/attack", datetime(2023, 1, 1, 12, 1)): 1,
+                },
+            ),
+            (HourRollupCollection, {("/api/v1/attack", datetime(2023, 1, 1, 12)): 3}),
+        ):
+            rollups = self.add_rollups[collection].await_args[0][0]
+            self.assertEqual(
+                {key: histogram.count for key, histogram in rollups.items()},
+                expected,
+                f"Durations are rolled up by {collection.period_seconds} seconds",
+            )
+            self.assertEqual(
+                writer.rollups[collection], {}, "Saved rollups are not kept"
+            )
+
+    async def test_rollups_are_kept_on_error(self):
+        self.add_rollups[MinuteRollupCollection].side_effect = ValueError("Mongo")
+        writer = StatisticWriter()
+        writer.add(get_document("0"))
+
+        await writer.close()
+
+        self.assertEqual(
+            {
+                key: histogram.count
+                for key, histogram in writer.rollups[MinuteRollupCollection].items()
+            },
+            {("/api/v1/attack", datetime(2023, 1, 1, 12)): 1},
+        )
+        self.assertEqual(
+            writer.rollups[HourRollupCollection], {}, "Other rollups are saved"
+        )
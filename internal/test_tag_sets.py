@@ -0,0 +1,116 @@
+from unittest import IsolatedAsyncioTestCase, mock
+
+from .models import VMInfo
+
+from .mongo_mock import (  # isort: skip
+    CollectionMock,
+    DatabaseMock,
+    get_collection_mock,
+    patch_database,
+)
+
+from .tag_sets import (  # isort: skip
+    add_tag_sets,
+    get_attacker_vm_ids_for_tag_set,
+    get_tag_set_signature,
+    update_tag_sets,
+)
+
+
+def get_mock_path(item: str) -> str:
+    return f"internal.tag_sets.{item}"
+
+
+class TagSetsTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.longMessage = True
+
+    def test_signature(self):
+        self.assertEqual(
+            get_tag_set_signature(["t1", "t2"]),
+            get_tag_set_signature(["t2", "t1", "t2"]),
+            "Order and duplicates of tags should not change signature",
+        )
+        self.assertNotEqual(
+            get_tag_set_signature(["t1", "t2"]), get_tag_set_signature(["t1"])
+        )
+        self.assertNotEqual(
+            get_tag_set_signature(["t1", "t2"]),
+            get_tag_set_signature(["t1\nt2"]),
+            "Tags should not be glued together",
+        )
+
+    def test_attacker_vm_ids_for_tag_set(self):
+        result = get_attacker_vm_ids_for_tag_set(
+            ["t1", "t2", "t4"],
+            vm_ids_for_tag={"t1": ["vm-1"], "t2": ["vm-2"], "t3": ["vm-3", "vm-1"]},
+            tags_with_access_for_tag={"t1": {"t3"}, "t2": {"t1", "t3"}},
+        )
+
+        self.assertEqual(
+            result, ["vm-1", "vm-3"], "Sorted unique VMs of all tags with access"
+        )
+
+    @mock.patch(get_mock_path("MONGO_ARRAY_ELEMS_COUNT"), 2)
+    @mock.patch(get_mock_path("TagSetCollection"), new_callable=get_collection_mock)
+    async def test_add_tag_sets(self, tag_set_collection):
+        await add_tag_sets(
+            "snapshot",
+            tags_for_tag_set={"s1": ["t1"], "s2": ["t2"]},
+            vm_ids_for_tag={"t1": ["vm-1"], "t2": ["vm-2", "vm-3", "vm-4"]},
+            tags_with_access_for_tag={"t1": {"t2"}},
+        )
+
+        tag_set_collection.for_snapshot.assert_called_once_with("snapshot")
+        tag_set_collection.create_indexes.assert_awaited_once()
+        tag_set_collection.insert_many.assert_awaited_once_with(
+            [
+                {
+                    "signature": "s1",
+                    "tags": ["t1"],
+                    "attacker_vm_ids": ["vm-2", "vm-3"],
+                },
+                {"signature": "s1", "tags": ["t1"], "attacker_vm_ids": ["vm-4"]},
+                {"signature": "s2", "tags": ["t2"], "attacker_vm_ids": []},
+            ],
+            ordered=False,
+        )
+
+    async def test_update_tag_sets(self):
+        signature_1 = get_tag_set_signature(["t1"])
+        signature_2 = get_tag_set_signature(["t2"])
+        db = DatabaseMock()
+        db["TagSet_base"] = CollectionMock(
+            [
+                {"signature": signature_1, "tags": ["t1"], "attacker_vm_ids": []},
+                {"signature": signature_2, "tags": ["t2"], "attacker_vm_ids": ["x"]},
+            ]
+        )
+        db["TagInfo_layer"] = CollectionMock(
+            [
+                {"tag": "t1", "tagged_vm_ids": ["vm-1"], "tags_with_access": ["t3"]},
+                {"tag": "t3", "tagged_vm_ids": ["vm-3"], "tags_with_access": []},
+            ]
+        )
+
+        with patch_database(db):
+            await update_tag_sets(
+                "layer",
+                "base",
+                [VMInfo(id="vm-3", name="", tags=["t3"])],
+                affected_tags={"t1"},
+            )
+
+        self.assertEqual(
+            db.get_docs("TagSet_layer", {"_id": False}),
+            [
+                {"signature": signature_1, "tags": ["t1"], "attacker_vm_ids": ["vm-3"]},
+                {
+                    "signature": get_tag_set_signature(["t3"]),
+                    "tags": ["t3"],
+                    "attacker_vm_ids": [],
+                },
+            ],
+            "Tag sets with affected tags and of upserted VMs are written to the layer",
+        )
+        self.assertEqual(len(db.get_docs("TagSet_base")), 2, "Base is not changed")
@@ -5,14 +5,11 @@ from internal.config import ALLOWED_HOST
 from internal.crud import StatusCollection
 from internal.db import close_mongo_connection, connect_to_mongo
 from internal.models import StatusModel
+from internal.processor import check_attack_resolver, preload_attack_graph
+from internal.statistic_writer import statistic_writer
 from routers.api import router as router_api
 
-from middlewares.check_service_status_middleware import (  # isort: skip
-    is_service_correctly_configured,
-)
-from middlewares.save_service_statistic_middleware import (  # isort: skip
-    save_service_statistic,
-)
+from middlewares.service_middleware import ServiceMiddleware  # isort: skip
 
 origins = []
 origins.extend(ALLOWED_HOST)
@@ -26,18 +23,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 app.include_router(router_api, prefix="/api", tags=["api"])
+app.add_middleware(ServiceMiddleware)
 
 
-is_service_correctly_configured = app.middleware("http")(
-    is_service_correctly_configured
-)
-save_service_statistic = app.middleware("http")(save_service_statistic)
-
-
+app.add_event_handler("startup", check_attack_resolver)
 app.add_event_handler("startup", connect_to_mongo)
+app.add_event_handler("startup", StatusCollection.start_watching)
+app.add_event_handler("startup", preload_attack_graph)
+app.add_event_handler("startup", statistic_writer.start)
+app.add_event_handler("shutdown", statistic_writer.close)
+app.add_event_handler("shutdown", StatusCollection.stop_watching)
 app.add_event_handler("shutdown", close_mongo_connection)
 
 
 @app.get("/status", response_model=StatusModel)
 async def get_status(request: Request) -> StatusModel:
-    return await StatusCollection.get_status()
+    return await StatusCollection.get_active_status()
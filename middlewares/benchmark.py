@@ -0,0 +1,145 @@
+"""
+Per-request overhead of service middlewares, ASGI app is called directly:
+
+    python -m middlewares.benchmark [requests count]
+
+"before" are the previous two @app.middleware("http") wrappers
+(BaseHTTPMiddleware), "after" is ServiceMiddleware.
+"""
+import asyncio
+import sys
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+import internal.crud
+from internal.config import CUSTOM_ENDPOINTS_STARTSWITH
+from internal.crud import StatusCollection
+from internal.models import ServiceStatusModel
+from internal.statistic_writer import statistic_writer
+from middlewares.service_middleware import ServiceMiddleware
+
+from middlewares import (  # isort: skip
+    check_service_status_middleware,
+    save_service_statistic_middleware,
+)
+
+
+async def check_status_before(request, call_next):
+    if not any(
+        request.url.path.startswith(prefix) for prefix in CUSTOM_ENDPOINTS_STARTSWITH
+    ):
+        return await call_next(request)
+    try:
+        check_service_status_val = bool(
+            int(check_service_status_middleware.CHECK_SERVICE_STATUS)
+        )
+    except ValueError:
+        check_service_status_val = True
+    if not check_service_status_val:
+        return await call_next(request)
+    error_response = await check_service_status_middleware.get_service_status_error()
+    return error_response or await call_next(request)
+
+
+async def save_statistic_before(request, call_next):
+    if not any(
+        request.url.path.startswith(prefix) for prefix in CUSTOM_ENDPOINTS_STARTSWITH
+    ):
+        return await call_next(request)
+    try:
+        save_service_statistic_val = bool(
+            int(save_service_statistic_middleware.SAVE_SERVICE_STATISTIC)
+        )
+    except ValueError:
+        save_service_statistic_val = True
+    if not save_service_statistic_val:
+        return await call_next(request)
+    start_time = time.time()
+    response = await call_next(request)
+    save_service_statistic_middleware.save_service_statistic(
+        request.url.path, request.url.query, start_time, time.time() - start_time
+    )
+    return response
+
+
+async def endpoint(request):
+    return PlainTextResponse("[]")
+
+
+def get_app(middleware: list[Middleware]) -> Starlette:
+    return Starlette(routes=[Route("/api/v1/attack", endpoint)], middleware=middleware)
+
+
+APPS = {
+    "no middleware": get_app([]),
+    "before": get_app(
+        [
+            Middleware(BaseHTTPMiddleware, dispatch=save_statistic_before),
+            Middleware(BaseHTTPMiddleware, dispatch=check_status_before),
+        ]
+    ),
+    "after": get_app([Middleware(ServiceMiddleware)]),
+}
+
+
+async def call(app, scope: dict):
+    request_messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if request_messages:
+            return request_messages.pop()
+        # like a server: the next message is sent only on client disconnect
+        await asyncio.Event().wait()
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def benchmark(app, count: int) -> float:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/api/v1/attack",
+        "raw_path": b"/api/v1/attack",
+        "root_path": "",
+        "query_string": b"vm_id=vm-1",
+        "headers": [],
+        "server": ("localhost", 8000),
+        "client": ("localhost", 50000),
+    }
+    for _ in range(100):
+        await call(app, dict(scope))
+
+    started_at = time.perf_counter()
+    for _ in range(count):
+        await call(app, dict(scope))
+    duration = time.perf_counter() - started_at
+    statistic_writer.queue.clear()
+    return duration / count
+
+
+async def main(count: int):
+    # status is in memory, statistic is only queued: only middlewares are measured
+    internal.crud.ACTIVE_SNAPSHOT_CACHE_SECONDS = float("inf")
+    StatusCollection.set_active_status(ServiceStatusModel(ok=True, snapshot="s"))
+    check_service_status_middleware.CHECK_SERVICE_STATUS = "1"
+    save_service_statistic_middleware.SAVE_SERVICE_STATISTIC = "1"
+    statistic_writer.max_queue_size = count + 100
+
+    for name, app in APPS.items():
+        per_request = await benchmark(app, count)
+        print(f"{name:>14}: {per_request * 1e6:8.1f} us/request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
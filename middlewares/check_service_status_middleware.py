@@ -1,33 +1,36 @@
-from fastapi import Request
+from functools import lru_cache
+from typing import Optional
+
 from fastapi.responses import JSONResponse
 
-from internal.config import CHECK_SERVICE_STATUS, CUSTOM_ENDPOINTS_STARTSWITH
+from internal.config import CHECK_SERVICE_STATUS
 from internal.crud import StatusCollection
 from internal.models import StatusModel
 
 
-async def is_service_correctly_configured(request: Request, call_next):
-    if not any(
-        request.url.path.startswith(prefix) for prefix in CUSTOM_ENDPOINTS_STARTSWITH
-    ):
-        return await call_next(request)
-
+@lru_cache
+def is_check_enabled(check_service_status) -> bool:
     try:
-        check_service_status_val = bool(int(CHECK_SERVICE_STATUS))
+        return bool(int(check_service_status))
     except ValueError:
-        check_service_status_val = True
+        return True
+
 
-    if not check_service_status_val:
-        return await call_next(request)
+async def get_service_status_error() -> Optional[JSONResponse]:
+    """
+    Response with status when the service can't do attacks, None when it can.
+    """
+    if not is_check_enabled(CHECK_SERVICE_STATUS):
+        return None
 
-    status = await StatusCollection.get_status()
+    status = await StatusCollection.get_active_status()
     if not status:
         status = StatusModel(
             ok=False,
             error_msg="Cloud Environment (.json file) configuration was not processed by service before start",
         )
     if not status.ok:
-        return JSONResponse(content=status.dict(), status_code=428)
-
-    response = await call_next(request)
-    return response
+        return JSONResponse(
+            content=status.dict(include=set(StatusModel.__fields__)), status_code=428
+        )
+    return None
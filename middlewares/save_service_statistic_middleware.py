@@ -1,43 +1,31 @@
-import logging
-import time
+from datetime import datetime
+from functools import lru_cache
 
-from fastapi import Request
-
-from internal.config import CUSTOM_ENDPOINTS_STARTSWITH, SAVE_SERVICE_STATISTIC
-from internal.crud import ResponseInfoCollection
-from internal.logger import log_step_async
+from internal.config import SAVE_SERVICE_STATISTIC
 from internal.models import ResponseInfoModel
+from internal.statistic_writer import statistic_writer
 
-logger = logging.getLogger(__name__)
-
-
-async def save_service_statistic(request: Request, call_next):
-    if not any(
-        request.url.path.startswith(prefix) for prefix in CUSTOM_ENDPOINTS_STARTSWITH
-    ):
-        return await call_next(request)
 
+@lru_cache
+def is_statistic_enabled(save_service_statistic) -> bool:
     try:
-        save_service_statistic_val = bool(int(SAVE_SERVICE_STATISTIC))
+        return bool(int(save_service_statistic))
     except ValueError:
-        save_service_statistic_val = True
+        return True
 
-    if not save_service_statistic_val:
-        return await call_next(request)
 
-    start_time = time.time()
-    response = await log_step_async(
-        logger, f"call {request.url.path} and save it to statistics collection"
-    )(call_next)(request)
-    process_time = time.time() - start_time
+def is_service_statistic_saved() -> bool:
+    return is_statistic_enabled(SAVE_SERVICE_STATISTIC)
 
-    await ResponseInfoCollection.insert_one(
+
+def save_service_statistic(
+    path: str, params: str, start_time: float, process_time: float
+):
+    statistic_writer.add(
         ResponseInfoModel(
-            id=str(start_time),
+            created_at=datetime.utcfromtimestamp(start_time),
             duration=process_time,
-            path=request.url.path,
-            params=request.url.query or "",
+            path=path,
+            params=params,
         ).dict(by_alias=True)
     )
-
-    return response
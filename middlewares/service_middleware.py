@@ -0,0 +1,74 @@
+import logging
+import time
+
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from internal.config import CUSTOM_ENDPOINTS_STARTSWITH
+
+from middlewares.check_service_status_middleware import (  # isort: skip
+    get_service_status_error,
+)
+from middlewares.save_service_statistic_middleware import (  # isort: skip
+    is_service_statistic_saved,
+    save_service_statistic,
+)
+
+logger = logging.getLogger(__name__)
+
+# statistic key of requests which don't match any route (404)
+UNMATCHED_PATH = "<unmatched>"
+
+
+def get_route_path(scope: Scope) -> str:
+    """
+    Path template of the route of the request: statistic has one key per endpoint,
+    whatever path is requested.
+    """
+    route = scope.get("route")
+    if route is None and "app" in scope:
+        # the response was sent before routing, e.g. with service status error
+        for app_route in scope["app"].routes:
+            match, _ = app_route.matches(scope)
+            if match == Match.FULL:
+                route = app_route
+                break
+    return route.path if route else UNMATCHED_PATH
+
+
+class ServiceMiddleware:
+    """
+    Pure ASGI middleware for custom endpoints: checks service status and saves
+    duration of requests. Messages of the app are sent as is, so streaming
+    responses are not buffered.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.custom_endpoints_prefixes = tuple(CUSTOM_ENDPOINTS_STARTSWITH)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(
+            self.custom_endpoints_prefixes
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        with_statistic = is_service_statistic_saved()
+        start_time = time.time()
+
+        error_response = await get_service_status_error()
+        if error_response:
+            await error_response(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+        if with_statistic:
+            process_time = time.time() - start_time
+            logger.debug("Finish %s [%s]", scope["path"], process_time)
+            save_service_statistic(
+                get_route_path(scope),
+                scope["query_string"].decode("latin-1"),
+                start_time,
+                process_time,
+            )
@@ -1,51 +1,239 @@
+import json
 from asyncio import gather
-from typing import Type
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Iterator, Optional
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 
-from internal.processor import get_vm_id_list_with_access_to_vm
+from internal.cache import CacheStatisticInfo
+from internal.histogram import LatencyInfo
+from internal.statistic_writer import StatisticWriterInfo, statistic_writer
 
 from internal.crud import (  # isort: skip
-    GetNamedCollectionMixin,
-    ResponseInfoCollection,
-    VirtualMachineCollection,
+    ExposureCollection,
+    HourRollupCollection,
+    MinuteRollupCollection,
+)
+
+from internal.config import (  # isort: skip
+    ATTACK_PAGE_MAX_LIMIT,
+    ATTACK_PATHS_MAX_DEPTH,
+    ATTACK_STREAM_CHUNK_SIZE,
+    EXPOSURE_TOP_MAX_K,
+    MINUTE_ROLLUP_TTL_SECONDS,
+    STAT_TIMESERIES_MAX_POINTS,
+)
+
+from internal.processor import (  # isort: skip
+    count_vm_ids_with_access_to_vm,
+    get_encoded_vm_id_list_with_access_to_vm,
+    get_vm_distances_with_access_to_vm,
+    get_vm_id_list_accessible_from_vm,
+    get_vm_id_lists_with_access_to_vms,
+    has_vm_ids_with_access_to_vm,
+    iter_vm_ids_with_access_to_vm,
+    tag_attackers_cache,
 )
 
 router = APIRouter()
 
+# Endpoints with big responses return Response: response_model is used only for
+# OpenAPI schema, the result is not validated and encoded item by item.
+
 
 VmId = str
 VmIdsList = list[VmId]
 
 
 @router.get("/attack", response_model=VmIdsList)
-async def do_attack(request: Request, vm_id: VmId) -> VmIdsList:
-    return await get_vm_id_list_with_access_to_vm(vm_id)
+async def do_attack(request: Request, vm_id: VmId) -> Response:
+    return Response(
+        await get_encoded_vm_id_list_with_access_to_vm(vm_id),
+        media_type=ORJSONResponse.media_type,
+    )
+
+
+@router.get("/targets", response_model=VmIdsList)
+async def do_targets(request: Request, vm_id: VmId) -> ORJSONResponse:
+    return ORJSONResponse(await get_vm_id_list_accessible_from_vm(vm_id))
+
+
+@router.get("/attack/count", response_model=int)
+async def do_attack_count(request: Request, vm_id: VmId) -> int:
+    return await count_vm_ids_with_access_to_vm(vm_id)
+
+
+@router.get("/attack/exists", response_model=bool)
+async def do_attack_exists(request: Request, vm_id: VmId) -> bool:
+    return await has_vm_ids_with_access_to_vm(vm_id)
+
+
+@router.get("/attack/paths", response_model=dict[VmId, int])
+async def do_attack_paths(
+    request: Request,
+    vm_id: VmId,
+    max_depth: int = Query(ATTACK_PATHS_MAX_DEPTH, gt=0, le=ATTACK_PATHS_MAX_DEPTH),
+) -> ORJSONResponse:
+    return ORJSONResponse(await get_vm_distances_with_access_to_vm(vm_id, max_depth))
+
+
+def iter_ndjson(vm_ids: Iterator[VmId]) -> Iterator[str]:
+    while True:
+        lines = [
+            json.dumps(vm_id) + "\n"
+            for vm_id in islice(vm_ids, ATTACK_STREAM_CHUNK_SIZE)
+        ]
+        if not lines:
+            return
+        yield "".join(lines)
+
+
+@router.get("/attack/stream", response_class=StreamingResponse)
+async def do_attack_stream(request: Request, vm_id: VmId) -> StreamingResponse:
+    vm_ids = await iter_vm_ids_with_access_to_vm(vm_id)
+    return StreamingResponse(iter_ndjson(vm_ids), media_type="application/x-ndjson")
+
+
+class VmIdsPage(BaseModel):
+    vm_ids: VmIdsList
+    next_after: Optional[VmId]
+
+
+@router.get("/attack/page", response_model=VmIdsPage)
+async def do_attack_page(
+    request: Request,
+    vm_id: VmId,
+    limit: int = Query(ATTACK_PAGE_MAX_LIMIT, gt=0, le=ATTACK_PAGE_MAX_LIMIT),
+    after: Optional[VmId] = None,
+) -> ORJSONResponse:
+    vm_ids = list(islice(await iter_vm_ids_with_access_to_vm(vm_id, after), limit))
+    return ORJSONResponse(
+        {"vm_ids": vm_ids, "next_after": vm_ids[-1] if len(vm_ids) == limit else None}
+    )
+
+
+@router.post("/attack/batch", response_model=dict[VmId, VmIdsList])
+async def do_attack_batch(request: Request, vm_ids: VmIdsList) -> ORJSONResponse:
+    return ORJSONResponse(await get_vm_id_lists_with_access_to_vms(vm_ids))
+
+
+class VmExposureInfo(BaseModel):
+    vm_id: VmId
+    attackers_count: int
+
+
+@router.get("/exposure/top", response_model=list[VmExposureInfo])
+async def get_exposure_top(
+    request: Request,
+    k: int = Query(10, gt=0, le=EXPOSURE_TOP_MAX_K),
+) -> ORJSONResponse:
+    return ORJSONResponse(
+        [
+            {"vm_id": exposure.id, "attackers_count": exposure.attackers_count}
+            for exposure in await ExposureCollection.get_top(k)
+        ]
+    )
 
 
 class ServiceStatisticInfo(BaseModel):
     vm_count: int
     request_count: int
     average_request_time: float
+    latency: dict[str, LatencyInfo]
 
 
-async def get_docs_count(collection: Type[GetNamedCollectionMixin]):
-    collection = await collection.get_collection()
-    doc_count = await collection.count_documents({})
-    return doc_count
+@router.get("/stat", response_model=ServiceStatisticInfo)
+async def get_statistic(request: Request) -> ORJSONResponse:
+    counters, histograms = await gather(
+        statistic_writer.get_counters(),
+        statistic_writer.get_histograms(),
+    )
 
+    return ORJSONResponse(
+        ServiceStatisticInfo(
+            vm_count=counters.vm_count,
+            request_count=counters.request_count,
+            average_request_time=(
+                counters.duration_sum / counters.request_count
+                if counters.request_count
+                else 0
+            ),
+            latency={path: histogram.info() for path, histogram in histograms.items()},
+        ).dict()
+    )
 
-@router.get("/stat", response_model=ServiceStatisticInfo)
-async def get_statistic(request: Request) -> ServiceStatisticInfo:
-    vm_count, resp_count, average_time = await gather(
-        get_docs_count(VirtualMachineCollection),
-        get_docs_count(ResponseInfoCollection),
-        ResponseInfoCollection.get_average_duration(),
+
+class StatisticPoint(LatencyInfo):
+    start: datetime
+    sum: float
+    min: float
+
+
+class StatisticTimeseries(BaseModel):
+    period_seconds: int
+    points: list[StatisticPoint]
+
+
+def to_utc(value: datetime) -> datetime:
+    """
+    Rollups are saved with naive UTC datetimes.
+    """
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+@router.get("/stat/timeseries", response_model=StatisticTimeseries)
+async def get_statistic_timeseries(
+    request: Request,
+    path: str,
+    from_: datetime = Query(alias="from"),
+    to: Optional[datetime] = None,
+) -> ORJSONResponse:
+    """
+    Per-minute points while they fit into STAT_TIMESERIES_MAX_POINTS
+    and are not expired, otherwise per-hour points. Ranges with more than
+    STAT_TIMESERIES_MAX_POINTS hours are rejected.
+    """
+    now = datetime.utcnow()
+    start, end = to_utc(from_), to_utc(to) if to else now
+    if end - start > timedelta(hours=STAT_TIMESERIES_MAX_POINTS):
+        raise HTTPException(
+            status_code=422,
+            detail=f"Range should be at most {STAT_TIMESERIES_MAX_POINTS} hours",
+        )
+    is_long = end - start > timedelta(minutes=STAT_TIMESERIES_MAX_POINTS)
+    is_expired = start < now - timedelta(seconds=MINUTE_ROLLUP_TTL_SECONDS)
+    collection = (
+        HourRollupCollection if is_long or is_expired else MinuteRollupCollection
     )
 
-    return ServiceStatisticInfo(
-        vm_count=vm_count,
-        request_count=resp_count,
-        average_request_time=average_time or 0,
+    return ORJSONResponse(
+        StatisticTimeseries(
+            period_seconds=collection.period_seconds,
+            points=[
+                StatisticPoint(
+                    start=period_start.replace(tzinfo=timezone.utc),
+                    sum=histogram.sum,
+                    min=histogram.min,
+                    **histogram.info().dict(),
+                )
+                for period_start, histogram in await collection.get_rollups(
+                    path, collection.get_period_start(start), end
+                )
+            ],
+        ).dict()
     )
+
+
+@router.get("/stat/cache", response_model=CacheStatisticInfo)
+async def get_cache_statistic(request: Request) -> ORJSONResponse:
+    return ORJSONResponse(tag_attackers_cache.statistic().dict())
+
+
+@router.get("/stat/writer", response_model=StatisticWriterInfo)
+async def get_statistic_writer_info(request: Request) -> ORJSONResponse:
+    return ORJSONResponse(statistic_writer.statistic().dict())
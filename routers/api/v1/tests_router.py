@@ -1,10 +1,15 @@
 import os
+from datetime import datetime, timedelta, timezone
 from unittest import IsolatedAsyncioTestCase, mock
 
+import orjson
 from fastapi.testclient import TestClient
 from httpx import codes
 from requests import codes
 
+from internal.cache import SnapshotLRUCache
+from internal.histogram import LatencyHistogram
+from internal.models import ExposureInfo, ServiceCountersModel
 from main import app
 
 
@@ -20,15 +25,18 @@ class AttackTestCase(IsolatedAsyncioTestCase):
             "vm_id1",
         ]
         with mock.patch(
-            "routers.api.v1.router.get_vm_id_list_with_access_to_vm"
-        ) as get_vm_id_list_with_access_to_vm_mock:
-            get_vm_id_list_with_access_to_vm_mock.return_value = (
+            "routers.api.v1.router.get_encoded_vm_id_list_with_access_to_vm"
+        ) as get_encoded_vm_id_list_with_access_to_vm_mock:
+            get_encoded_vm_id_list_with_access_to_vm_mock.return_value = orjson.dumps(
                 expected_ids_with_access
             )
             response = client.get("/api/v1/attack", params={"vm_id": "test"})
         self.assertEqual(response.status_code, codes.OK, "Should return 200")
         self.assertEqual(
-            get_vm_id_list_with_access_to_vm_mock.call_count,
+            response.headers["content-type"], "application/json", "Should return JSON"
+        )
+        self.assertEqual(
+            get_encoded_vm_id_list_with_access_to_vm_mock.call_count,
             1,
             "Should call logic function",
         )
@@ -37,3 +45,344 @@ class AttackTestCase(IsolatedAsyncioTestCase):
             expected_ids_with_access,
             "Should return result of logic function",
         )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_attack_batch(self):
+        client = TestClient(app)
+
+        expected_ids_with_access = {"vm_id1": ["vm_id2"], "vm_id2": []}
+        with mock.patch(
+            "routers.api.v1.router.get_vm_id_lists_with_access_to_vms"
+        ) as get_vm_id_lists_with_access_to_vms_mock:
+            get_vm_id_lists_with_access_to_vms_mock.return_value = (
+                expected_ids_with_access
+            )
+            response = client.post("/api/v1/attack/batch", json=["vm_id1", "vm_id2"])
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        get_vm_id_lists_with_access_to_vms_mock.assert_called_once_with(
+            ["vm_id1", "vm_id2"]
+        )
+        self.assertEqual(
+            response.json(),
+            expected_ids_with_access,
+            "Should return result of logic function",
+        )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_attack_paths(self):
+        client = TestClient(app)
+
+        with mock.patch(
+            "routers.api.v1.router.get_vm_distances_with_access_to_vm",
+            mock.AsyncMock(return_value={"vm_id1": 1, "vm_id2": 2}),
+        ) as get_vm_distances_with_access_to_vm_mock:
+            response = client.get(
+                "/api/v1/attack/paths", params={"vm_id": "test", "max_depth": 2}
+            )
+            invalid_response = client.get(
+                "/api/v1/attack/paths", params={"vm_id": "test", "max_depth": 0}
+            )
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        get_vm_distances_with_access_to_vm_mock.assert_awaited_once_with("test", 2)
+        self.assertEqual(
+            response.json(),
+            {"vm_id1": 1, "vm_id2": 2},
+            "Should return VMs with count of hops",
+        )
+        self.assertEqual(
+            invalid_response.status_code,
+            codes.UNPROCESSABLE_ENTITY,
+            "Depth should be positive",
+        )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_targets(self):
+        client = TestClient(app)
+
+        with mock.patch(
+            "routers.api.v1.router.get_vm_id_list_accessible_from_vm",
+            mock.AsyncMock(return_value=["vm_id1"]),
+        ) as get_vm_id_list_accessible_from_vm_mock:
+            response = client.get("/api/v1/targets", params={"vm_id": "test"})
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        get_vm_id_list_accessible_from_vm_mock.assert_awaited_once_with("test")
+        self.assertEqual(
+            response.json(), ["vm_id1"], "Should return result of logic function"
+        )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_attack_count_and_exists(self):
+        client = TestClient(app)
+
+        with mock.patch(
+            "routers.api.v1.router.count_vm_ids_with_access_to_vm",
+            mock.AsyncMock(return_value=3),
+        ), mock.patch(
+            "routers.api.v1.router.has_vm_ids_with_access_to_vm",
+            mock.AsyncMock(return_value=True),
+        ):
+            count_response = client.get(
+                "/api/v1/attack/count", params={"vm_id": "test"}
+            )
+            exists_response = client.get(
+                "/api/v1/attack/exists", params={"vm_id": "test"}
+            )
+        self.assertEqual(count_response.status_code, codes.OK, "Should return 200")
+        self.assertEqual(count_response.json(), 3, "Should return count of VMs")
+        self.assertEqual(exists_response.status_code, codes.OK, "Should return 200")
+        self.assertEqual(exists_response.json(), True, "Should return if VMs exist")
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    @mock.patch("routers.api.v1.router.ATTACK_STREAM_CHUNK_SIZE", 2)
+    async def test_attack_stream(self):
+        client = TestClient(app)
+
+        with mock.patch(
+            "routers.api.v1.router.iter_vm_ids_with_access_to_vm"
+        ) as iter_vm_ids_with_access_to_vm_mock:
+            iter_vm_ids_with_access_to_vm_mock.return_value = iter(
+                ["vm_id1", "vm_id2", "vm_id3"]
+            )
+            response = client.get("/api/v1/attack/stream", params={"vm_id": "test"})
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        self.assertEqual(
+            response.headers["content-type"], "application/x-ndjson", "NDJSON"
+        )
+        self.assertEqual(
+            response.text,
+            '"vm_id1"\n"vm_id2"\n"vm_id3"\n',
+            "Should return one VM ID per line",
+        )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_attack_page(self):
+        client = TestClient(app)
+
+        with mock.patch(
+            "routers.api.v1.router.iter_vm_ids_with_access_to_vm"
+        ) as iter_vm_ids_with_access_to_vm_mock:
+            iter_vm_ids_with_access_to_vm_mock.side_effect = lambda vm_id, after: iter(
+                ["vm_id2", "vm_id3", "vm_id4"]
+            )
+            response = client.get(
+                "/api/v1/attack/page",
+                params={"vm_id": "test", "after": "vm_id1", "limit": 2},
+            )
+            last_response = client.get(
+                "/api/v1/attack/page", params={"vm_id": "test", "limit": 3}
+            )
+            invalid_response = client.get(
+                "/api/v1/attack/page", params={"vm_id": "test", "limit": 0}
+            )
+        iter_vm_ids_with_access_to_vm_mock.assert_any_call("test", "vm_id1")
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        self.assertEqual(
+            response.json(),
+            {"vm_ids": ["vm_id2", "vm_id3"], "next_after": "vm_id3"},
+            "Should return first `limit` VM IDs and cursor for the next page",
+        )
+        self.assertEqual(
+            last_response.json(),
+            {"vm_ids": ["vm_id2", "vm_id3", "vm_id4"], "next_after": "vm_id4"},
+        )
+        self.assertEqual(
+            invalid_response.status_code,
+            codes.UNPROCESSABLE_ENTITY,
+            "Limit should be positive",
+        )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_cache_statistic(self):
+        client = TestClient(app)
+
+        cache = SnapshotLRUCache(max_entries=10, max_size=10)
+        cache.use_version(("snapshot", 1))
+        cache.put("tag", ("vm_id1",), ("snapshot", 1))
+        cache.get("tag")
+        with mock.patch("routers.api.v1.router.tag_attackers_cache", cache):
+            response = client.get("/api/v1/stat/cache")
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        self.assertEqual(
+            response.json(),
+            {
+                "version": "('snapshot', 1)",
+                "entries": 1,
+                "size": 1,
+                "hits": 1,
+                "misses": 0,
+                "evictions": 0,
+            },
+            "Should return counters of tag cache",
+        )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_exposure_top(self):
+        client = TestClient(app)
+
+        with mock.patch(
+            "routers.api.v1.router.ExposureCollection.get_top",
+            mock.AsyncMock(
+                return_value=[
+                    ExposureInfo(id="vm_id1", attackers_count=3),
+                    ExposureInfo(id="vm_id2", attackers_count=1),
+                ]
+            ),
+        ) as get_top_mock:
+            response = client.get("/api/v1/exposure/top", params={"k": 2})
+            invalid_response = client.get("/api/v1/exposure/top", params={"k": 0})
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        get_top_mock.assert_awaited_once_with(2)
+        self.assertEqual(
+            response.json(),
+            [
+                {"vm_id": "vm_id1", "attackers_count": 3},
+                {"vm_id": "vm_id2", "attackers_count": 1},
+            ],
+            "Should return the most exposed VMs with counts of attackers",
+        )
+        self.assertEqual(
+            invalid_response.status_code,
+            codes.UNPROCESSABLE_ENTITY,
+            "K should be positive",
+        )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_statistic(self):
+        client = TestClient(app)
+
+        attack_histogram = LatencyHistogram()
+        for duration in (0.1, 0.1, 0.4):
+            attack_histogram.add(duration)
+        stat_histogram = LatencyHistogram()
+        stat_histogram.add(0.2)
+        with mock.patch(
+            "routers.api.v1.router.statistic_writer.get_counters",
+            mock.AsyncMock(
+                return_value=ServiceCountersModel(
+                    vm_count=5, request_count=4, duration_sum=0.8
+                )
+            ),
+        ), mock.patch(
+            "routers.api.v1.router.statistic_writer.get_histograms",
+            mock.AsyncMock(
+                return_value={
+                    "/api/v1/attack": attack_histogram,
+                    "/api/v1/stat": stat_histogram,
+                }
+            ),
+        ):
+            response = client.get("/api/v1/stat")
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        result = response.json()
+        self.assertEqual(result["vm_count"], 5)
+        self.assertEqual(result["request_count"], 4)
+        self.assertAlmostEqual(result["average_request_time"], 0.2)
+        self.assertEqual(
+            result["latency"],
+            {
+                "/api/v1/attack": attack_histogram.info().dict(),
+                "/api/v1/stat": stat_histogram.info().dict(),
+            },
+            "Should return latency percentiles per path",
+        )
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0")
+    @mock.patch(
+        "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0"
+    )
+    async def test_statistic_timeseries(self):
+        client = TestClient(app)
+
+        histogram = LatencyHistogram()
+        for duration in (0.1, 0.3):
+            histogram.add(duration)
+        start = datetime.utcnow().replace(second=0, microsecond=0)
+        from_ = (start + timedelta(seconds=10)).replace(tzinfo=timezone.utc)
+        with mock.patch(
+            "routers.api.v1.router.MinuteRollupCollection.get_rollups",
+            mock.AsyncMock(return_value=[(start, histogram)]),
+        ) as get_minute_rollups, mock.patch(
+            "routers.api.v1.router.HourRollupCollection.get_rollups",
+            mock.AsyncMock(return_value=[]),
+        ) as get_hour_rollups:
+            response = client.get(
+                "/api/v1/stat/timeseries",
+                params={
+                    "path": "/api/v1/attack",
+                    "from": from_.astimezone(timezone(timedelta(hours=2))).isoformat(),
+                    "to": (from_ + timedelta(minutes=5)).isoformat(),
+                },
+            )
+            long_response = client.get(
+                "/api/v1/stat/timeseries",
+                params={
+                    "path": "/api/v1/attack",
+                    "from": (from_ - timedelta(days=2)).isoformat(),
+                },
+            )
+            too_long_response = client.get(
+                "/api/v1/stat/timeseries",
+                params={
+                    "path": "/api/v1/attack",
+                    "from": (from_ - timedelta(days=100)).isoformat(),
+                },
+            )
+
+        self.assertEqual(response.status_code, codes.OK, "Should return 200")
+        get_minute_rollups.assert_awaited_once_with(
+            "/api/v1/attack", start, start + timedelta(minutes=5, seconds=10)
+        )
+        result = response.json()
+        self.assertEqual(result["period_seconds"], 60)
+        self.assertEqual(
+            result["points"],
+            [
+                {
+                    **histogram.info().dict(),
+                    "start": start.replace(tzinfo=timezone.utc).isoformat(),
+                    "sum": histogram.sum,
+                    "min": 0.1,
+                }
+            ],
+            "Should return points of the minutes which include the range in UTC",
+        )
+
+        self.assertEqual(long_response.status_code, codes.OK, "Should return 200")
+        get_hour_rollups.assert_awaited_once()
+        self.assertEqual(
+            long_response.json(),
+            {"period_seconds": 3600, "points": []},
+            "Hour rollups should be used for long ranges",
+        )
+        self.assertEqual(
+            too_long_response.status_code,
+            codes.UNPROCESSABLE_ENTITY,
+            "Count of hour points should be limited too",
+        )
@@ -4,13 +4,20 @@ from fastapi.testclient import TestClient
 from httpx import codes
 from requests import codes
 
-from internal.models import StatusModel
+from internal.crud import StatusCollection
+from internal.models import ServiceStatusModel, StatusModel
 from main import app
+from middlewares.service_middleware import UNMATCHED_PATH, ServiceMiddleware
 
 
 @mock.patch("middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC", "0")
 class StatusTestCase(IsolatedAsyncioTestCase):
-    @mock.patch("main.StatusCollection.get_status", mock.AsyncMock(return_value=None))
+    def setUp(self) -> None:
+        StatusCollection.reset_active_status()
+
+    @mock.patch(
+        "main.StatusCollection.get_active_status", mock.AsyncMock(return_value=None)
+    )
     def test_status_negative_when_has_no_info_about_status(self):
         client = TestClient(app)
 
@@ -30,7 +37,7 @@ class StatusTestCase(IsolatedAsyncioTestCase):
         )
 
     @mock.patch(
-        "main.StatusCollection.get_status",
+        "main.StatusCollection.get_active_status",
         mock.AsyncMock(return_value=StatusModel(ok=True, error_msg="")),
     )
     def test_status_positive_when_has_info_about_status(self):
@@ -49,7 +56,7 @@ class StatusTestCase(IsolatedAsyncioTestCase):
         )
 
     @mock.patch(
-        "main.StatusCollection.get_status",
+        "main.StatusCollection.get_active_status",
         mock.AsyncMock(
             return_value=StatusModel(ok=False, error_msg="Validation failed")
         ),
@@ -68,3 +75,107 @@ class StatusTestCase(IsolatedAsyncioTestCase):
             {"ok": False, "error_msg": "Validation failed"},
             "Should return status not OK when server is OK but .json has problems",
         )
+
+    @mock.patch(
+        "main.StatusCollection.get_active_status",
+        mock.AsyncMock(
+            return_value=ServiceStatusModel(
+                ok=False, error_msg="Validation failed", snapshot="20230601"
+            )
+        ),
+    )
+    def test_status_does_not_show_snapshot(self):
+        client = TestClient(app)
+
+        response = client.get("/status")
+        self.assertEqual(
+            response.json(),
+            {"ok": False, "error_msg": "Validation failed"},
+            "Active snapshot is internal info",
+        )
+
+
+class ServiceMiddlewareTestCase(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        for patcher in (
+            mock.patch(
+                "middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "0"
+            ),
+            mock.patch(
+                "middlewares.save_service_statistic_middleware.SAVE_SERVICE_STATISTIC",
+                "1",
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("middlewares.service_middleware.save_service_statistic")
+        self.save_service_statistic = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_statistic_is_saved_for_custom_endpoints(self):
+        client = TestClient(app)
+
+        with mock.patch(
+            "routers.api.v1.router.get_vm_id_list_accessible_from_vm",
+            mock.AsyncMock(return_value=[]),
+        ):
+            client.get("/api/v1/targets", params={"vm_id": "vm-1"})
+        client.get("/docs")
+
+        self.save_service_statistic.assert_called_once()
+        path, params, start_time, process_time = self.save_service_statistic.call_args[
+            0
+        ]
+        self.assertEqual((path, params), ("/api/v1/targets", "vm_id=vm-1"))
+        self.assertGreaterEqual(process_time, 0)
+
+    @mock.patch("middlewares.check_service_status_middleware.CHECK_SERVICE_STATUS", "1")
+    @mock.patch(
+        "main.StatusCollection.get_active_status", mock.AsyncMock(return_value=None)
+    )
+    def test_statistic_is_saved_when_status_is_not_ok(self):
+        client = TestClient(app)
+
+        response = client.get("/api/v1/targets", params={"vm_id": "vm-1"})
+
+        self.assertEqual(response.status_code, codes.PRECONDITION_REQUIRED)
+        self.assertEqual(self.save_service_statistic.call_args[0][0], "/api/v1/targets")
+
+    def test_statistic_is_saved_by_route(self):
+        client = TestClient(app)
+
+        client.get("/api/v1/unknown-1")
+        client.get("/api/v2/attack")
+        client.get("/api")
+
+        self.assertEqual(
+            [call[0][0] for call in self.save_service_statistic.call_args_list],
+            [UNMATCHED_PATH, UNMATCHED_PATH, "/api"],
+            "Unknown paths should share one statistic key",
+        )
+
+    async def test_streaming_response_is_not_buffered(self):
+        messages = []
+        sent_before_next_chunk = []
+
+        async def streaming_app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"1", "more_body": True})
+            sent_before_next_chunk.append(len(messages))
+            await send({"type": "http.response.body", "body": b"2"})
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "path": "/api/v1/attack/stream", "query_string": b""}
+        await ServiceMiddleware(streaming_app)(scope, mock.AsyncMock(), send)
+
+        self.assertEqual(
+            [message.get("body") for message in messages],
+            [None, b"1", b"2"],
+            "Messages of the app should be sent as is",
+        )
+        self.assertEqual(
+            sent_before_next_chunk, [2], "Chunk should be sent before the next one"
+        )
+        self.save_service_statistic.assert_called_once()